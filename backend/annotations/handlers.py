@@ -4,13 +4,20 @@ Funciones y endpoints para manejar las anotaciones de PDF.
 import os
 import json
 from pathlib import Path
-from fastapi import APIRouter, HTTPException, Body
+import asyncio
+import glob
+import hashlib
+from fastapi import APIRouter, HTTPException, Body, Request
 from pydantic import BaseModel
 from typing import Dict, Any, Optional
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, Response
 import io
 from PyPDF2 import PdfReader, PdfWriter
 from reportlab.pdfgen import canvas
+from backend.db import find_local_file
+from backend.downloads import temp_path_for
+from backend.store import resolve_local
+from backend.utils import etag_matches, file_etag
 
 # Definir la ruta de almacenamiento de anotaciones
 ANNOTATIONS_DIR = Path("backend/annotations")
@@ -67,25 +74,63 @@ async def delete_annotations(filename: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al eliminar anotaciones: {str(e)}")
 
+# PDFs con anotaciones ya generados, para no repetir el trabajo y poder
+# servirlos con FileResponse (Range, ETag) en lugar de desde memoria
+RENDERED_DIR = Path("backend/cache/annotated")
+RENDERED_DIR.mkdir(parents=True, exist_ok=True)
+
+def _annotated_sources(filename: str):
+    """
+    (PDF original, fichero de anotaciones, su contenido, digest del resultado),
+    o None si no hay PDF original. Consulta SQLite y lee ficheros: se llama en un hilo.
+    """
+    # Ruta al PDF original descargado: `filename` es el nombre con el que el
+    # lector guarda las anotaciones (título o nombre de fichero del adjunto)
+    stored = find_local_file(filename)
+    orig_path = resolve_local(stored) if stored else resolve_local(filename)
+    if orig_path is None:
+        return None
+    ann_path = get_annotation_path(filename)
+    ann_bytes = ann_path.read_bytes() if ann_path.exists() else b""
+    # El resultado depende solo del PDF original y de las anotaciones
+    digest = hashlib.md5(file_etag(orig_path).encode() + b"\0" + ann_bytes).hexdigest()
+    return orig_path, ann_path, ann_bytes, digest
+
 @router.get("/pdf/annotated/{filename}")
-async def get_annotated_pdf(filename: str):
+async def get_annotated_pdf(filename: str, request: Request):
     """Genera y devuelve el PDF con anotaciones embebidas"""
-    # Ruta al PDF original descargado
-    orig_path = Path("backend/downloaded_pdfs") / filename
-    if not orig_path.exists():
+    sources = await asyncio.to_thread(_annotated_sources, filename)
+    if sources is None:
         raise HTTPException(status_code=404, detail=f"PDF original no encontrado: {filename}")
-    # Cargar anotaciones si existen
-    ann_path = get_annotation_path(filename)
-    annotations = {}
-    if ann_path.exists():
-        with open(ann_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            annotations = data.get('pages', {})
+    orig_path, ann_path, ann_bytes, digest = sources
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    rendered = RENDERED_DIR / f"{ann_path.stem}.{digest}.pdf"
+    if not rendered.exists():
+        annotations = json.loads(ann_bytes).get('pages', {}) if ann_bytes else {}
+        # Generar el PDF es CPU: fuera del event loop
+        await asyncio.to_thread(render_annotated_pdf, orig_path, annotations, rendered)
+        # Las versiones anteriores del mismo documento ya no sirven
+        for old in RENDERED_DIR.glob(f"{glob.escape(ann_path.stem)}.*.pdf"):
+            if old != rendered:
+                old.unlink(missing_ok=True)
+    return FileResponse(rendered, media_type="application/pdf", headers=headers,
+                        filename=f"{filename}_annotated.pdf")
+
+def render_annotated_pdf(orig_path: Path, annotations: dict, dest: Path):
+    """Escribe en `dest` el PDF original con las anotaciones dibujadas encima."""
     # Leer PDF original
     reader = PdfReader(str(orig_path))
     writer = PdfWriter()
     # Procesar cada página
     for idx, page in enumerate(reader.pages, start=1):
+        page_ann = annotations.get(str(idx), {}).get('objects', [])
+        # Las páginas sin anotaciones se copian tal cual
+        if not page_ann:
+            writer.add_page(page)
+            continue
         # Crear capa de anotaciones
         packet = io.BytesIO()
         # Determinar tamaño de página
@@ -94,7 +139,6 @@ async def get_annotated_pdf(filename: str):
         height = float(media.height)
         c = canvas.Canvas(packet, pagesize=(width, height))
         # Dibujar objetos vectoriales básicos
-        page_ann = annotations.get(str(idx), {}).get('objects', [])
         for obj in page_ann:
             if obj.get('type') == 'rect':
                 left = obj.get('left', 0)
@@ -113,8 +157,12 @@ async def get_annotated_pdf(filename: str):
         overlay_page = overlay.pages[0]
         page.merge_page(overlay_page)
         writer.add_page(page)
-    # Generar salida en memoria
-    output = io.BytesIO()
-    writer.write(output)
-    output.seek(0)
-    return StreamingResponse(output, media_type="application/pdf", headers={"Content-Disposition": f"attachment; filename=\"{filename}_annotated.pdf\""})
\ No newline at end of file
+    # Escribir a un temporal propio (puede haber dos peticiones generando el
+    # mismo documento) y publicarlo con un rename atómico
+    tmp = temp_path_for(dest)
+    try:
+        with open(tmp, "wb") as f:
+            writer.write(f)
+        os.replace(tmp, dest)
+    finally:
+        tmp.unlink(missing_ok=True)
\ No newline at end of file
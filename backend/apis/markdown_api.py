@@ -1,17 +1,30 @@
 import os
 from fastapi import APIRouter, HTTPException
 from backend.settings import DOWNLOADS_DIR
+from backend.db import set_fulltext_for_attachment
+from backend.retrieval import index_generated_text
+from backend.store import attachment_of, relative, resolve_local
 from typing import List
 
 router = APIRouter(prefix="/markdown")
 
+def index_fulltext(pdf_path, text):
+    """Añade el texto al ítem padre del adjunto (por su clave: muchos adjuntos comparten nombre de fichero)."""
+    attachment = attachment_of(pdf_path)
+    if attachment is None:
+        print(f"No attachment known for {pdf_path.name}; its text is not added to the search index.")
+        return
+    attachment_key, library_type, library_id = attachment
+    set_fulltext_for_attachment(attachment_key, text, library_type, library_id)
+
 @router.post("/generate-md-for-pdf")
 def generate_md_for_pdf(pdf_filename: str) -> dict:
     """
     Convierte un PDF local a markdown (.txt) usando MarkItDown y guarda el resultado junto al PDF.
+    pdf_filename es la ruta relativa a la carpeta de descargas.
     """
-    pdf_path = DOWNLOADS_DIR / pdf_filename
-    if not pdf_path.is_file():
+    pdf_path = resolve_local(pdf_filename)
+    if pdf_path is None:
         raise HTTPException(status_code=404, detail=f"PDF not found: {pdf_filename}")
     txt_path = pdf_path.with_suffix('.txt')
     try:
@@ -20,7 +33,10 @@ def generate_md_for_pdf(pdf_filename: str) -> dict:
         result = md.convert(str(pdf_path))
         with open(txt_path, 'w', encoding='utf-8') as f:
             f.write(result.text_content)
-        return {"status": "success", "txt_file": txt_path.name}
+        # Añadir el texto al índice de búsqueda y al de pasajes de /process-pdf
+        index_fulltext(pdf_path, result.text_content)
+        index_generated_text(result.text_content)
+        return {"status": "success", "txt_file": relative(txt_path)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error converting PDF to markdown: {e}")
 
@@ -33,14 +49,16 @@ def generate_md_for_all_pdfs() -> dict:
     md = MarkItDown(enable_plugins=False)
     converted = []
     errors = []
-    for pdf_file in DOWNLOADS_DIR.glob("*.pdf"):
+    for pdf_file in DOWNLOADS_DIR.rglob("*.pdf"):
         txt_file = pdf_file.with_suffix('.txt')
         if not txt_file.exists():
             try:
                 result = md.convert(str(pdf_file))
                 with open(txt_file, 'w', encoding='utf-8') as f:
                     f.write(result.text_content)
-                converted.append(txt_file.name)
+                index_fulltext(pdf_file, result.text_content)
+                index_generated_text(result.text_content)
+                converted.append(relative(txt_file))
             except Exception as e:
-                errors.append({"pdf": pdf_file.name, "error": str(e)})
+                errors.append({"pdf": relative(pdf_file), "error": str(e)})
     return {"converted": converted, "errors": errors}
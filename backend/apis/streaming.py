@@ -0,0 +1,61 @@
+"""
+Respuestas en streaming (Server-Sent Events) para los endpoints /chat y
+/process-pdf de todos los proveedores.
+
+Con `?stream=true` el endpoint responde `text/event-stream` en cuanto llega
+el primer fragmento del modelo. Todos los proveedores emiten los mismos
+eventos, una línea `data:` con JSON cada uno:
+
+    {"type": "delta", "text": "..."}       fragmento nuevo de la respuesta
+    {"type": "done", "response": "..."}    fin, con la respuesta completa
+    {"type": "error", "detail": "..."}     error a mitad de la respuesta
+
+Si el cliente se desconecta (o pulsa Stop) se deja de leer y se cierra la
+petición al proveedor, que deja de generar.
+"""
+import json
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+
+def _event(payload: dict) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+async def sse_response(request: Request, deltas) -> StreamingResponse:
+    """
+    Respuesta SSE a partir de un generador asíncrono de fragmentos de texto.
+    Se espera al primer fragmento antes de responder, de modo que los errores
+    de la llamada (clave inválida, modelo inexistente...) siguen saliendo
+    como excepción en el endpoint y no como un 200 con un evento de error.
+    """
+    try:
+        first = await anext(deltas)
+    except StopAsyncIteration:
+        first = None
+
+    async def events():
+        parts = []
+        try:
+            if first:
+                parts.append(first)
+                yield _event({"type": "delta", "text": first})
+            async for text in deltas:
+                if await request.is_disconnected():
+                    print("Client disconnected, cancelling the model stream.")
+                    break
+                if text:
+                    parts.append(text)
+                    yield _event({"type": "delta", "text": text})
+            else:
+                yield _event({"type": "done", "response": "".join(parts)})
+        except Exception as e:
+            print(f"[ERROR] Error while streaming the model response: {e}")
+            yield _event({"type": "error", "detail": str(e)})
+        finally:
+            # Cierra el stream del proveedor también si el cliente se ha ido
+            await deltas.aclose()
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,14 +1,120 @@
+import json
+import os
+import re
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
 
-DB_PATH = Path(__file__).parent / "database.db"
+from backend.utils import item_fields
+
+DB_PATH = Path(os.getenv("DATABASE_PATH", Path(__file__).parent / "database.db"))
 
 def get_connection():
-    return sqlite3.connect(DB_PATH)
+    # timeout: espera al escritor en lugar de fallar con "database is locked"
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    # Con WAL, synchronous=NORMAL solo hace fsync en los checkpoints
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+_write_lock = threading.Lock()
+
+@contextmanager
+def transaction():
+    """
+    Conexión con una única transacción de escritura: commit al salir del
+    bloque, rollback si se produce una excepción.
+    Las transacciones del proceso se serializan con un lock, de modo que
+    varios hilos de sincronización no compiten por el bloqueo de SQLite.
+    """
+    with _write_lock:
+        conn = get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+def try_write(sql, params):
+    """
+    Escritura no esencial (p. ej. un último acceso): si hay otra transacción
+    en curso se omite en lugar de esperarla. Devuelve True si se ha hecho.
+    """
+    if not _write_lock.acquire(blocking=False):
+        return False
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=0.1)
+        try:
+            conn.execute(sql, params)
+            conn.commit()
+        finally:
+            conn.close()
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        _write_lock.release()
+
+# --- Conexiones de lectura reutilizables ---
+# Las conexiones de solo lectura se devuelven a un pool al terminar en lugar
+# de cerrarse, de modo que cada consulta no paga la apertura del fichero y
+# cada conexión conserva su caché de sentencias preparadas.
+
+READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "8"))
+_read_pool = []
+_read_pool_lock = threading.Lock()
+_read_pool_stats = {"hits": 0, "misses": 0, "discarded": 0}
+
+def _open_read_connection():
+    # check_same_thread=False: la conexión puede devolverse al pool desde otro
+    # hilo del threadpool de FastAPI; el pool garantiza un único usuario a la vez.
+    return sqlite3.connect(
+        f"{Path(DB_PATH).resolve().as_uri()}?mode=ro",
+        uri=True,
+        timeout=30,
+        check_same_thread=False,
+        cached_statements=256,
+    )
+
+@contextmanager
+def read_connection():
+    """Toma una conexión de solo lectura del pool y la devuelve al salir."""
+    with _read_pool_lock:
+        conn = _read_pool.pop() if _read_pool else None
+        _read_pool_stats["hits" if conn is not None else "misses"] += 1
+    if conn is None:
+        conn = _open_read_connection()
+    try:
+        yield conn
+    finally:
+        with _read_pool_lock:
+            if len(_read_pool) < READ_POOL_SIZE:
+                _read_pool.append(conn)
+                conn = None
+            else:
+                _read_pool_stats["discarded"] += 1
+        if conn is not None:
+            conn.close()
+
+def get_read_db():
+    """Dependencia de FastAPI: `conn = Depends(get_read_db)`."""
+    with read_connection() as conn:
+        yield conn
+
+def read_pool_stats():
+    with _read_pool_lock:
+        return {**_read_pool_stats, "idle": len(_read_pool), "max_idle": READ_POOL_SIZE}
 
 def init_db():
     conn = get_connection()
     cur = conn.cursor()
+    # WAL es persistente en el fichero: los lectores no se bloquean durante una sincronización
+    cur.execute('PRAGMA journal_mode=WAL')
     # Crear tabla de colecciones
     cur.execute('''
         CREATE TABLE IF NOT EXISTS collections (
@@ -26,9 +132,50 @@ def init_db():
             title TEXT,
             library_type TEXT NOT NULL,
             library_id TEXT NOT NULL,
-            metadata TEXT
+            metadata TEXT,
+            has_attachment INTEGER NOT NULL DEFAULT 0,
+            creators TEXT NOT NULL DEFAULT '',
+            date TEXT NOT NULL DEFAULT '',
+            year INTEGER NOT NULL DEFAULT 0,
+            item_type TEXT NOT NULL DEFAULT '',
+            publication_title TEXT NOT NULL DEFAULT '',
+            publisher TEXT NOT NULL DEFAULT ''
+        )
+    ''')
+    # Etiquetas normalizadas: filtrar por etiqueta es una búsqueda en índice
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS item_tags (
+            item_id TEXT NOT NULL,
+            library_type TEXT NOT NULL,
+            library_id TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (item_id, library_type, library_id, tag)
+        )
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_item_tags_tag
+        ON item_tags (library_type, library_id, tag)
+    ''')
+    # Adjuntos hijos de los ítems, para no preguntar a Zotero por cada fila
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS attachments (
+            id TEXT PRIMARY KEY,
+            parent_id TEXT NOT NULL,
+            library_type TEXT NOT NULL,
+            library_id TEXT NOT NULL,
+            title TEXT,
+            filename TEXT,
+            content_type TEXT,
+            link_mode TEXT,
+            md5 TEXT,
+            mtime INTEGER,
+            version INTEGER
         )
     ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_attachments_parent
+        ON attachments (parent_id, library_type, library_id)
+    ''')
     # Tabla intermedia para relación muchos-a-muchos ítem-colección
     cur.execute('''
         CREATE TABLE IF NOT EXISTS item_collections (
@@ -41,102 +188,850 @@ def init_db():
             FOREIGN KEY (collection_id) REFERENCES collections(id)
         )
     ''')
+    # Índice para listar y paginar por título (keyset) sin ordenar en memoria
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_items_library_title
+        ON items (library_type, library_id, title COLLATE NOCASE, id)
+    ''')
+    # Índices para recorrer el árbol de colecciones y sus ítems
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_collections_parent
+        ON collections (parent_id, library_type, library_id)
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_item_collections_collection
+        ON item_collections (collection_id, library_type, library_id)
+    ''')
+    # Índice de los ficheros descargados en DOWNLOADS_DIR (ver backend/store.py):
+    # una fila por adjunto con la ruta de su copia actual, tamaño y último acceso
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS local_files (
+            attachment_key TEXT NOT NULL,
+            library_type TEXT NOT NULL,
+            library_id TEXT NOT NULL,
+            md5 TEXT NOT NULL DEFAULT '',
+            filename TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            last_access REAL NOT NULL,
+            pinned INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (attachment_key, library_type, library_id)
+        )
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_local_files_filename ON local_files (filename)
+    ''')
+    # Última versión de Zotero (Last-Modified-Version) sincronizada por biblioteca
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            library_type TEXT NOT NULL,
+            library_id TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            synced_at REAL,
+            PRIMARY KEY (library_type, library_id)
+        )
+    ''')
+    # Respaldo local de la caché de respuestas de los LLM (ver backend/llm_cache.py)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            provider TEXT NOT NULL,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access)
+    ''')
+    # Ficheros subidos a los proveedores de LLM (ver backend/llm_files.py): uno
+    # por proveedor, cuenta (hash de la clave de API) y contenido del documento
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS provider_files (
+            provider TEXT NOT NULL,
+            account TEXT NOT NULL,
+            document_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            uri TEXT,
+            mime_type TEXT,
+            expires_at REAL NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (provider, account, document_hash)
+        )
+    ''')
+    # Fragmentos de los .txt de markdown_api para la recuperación de pasajes
+    # (ver backend/retrieval.py). Los fragmentos de un documento ocupan rowids
+    # consecutivos de document_chunks; document_index guarda el rango y
+    # document_chunk_seq el siguiente rowid libre.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS document_index (
+            document_hash TEXT PRIMARY KEY,
+            first_rowid INTEGER NOT NULL,
+            last_rowid INTEGER NOT NULL,
+            chunks INTEGER NOT NULL,
+            indexed_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+    ''')
+    cur.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS document_chunks USING fts5(
+            text, page_start UNINDEXED, page_end UNINDEXED,
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    # Los rowids no se reutilizan: una petición que aún tenga el rango de un
+    # documento desalojado no puede leer los fragmentos de otro
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS document_chunk_seq (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            next_rowid INTEGER NOT NULL
+        )
+    ''')
+    cur.execute('''
+        INSERT OR IGNORE INTO document_chunk_seq (id, next_rowid)
+        SELECT 1, COALESCE(MAX(rowid), 0) + 1 FROM document_chunks
+    ''')
+    # Índice de búsqueda de texto completo. item_search guarda el contenido
+    # (incluido el texto extraído de los PDF) e items_fts es un índice FTS5
+    # de contenido externo mantenido por triggers.
+    search_index_exists = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='item_search'"
+    ).fetchone() is not None
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS item_search (
+            id INTEGER PRIMARY KEY,
+            item_id TEXT NOT NULL,
+            library_type TEXT NOT NULL,
+            library_id TEXT NOT NULL,
+            title TEXT,
+            creators TEXT,
+            abstract TEXT,
+            tags TEXT,
+            publication TEXT,
+            fulltext TEXT NOT NULL DEFAULT '',
+            UNIQUE (item_id, library_type, library_id)
+        )
+    ''')
+    cur.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+            title, creators, abstract, tags, publication, fulltext,
+            content='item_search', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    cur.executescript('''
+        CREATE TRIGGER IF NOT EXISTS item_search_ai AFTER INSERT ON item_search BEGIN
+            INSERT INTO items_fts (rowid, title, creators, abstract, tags, publication, fulltext)
+            VALUES (new.id, new.title, new.creators, new.abstract, new.tags, new.publication, new.fulltext);
+        END;
+        CREATE TRIGGER IF NOT EXISTS item_search_ad AFTER DELETE ON item_search BEGIN
+            INSERT INTO items_fts (items_fts, rowid, title, creators, abstract, tags, publication, fulltext)
+            VALUES ('delete', old.id, old.title, old.creators, old.abstract, old.tags, old.publication, old.fulltext);
+        END;
+        CREATE TRIGGER IF NOT EXISTS item_search_au AFTER UPDATE ON item_search BEGIN
+            INSERT INTO items_fts (items_fts, rowid, title, creators, abstract, tags, publication, fulltext)
+            VALUES ('delete', old.id, old.title, old.creators, old.abstract, old.tags, old.publication, old.fulltext);
+            INSERT INTO items_fts (rowid, title, creators, abstract, tags, publication, fulltext)
+            VALUES (new.id, new.title, new.creators, new.abstract, new.tags, new.publication, new.fulltext);
+        END;
+    ''')
+    if not search_index_exists:
+        # Base de datos anterior al índice: la sincronización incremental no
+        # volvería a enviar los ítems ya sincronizados, así que se fuerza una completa
+        cur.execute('DELETE FROM sync_state')
     conn.commit()
+    # Migraciones de bases de datos creadas con versiones anteriores
+    from backend.migrate_add_has_attachment import migrate as migrate_has_attachment
+    from backend.migrate_add_item_columns import migrate as migrate_item_columns
+    from backend.migrate_add_attachment_file_columns import migrate as migrate_attachment_file_columns
+    migrate_has_attachment(conn)
+    migrate_item_columns(conn)
+    migrate_attachment_file_columns(conn)
+    # Índices sobre las columnas desnormalizadas (existen ya tras las migraciones)
+    cur.executescript('''
+        CREATE INDEX IF NOT EXISTS idx_items_library_year ON items (library_type, library_id, year, id);
+        CREATE INDEX IF NOT EXISTS idx_items_library_creators ON items (library_type, library_id, creators COLLATE NOCASE, id);
+        CREATE INDEX IF NOT EXISTS idx_items_library_item_type ON items (library_type, library_id, item_type, id);
+    ''')
     conn.close()
 
-def insert_collection(id, name, parent_id, library_type, library_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
+# --- Escritura por lotes ---
+# Todas reciben una conexión abierta con transaction() para que una
+# sincronización completa use una sola conexión y una sola transacción.
+
+def upsert_collections(conn, rows):
+    """rows: (id, name, parent_id, library_type, library_id)"""
+    conn.executemany('''
         INSERT OR REPLACE INTO collections (id, name, parent_id, library_type, library_id)
         VALUES (?, ?, ?, ?, ?)
-    ''', (id, name, parent_id, library_type, library_id))
-    conn.commit()
-    conn.close()
+    ''', rows)
 
-def insert_item(id, title, library_type, library_id, metadata):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT OR REPLACE INTO items (id, title, library_type, library_id, metadata)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (id, title, library_type, library_id, metadata))
-    conn.commit()
-    conn.close()
+def upsert_items(conn, rows):
+    """
+    rows: (id, title, library_type, library_id, metadata,
+           creators, date, year, item_type, publication_title, publisher)
+    """
+    conn.executemany('''
+        INSERT OR REPLACE INTO items (id, title, library_type, library_id, metadata,
+                                      creators, date, year, item_type, publication_title, publisher)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
 
-def insert_item_collection(item_id, collection_id, library_type, library_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
+def replace_item_tags(conn, item_keys, rows, library_type, library_id):
+    """Sustituye las etiquetas de item_keys por rows: (item_id, library_type, library_id, tag)"""
+    conn.executemany('''
+        DELETE FROM item_tags WHERE item_id=? AND library_type=? AND library_id=?
+    ''', [(key, library_type, library_id) for key in item_keys])
+    conn.executemany('''
+        INSERT OR IGNORE INTO item_tags (item_id, library_type, library_id, tag) VALUES (?, ?, ?, ?)
+    ''', rows)
+
+def upsert_attachments(conn, rows):
+    """rows: (id, parent_id, library_type, library_id, title, filename, content_type, link_mode, md5, mtime, version)"""
+    conn.executemany('''
+        INSERT OR REPLACE INTO attachments (id, parent_id, library_type, library_id, title, filename,
+                                            content_type, link_mode, md5, mtime, version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+def upsert_search_rows(conn, rows):
+    """
+    rows: (item_id, library_type, library_id, title, creators, abstract, tags, publication)
+    El texto completo (fulltext) se conserva: solo lo actualiza set_fulltext_for_attachment().
+    """
+    conn.executemany('''
+        INSERT INTO item_search (item_id, library_type, library_id, title, creators, abstract, tags, publication)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (item_id, library_type, library_id) DO UPDATE SET
+            title=excluded.title, creators=excluded.creators, abstract=excluded.abstract,
+            tags=excluded.tags, publication=excluded.publication
+    ''', rows)
+
+def replace_item_collections(conn, item_keys, rows, library_type, library_id):
+    """Sustituye las colecciones de item_keys por rows: (item_id, collection_id, library_type, library_id)"""
+    conn.executemany('''
+        DELETE FROM item_collections WHERE item_id=? AND library_type=? AND library_id=?
+    ''', [(key, library_type, library_id) for key in item_keys])
+    conn.executemany('''
         INSERT OR IGNORE INTO item_collections (item_id, collection_id, library_type, library_id)
         VALUES (?, ?, ?, ?)
-    ''', (item_id, collection_id, library_type, library_id))
-    conn.commit()
-    conn.close()
+    ''', rows)
 
-def get_collections(library_type, library_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT id, name, parent_id FROM collections WHERE library_type=? AND library_id=?
+def delete_collections(conn, keys, library_type, library_id):
+    params = [(key, library_type, library_id) for key in keys]
+    conn.executemany('''
+        DELETE FROM collections WHERE id=? AND library_type=? AND library_id=?
+    ''', params)
+    conn.executemany('''
+        DELETE FROM item_collections WHERE collection_id=? AND library_type=? AND library_id=?
+    ''', params)
+
+def delete_items(conn, keys, library_type, library_id):
+    params = [(key, library_type, library_id) for key in keys]
+    conn.executemany('''
+        DELETE FROM items WHERE id=? AND library_type=? AND library_id=?
+    ''', params)
+    conn.executemany('''
+        DELETE FROM item_collections WHERE item_id=? AND library_type=? AND library_id=?
+    ''', params)
+    conn.executemany('''
+        DELETE FROM item_search WHERE item_id=? AND library_type=? AND library_id=?
+    ''', params)
+    conn.executemany('''
+        DELETE FROM item_tags WHERE item_id=? AND library_type=? AND library_id=?
+    ''', params)
+
+def get_library_keys(conn, library_type, library_id):
+    """Claves guardadas de la biblioteca: (colecciones, ítems, adjuntos), como conjuntos."""
+    params = (library_type, library_id)
+    return tuple(
+        {row[0] for row in conn.execute(f'SELECT id FROM {table} WHERE library_type=? AND library_id=?', params)}
+        for table in ("collections", "items", "attachments")
+    )
+
+def delete_attachments(conn, keys, library_type, library_id):
+    conn.executemany('''
+        DELETE FROM attachments WHERE id=? AND library_type=? AND library_id=?
+    ''', [(key, library_type, library_id) for key in keys])
+
+def refresh_has_attachment(conn, library_type, library_id):
+    """Recalcula items.has_attachment a partir de la tabla attachments."""
+    conn.execute('''
+        UPDATE items SET has_attachment = EXISTS (
+            SELECT 1 FROM attachments a
+            WHERE a.parent_id = items.id AND a.library_type = items.library_type AND a.library_id = items.library_id
+        )
+        WHERE library_type=? AND library_id=?
     ''', (library_type, library_id))
-    rows = cur.fetchall()
-    conn.close()
+
+def set_library_version(conn, library_type, library_id, version):
+    conn.execute('''
+        INSERT OR REPLACE INTO sync_state (library_type, library_id, version, synced_at)
+        VALUES (?, ?, ?, ?)
+    ''', (library_type, library_id, version, time.time()))
+
+# --- Escritura fila a fila (una transacción por llamada) ---
+
+def insert_collection(id, name, parent_id, library_type, library_id):
+    with transaction() as conn:
+        upsert_collections(conn, [(id, name, parent_id, library_type, library_id)])
+
+def insert_item(id, title, library_type, library_id, metadata):
+    """metadata: JSON (texto) con los datos del ítem de Zotero, como lo guarda la sincronización."""
+    fields = item_fields(json.loads(metadata) if isinstance(metadata, str) else metadata or {})
+    metadata = metadata if isinstance(metadata, str) else json.dumps(metadata or {})
+    with transaction() as conn:
+        upsert_items(conn, [(
+            id, title, library_type, library_id, metadata,
+            fields["creators"], fields["date"], fields["year"], fields["item_type"],
+            fields["publication_title"], fields["publisher"],
+        )])
+
+def insert_item_collection(item_id, collection_id, library_type, library_id):
+    with transaction() as conn:
+        conn.execute('''
+            INSERT OR IGNORE INTO item_collections (item_id, collection_id, library_type, library_id)
+            VALUES (?, ?, ?, ?)
+        ''', (item_id, collection_id, library_type, library_id))
+
+def delete_library(library_type, library_id):
+    """Borra todos los datos de una biblioteca (p. ej. un grupo al que ya no se pertenece)."""
+    with transaction() as conn:
+        for table in ('collections', 'items', 'item_collections', 'item_tags', 'attachments', 'item_search', 'sync_state'):
+            conn.execute(f'DELETE FROM {table} WHERE library_type=? AND library_id=?', (library_type, library_id))
+
+def set_fulltext_for_attachment(attachment_key, text, library_type=None, library_id=None):
+    """
+    Indexa el texto extraído de un PDF (el .txt de generate_md_for_pdf) en el
+    ítem padre de ese adjunto. Sin biblioteca, en el de cualquier biblioteca
+    con un adjunto de esa clave. Devuelve el número de ítems actualizados.
+    """
+    with transaction() as conn:
+        cur = conn.execute('''
+            UPDATE item_search SET fulltext=?
+            WHERE id IN (
+                SELECT s.id FROM item_search s
+                JOIN attachments a ON a.parent_id = s.item_id
+                    AND a.library_type = s.library_type AND a.library_id = s.library_id
+                WHERE a.id=? AND (? IS NULL OR (a.library_type=? AND a.library_id=?))
+            )
+        ''', (text, attachment_key, library_type, library_type, library_id))
+        return cur.rowcount
+
+def get_library_version(library_type, library_id):
+    with read_connection() as conn:
+        row = conn.execute('''
+            SELECT version FROM sync_state WHERE library_type=? AND library_id=?
+        ''', (library_type, library_id)).fetchone()
+    return row[0] if row else 0
+
+def get_sync_state():
+    """{(library_type, library_id): (version, synced_at)} de todas las bibliotecas sincronizadas."""
+    with read_connection() as conn:
+        rows = conn.execute('SELECT library_type, library_id, version, synced_at FROM sync_state').fetchall()
+    return {(row[0], str(row[1])): (row[2], row[3]) for row in rows}
+
+def get_synced_libraries():
+    with read_connection() as conn:
+        rows = conn.execute('''
+            SELECT DISTINCT library_type, library_id FROM collections
+            UNION SELECT DISTINCT library_type, library_id FROM items
+            UNION SELECT DISTINCT library_type, library_id FROM attachments
+            UNION SELECT library_type, library_id FROM sync_state
+        ''').fetchall()
+    return rows
+
+def get_collections(library_type, library_id):
+    with read_connection() as conn:
+        rows = conn.execute('''
+            SELECT id, name, parent_id FROM collections WHERE library_type=? AND library_id=?
+        ''', (library_type, library_id)).fetchall()
     return rows
 
 def get_subcollections(parent_id, library_type, library_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT id, name FROM collections WHERE parent_id=? AND library_type=? AND library_id=?
-    ''', (parent_id, library_type, library_id))
-    rows = cur.fetchall()
-    conn.close()
+    with read_connection() as conn:
+        rows = conn.execute('''
+            SELECT id, name FROM collections WHERE parent_id=? AND library_type=? AND library_id=?
+        ''', (parent_id, library_type, library_id)).fetchall()
     return rows
 
 def get_items(collection_id, library_type, library_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT i.id, i.title, i.metadata FROM items i
-        JOIN item_collections ic ON i.id = ic.item_id
-        WHERE ic.collection_id=? AND ic.library_type=? AND ic.library_id=?
-    ''', (collection_id, library_type, library_id))
-    rows = cur.fetchall()
-    conn.close()
+    with read_connection() as conn:
+        rows = conn.execute('''
+            SELECT i.id, i.title, i.metadata FROM items i
+            JOIN item_collections ic ON i.id = ic.item_id
+            WHERE ic.collection_id=? AND ic.library_type=? AND ic.library_id=?
+        ''', (collection_id, library_type, library_id)).fetchall()
     return rows
 
-def get_all_items(library_type, library_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT id, title, metadata FROM items 
-        WHERE library_type=? AND library_id=?
-    ''', (library_type, library_id))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+# Separador de las etiquetas agregadas en la columna `tags` de los listados
+TAG_SEPARATOR = "\x1f"
 
-def get_items_for_collection(collection_id, library_type, library_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT i.id, i.title, i.metadata FROM items i
+# Columnas de los listados de ítems (items con alias i). Se devuelven como
+# sqlite3.Row: id, title, metadata, has_attachment, item_type, creators, date,
+# publisher, publication_title, tags (unidas con TAG_SEPARATOR)
+_ITEM_LIST_COLUMNS = '''
+    i.id, i.title, {metadata} AS metadata, i.has_attachment, i.item_type, i.creators, i.date, i.year,
+    i.publisher, i.publication_title,
+    (SELECT group_concat(t.tag, char(31)) FROM item_tags t
+     WHERE t.item_id = i.id AND t.library_type = i.library_type AND t.library_id = i.library_id) AS tags
+'''
+
+def _item_list_columns(with_metadata):
+    return _ITEM_LIST_COLUMNS.format(metadata="i.metadata" if with_metadata else "NULL")
+
+def _item_filters(library_type, library_id, item_type=None, tag=None):
+    """Condiciones opcionales de filtrado por tipo y etiqueta (ambas indexadas)."""
+    sql, params = "", []
+    if item_type:
+        sql += " AND i.item_type=?"
+        params.append(item_type)
+    if tag:
+        sql += ''' AND i.id IN (
+            SELECT item_id FROM item_tags WHERE library_type=? AND library_id=? AND tag=?
+        )'''
+        params.extend([library_type, library_id, tag])
+    return sql, params
+
+def _fetch_item_rows(sql, params):
+    with read_connection() as conn:
+        cur = conn.cursor()
+        cur.row_factory = sqlite3.Row
+        return cur.execute(sql, params).fetchall()
+
+def get_all_items(library_type, library_id, with_metadata=True, item_type=None, tag=None):
+    filters, filter_params = _item_filters(library_type, library_id, item_type, tag)
+    return _fetch_item_rows(f'''
+        SELECT {_item_list_columns(with_metadata)} FROM items i
+        WHERE i.library_type=? AND i.library_id=?{filters}
+    ''', [library_type, library_id, *filter_params])
+
+# Claves de ordenación admitidas por iter_items -> expresión SQL indexada
+ITEM_SORT_KEYS = {
+    "title": "i.title COLLATE NOCASE",
+    "key": "i.id",
+    "year": "i.year",
+    "creators": "i.creators COLLATE NOCASE",
+    "itemType": "i.item_type",
+}
+
+def iter_items(library_type, library_id, sort="title", descending=False, after=None, limit=None,
+               with_metadata=True, item_type=None, tag=None):
+    """
+    Recorre los ítems de una biblioteca ordenados por `sort` con paginación
+    por keyset: `after` es el par (valor_de_orden, id) de la última fila ya
+    servida. Genera filas sqlite3.Row con las columnas de los listados más
+    `sort_value`; metadata es None si with_metadata=False.
+    """
+    sort_expr = ITEM_SORT_KEYS[sort]
+    op, direction = ("<", "DESC") if descending else (">", "ASC")
+    filters, params = _item_filters(library_type, library_id, item_type, tag)
+    params = [library_type, library_id, *params]
+    where = "i.library_type=? AND i.library_id=?" + filters
+    if after is not None:
+        where += f" AND ({sort_expr}, i.id) {op} (?, ?)"
+        params.extend(after)
+    sql = f'''
+        SELECT {_item_list_columns(with_metadata)}, {sort_expr.split()[0]} AS sort_value
+        FROM items i WHERE {where}
+        ORDER BY {sort_expr} {direction}, i.id {direction}
+    '''
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    with read_connection() as conn:
+        cur = conn.cursor()
+        cur.row_factory = sqlite3.Row
+        cur.execute(sql, params)
+        try:
+            while True:
+                rows = cur.fetchmany(500)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cur.close()
+
+def get_items_for_collection(collection_id, library_type, library_id, with_metadata=True, item_type=None, tag=None):
+    filters, filter_params = _item_filters(library_type, library_id, item_type, tag)
+    return _fetch_item_rows(f'''
+        SELECT {_item_list_columns(with_metadata)} FROM items i
         JOIN item_collections ic ON i.id = ic.item_id
-        WHERE ic.collection_id=? AND ic.library_type=? AND ic.library_id=?
-    ''', (collection_id, library_type, library_id))
-    rows = cur.fetchall()
-    conn.close()
+        WHERE ic.collection_id=? AND ic.library_type=? AND ic.library_id=?{filters}
+    ''', [collection_id, library_type, library_id, *filter_params])
+
+def get_items_recursive(collection_id, library_type, library_id, with_metadata=True, item_type=None, tag=None):
+    """Ítems de una colección y de todas sus subcolecciones, sin duplicados, en una sola consulta."""
+    filters, filter_params = _item_filters(library_type, library_id, item_type, tag)
+    return _fetch_item_rows(f'''
+        WITH RECURSIVE subtree(id) AS (
+            SELECT ?
+            UNION
+            SELECT c.id FROM collections c
+            JOIN subtree s ON c.parent_id = s.id
+            WHERE c.library_type=? AND c.library_id=?
+        )
+        SELECT {_item_list_columns(with_metadata)} FROM items i
+        WHERE i.library_type=? AND i.library_id=?
+          AND i.id IN (
+            SELECT ic.item_id FROM item_collections ic
+            WHERE ic.collection_id IN (SELECT id FROM subtree) AND ic.library_type=? AND ic.library_id=?
+          ){filters}
+    ''', [collection_id, library_type, library_id, library_type, library_id,
+          library_type, library_id, *filter_params])
+
+def get_listing_items(library_type, library_id, collection_id=None):
+    """
+    Ítems de los listados /api/libraries/... (toda la biblioteca o una
+    colección), sin adjuntos ni anotaciones sueltos, como hacía la consulta a
+    Zotero. Añade abstract_note y url sacados del JSON sin parsearlo en Python.
+    """
+    sql = f'''
+        SELECT {_item_list_columns(False)},
+               json_extract(i.metadata, '$.abstractNote') AS abstract_note,
+               json_extract(i.metadata, '$.url') AS url
+        FROM items i
+    '''
+    params = []
+    if collection_id:
+        sql += '''
+            JOIN item_collections ic ON ic.item_id = i.id AND ic.collection_id=?
+             AND ic.library_type = i.library_type AND ic.library_id = i.library_id
+        '''
+        params.append(collection_id)
+    sql += '''
+        WHERE i.library_type=? AND i.library_id=? AND i.item_type NOT IN ('attachment', 'annotation')
+        ORDER BY i.title COLLATE NOCASE, i.id
+    '''
+    return _fetch_item_rows(sql, [*params, library_type, library_id])
+
+def get_attachments(parent_id, library_type, library_id):
+    with read_connection() as conn:
+        rows = conn.execute('''
+            SELECT id, title, filename, content_type FROM attachments
+            WHERE parent_id=? AND library_type=? AND library_id=?
+            ORDER BY title
+        ''', (parent_id, library_type, library_id)).fetchall()
     return rows
 
-def search_items(query, library_type, library_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT id, title, metadata FROM items WHERE library_type=? AND library_id=? AND title LIKE ?
-    ''', (library_type, library_id, f"%{query}%"))
-    rows = cur.fetchall()
-    conn.close()
+def get_file_attachments(library_type, library_id, collection_id=None, recursive=True, content_type="application/pdf"):
+    """
+    Adjuntos con fichero almacenado (imported_file/imported_url) de los ítems
+    de una biblioteca, o de una colección y, con recursive, sus subcolecciones.
+    Filas (id, filename, content_type, md5, mtime).
+    """
+    params = [library_type, library_id, content_type]
+    scope = ''
+    if collection_id:
+        subcollections = '''
+            UNION
+            SELECT c.id FROM collections c
+            JOIN subtree s ON c.parent_id = s.id
+            WHERE c.library_type=? AND c.library_id=?
+        ''' if recursive else ''
+        scope = f'''
+          AND a.parent_id IN (
+            WITH RECURSIVE subtree(id) AS (SELECT ? {subcollections})
+            SELECT ic.item_id FROM item_collections ic
+            WHERE ic.collection_id IN (SELECT id FROM subtree) AND ic.library_type=? AND ic.library_id=?
+          )'''
+        params += [collection_id] + ([library_type, library_id] if recursive else []) + [library_type, library_id]
+    with read_connection() as conn:
+        return conn.execute(f'''
+            SELECT a.id, a.filename, a.content_type, a.md5, a.mtime FROM attachments a
+            WHERE a.library_type=? AND a.library_id=? AND a.content_type=?
+              AND a.link_mode IN ('imported_file', 'imported_url') AND a.filename != ''{scope}
+            ORDER BY a.id
+        ''', params).fetchall()
+
+def get_attachment_info(attachment_key, library_type, library_id):
+    """
+    Metadatos del fichero de un adjunto (filename, content_type, md5, mtime,
+    version) sin llamar a Zotero, o None si no está sincronizado.
+    Los adjuntos sin padre están en items, con los datos en el JSON de metadata.
+    """
+    with read_connection() as conn:
+        row = conn.execute('''
+            SELECT filename, content_type, md5, mtime, version FROM attachments
+            WHERE id=? AND library_type=? AND library_id=?
+        ''', (attachment_key, library_type, library_id)).fetchone()
+        if row is None:
+            item = conn.execute('''
+                SELECT metadata FROM items
+                WHERE id=? AND library_type=? AND library_id=? AND item_type='attachment'
+            ''', (attachment_key, library_type, library_id)).fetchone()
+    if row is not None:
+        filename, content_type, md5, mtime, version = row
+        return {"filename": filename, "content_type": content_type, "md5": md5, "mtime": mtime, "version": version}
+    if item is None or not item[0]:
+        return None
+    data = json.loads(item[0])
+    return {
+        "filename": data.get("filename"),
+        "content_type": data.get("contentType"),
+        "md5": data.get("md5"),
+        "mtime": data.get("mtime"),
+        "version": data.get("version"),
+    }
+
+# --- Índice de ficheros locales (backend/store.py) ---
+
+def get_local_file(attachment_key, library_type, library_id):
+    """(md5, filename, path, size, last_access, pinned) o None."""
+    with read_connection() as conn:
+        return conn.execute('''
+            SELECT md5, filename, path, size, last_access, pinned FROM local_files
+            WHERE attachment_key=? AND library_type=? AND library_id=?
+        ''', (attachment_key, library_type, library_id)).fetchone()
+
+def get_local_file_by_path(path):
+    """(attachment_key, library_type, library_id) de la copia con esa ruta relativa, o None."""
+    with read_connection() as conn:
+        return conn.execute(
+            'SELECT attachment_key, library_type, library_id FROM local_files WHERE path=?', (path,)
+        ).fetchone()
+
+def find_local_file(name):
+    """
+    Ruta (relativa a DOWNLOADS_DIR) de la copia más reciente de un adjunto
+    cuyo nombre de fichero o título sea `name`, o None.
+    """
+    with read_connection() as conn:
+        row = conn.execute('''
+            SELECT f.path FROM local_files f
+            LEFT JOIN attachments a
+              ON a.id = f.attachment_key AND a.library_type = f.library_type AND a.library_id = f.library_id
+            WHERE f.filename = ? OR a.title = ?
+            ORDER BY f.last_access DESC LIMIT 1
+        ''', (name, name)).fetchone()
+    return row[0] if row else None
+
+def list_local_files():
+    """Todas las entradas, de la menos a la más usada: (attachment_key, library_type, library_id, filename, path, size, last_access, pinned, title)."""
+    with read_connection() as conn:
+        return conn.execute('''
+            SELECT f.attachment_key, f.library_type, f.library_id, f.filename, f.path, f.size,
+                   f.last_access, f.pinned, COALESCE(a.title, '')
+            FROM local_files f
+            LEFT JOIN attachments a
+              ON a.id = f.attachment_key AND a.library_type = f.library_type AND a.library_id = f.library_id
+            ORDER BY f.last_access
+        ''').fetchall()
+
+def upsert_local_file(attachment_key, library_type, library_id, md5, filename, path, size):
+    with transaction() as conn:
+        conn.execute('''
+            INSERT INTO local_files (attachment_key, library_type, library_id, md5, filename, path, size, last_access)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (attachment_key, library_type, library_id) DO UPDATE SET
+                md5=excluded.md5, filename=excluded.filename, path=excluded.path,
+                size=excluded.size, last_access=excluded.last_access
+        ''', (attachment_key, library_type, library_id, md5 or '', filename, path, size, time.time()))
+
+def touch_local_file(attachment_key, library_type, library_id):
+    """Último acceso de una copia local (para el desalojo); se omite si hay una escritura en curso."""
+    return try_write('''
+        UPDATE local_files SET last_access=? WHERE attachment_key=? AND library_type=? AND library_id=?
+    ''', (time.time(), attachment_key, library_type, library_id))
+
+def set_local_file_pinned(attachment_key, library_type, library_id, pinned):
+    """Devuelve False si el adjunto no tiene copia local."""
+    with transaction() as conn:
+        cur = conn.execute('''
+            UPDATE local_files SET pinned=? WHERE attachment_key=? AND library_type=? AND library_id=?
+        ''', (1 if pinned else 0, attachment_key, library_type, library_id))
+    return cur.rowcount > 0
+
+def delete_local_file(attachment_key, library_type, library_id):
+    with transaction() as conn:
+        conn.execute('''
+            DELETE FROM local_files WHERE attachment_key=? AND library_type=? AND library_id=?
+        ''', (attachment_key, library_type, library_id))
+
+# --- Caché de respuestas de los LLM (backend/llm_cache.py) ---
+
+def get_llm_response(key):
+    """Respuesta guardada y vigente para `key`, o None."""
+    with read_connection() as conn:
+        row = conn.execute(
+            'SELECT response FROM llm_cache WHERE key=? AND expires_at > ?', (key, time.time())
+        ).fetchone()
+    return row[0] if row else None
+
+def touch_llm_response(key):
+    """Último acceso de una respuesta (para el desalojo); se omite si hay una escritura en curso."""
+    return try_write('UPDATE llm_cache SET last_access=? WHERE key=?', (time.time(), key))
+
+def put_llm_response(key, provider, model, response, ttl, max_bytes):
+    """
+    Guarda la respuesta y, si la tabla pasa de `max_bytes`, borra las caducadas
+    y después las menos usadas. Devuelve el número de entradas borradas.
+    """
+    now = time.time()
+    size = len(response.encode('utf-8'))
+    with transaction() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO llm_cache (key, provider, model, response, size, expires_at, last_access)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (key, provider, model, response, size, now + ttl, now))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+        if total <= max_bytes:
+            return 0
+        evicted = conn.execute('DELETE FROM llm_cache WHERE expires_at <= ?', (now,)).rowcount
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+        for old_key, old_size in conn.execute(
+            'SELECT key, size FROM llm_cache WHERE key != ? ORDER BY last_access', (key,)
+        ).fetchall():
+            if total <= max_bytes:
+                break
+            conn.execute('DELETE FROM llm_cache WHERE key=?', (old_key,))
+            total -= old_size
+            evicted += 1
+    return evicted
+
+def llm_cache_usage():
+    """(entradas, bytes) de la caché local de respuestas."""
+    with read_connection() as conn:
+        return conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache').fetchone()
+
+def clear_llm_cache():
+    with transaction() as conn:
+        return conn.execute('DELETE FROM llm_cache').rowcount
+
+# --- Ficheros subidos a los proveedores de LLM (backend/llm_files.py) ---
+
+def get_provider_file(provider, account, document_hash):
+    """(file_id, uri, mime_type) del fichero subido y aún vigente, o None."""
+    with read_connection() as conn:
+        return conn.execute('''
+            SELECT file_id, uri, mime_type FROM provider_files
+            WHERE provider=? AND account=? AND document_hash=? AND expires_at > ?
+        ''', (provider, account, document_hash, time.time())).fetchone()
+
+def put_provider_file(provider, account, document_hash, file_id, uri, mime_type, expires_at):
+    """Registra un fichero subido y borra los registros ya caducados."""
+    now = time.time()
+    with transaction() as conn:
+        conn.execute('DELETE FROM provider_files WHERE expires_at <= ?', (now,))
+        conn.execute('''
+            INSERT OR REPLACE INTO provider_files
+                (provider, account, document_hash, file_id, uri, mime_type, expires_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (provider, account, document_hash, file_id, uri, mime_type, expires_at, now))
+
+def delete_provider_file(provider, account, document_hash):
+    with transaction() as conn:
+        conn.execute('''
+            DELETE FROM provider_files WHERE provider=? AND account=? AND document_hash=?
+        ''', (provider, account, document_hash))
+
+def count_provider_files():
+    with read_connection() as conn:
+        return conn.execute('SELECT COUNT(*) FROM provider_files WHERE expires_at > ?', (time.time(),)).fetchone()[0]
+
+# --- Fragmentos de documentos (backend/retrieval.py) ---
+
+def get_document_index(document_hash):
+    """(first_rowid, last_rowid, chunks) del documento indexado, o None."""
+    with read_connection() as conn:
+        return conn.execute(
+            'SELECT first_rowid, last_rowid, chunks FROM document_index WHERE document_hash=?', (document_hash,)
+        ).fetchone()
+
+def touch_document_index(document_hash):
+    """Último acceso de un documento indexado; se omite si hay una escritura en curso."""
+    return try_write('UPDATE document_index SET last_access=? WHERE document_hash=?', (time.time(), document_hash))
+
+def _delete_document_chunks(conn, document_hash):
+    row = conn.execute(
+        'SELECT first_rowid, last_rowid FROM document_index WHERE document_hash=?', (document_hash,)
+    ).fetchone()
+    if row:
+        conn.execute('DELETE FROM document_chunks WHERE rowid BETWEEN ? AND ?', row)
+        conn.execute('DELETE FROM document_index WHERE document_hash=?', (document_hash,))
+
+def replace_document_chunks(document_hash, chunks, max_documents):
+    """
+    Indexa los fragmentos de un documento: chunks = [(page_start, page_end, text)].
+    Si hay más de `max_documents` documentos indexados se borran los menos usados.
+    Devuelve (first_rowid, last_rowid, chunks).
+    """
+    now = time.time()
+    with transaction() as conn:
+        _delete_document_chunks(conn, document_hash)
+        # Rowids consecutivos y nunca reutilizados: las transacciones de escritura están serializadas
+        first = conn.execute('SELECT next_rowid FROM document_chunk_seq WHERE id = 1').fetchone()[0]
+        conn.execute('UPDATE document_chunk_seq SET next_rowid=? WHERE id = 1', (first + len(chunks),))
+        conn.executemany(
+            'INSERT INTO document_chunks (rowid, text, page_start, page_end) VALUES (?, ?, ?, ?)',
+            [(first + i, text, page_start, page_end) for i, (page_start, page_end, text) in enumerate(chunks)])
+        last = first + len(chunks) - 1
+        conn.execute('''
+            INSERT INTO document_index (document_hash, first_rowid, last_rowid, chunks, indexed_at, last_access)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (document_hash, first, last, len(chunks), now, now))
+        for (old_hash,) in conn.execute(
+            'SELECT document_hash FROM document_index ORDER BY last_access DESC LIMIT -1 OFFSET ?', (max_documents,)
+        ).fetchall():
+            _delete_document_chunks(conn, old_hash)
+    return first, last, len(chunks)
+
+def _fts_any_query(query):
+    """Consulta FTS5 que acepta cualquiera de los términos (OR); BM25 ordena por relevancia."""
+    terms = dict.fromkeys(term.lower() for term in re.findall(r"\w+", query, re.UNICODE) if len(term) > 1)
+    return " OR ".join(f'"{term}"*' if len(term) > 3 else f'"{term}"' for term in list(terms)[:64])
+
+def search_document_chunks(first_rowid, last_rowid, query, limit):
+    """Los `limit` fragmentos del documento más relevantes para `query` por BM25: (rowid, page_start, page_end, text)."""
+    match = _fts_any_query(query)
+    if not match:
+        return []
+    with read_connection() as conn:
+        return conn.execute('''
+            SELECT rowid, page_start, page_end, text FROM document_chunks
+            WHERE document_chunks MATCH ? AND rowid BETWEEN ? AND ?
+            ORDER BY bm25(document_chunks)
+            LIMIT ?
+        ''', (match, first_rowid, last_rowid, limit)).fetchall()
+
+def get_document_chunks(rowids):
+    """Fragmentos por rowid: (rowid, page_start, page_end, text)."""
+    with read_connection() as conn:
+        return conn.execute(
+            f'SELECT rowid, page_start, page_end, text FROM document_chunks WHERE rowid IN ({",".join("?" * len(rowids))})',
+            list(rowids)).fetchall()
+
+def count_indexed_documents():
+    with read_connection() as conn:
+        return conn.execute('SELECT COUNT(*), COALESCE(SUM(chunks), 0) FROM document_index').fetchone()
+
+def _fts_query(query):
+    """Convierte el texto del usuario en una consulta FTS5 segura (AND de prefijos)."""
+    terms = re.findall(r"\w+", query, re.UNICODE)
+    return " ".join(f'"{term}"*' for term in terms)
+
+def search_items(query, library_type, library_id, limit=50, offset=0):
+    """
+    Búsqueda de texto completo ordenada por BM25. Devuelve filas
+    (id, title, metadata, has_attachment, score, snippet).
+    """
+    match = _fts_query(query)
+    if not match:
+        return []
+    with read_connection() as conn:
+        rows = conn.execute('''
+            SELECT i.id, i.title, i.metadata, i.has_attachment,
+                   bm25(items_fts, 10.0, 5.0, 3.0, 4.0, 2.0, 1.0) AS score,
+                   snippet(items_fts, -1, '<mark>', '</mark>', '…', 12)
+            FROM items_fts
+            JOIN item_search s ON s.id = items_fts.rowid
+            JOIN items i ON i.id = s.item_id AND i.library_type = s.library_type AND i.library_id = s.library_id
+            WHERE items_fts MATCH ? AND s.library_type=? AND s.library_id=?
+            ORDER BY score
+            LIMIT ? OFFSET ?
+        ''', (match, library_type, library_id, limit, offset)).fetchall()
     return rows
 
 # Inicializar la base de datos al importar
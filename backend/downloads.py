@@ -0,0 +1,185 @@
+"""
+Descarga de adjuntos (WebDAV o Zotero Storage) directamente a disco.
+
+Nada se carga entero en memoria: la respuesta HTTP se vuelca por bloques a un
+fichero temporal en DOWNLOADS_DIR, el PDF se extrae del zip también por
+bloques y el fichero final se publica con un rename atómico, así que un
+lector nunca ve un fichero a medias. La memoria usada por descarga es
+constante (CHUNK_SIZE) sea cual sea el tamaño del PDF.
+
+Las peticiones simultáneas del mismo adjunto comparten una sola descarga
+(`ensure_downloaded`): la primera la lanza y el resto esperan su resultado.
+Dónde se guarda cada copia lo decide backend/store.py.
+"""
+import asyncio
+import os
+import shutil
+import uuid
+import zipfile
+from pathlib import Path
+
+import httpx
+from fastapi import HTTPException
+
+from backend import store
+from backend.http_clients import get_http_client
+
+CHUNK_SIZE = 1024 * 1024
+ZOTERO_API_URL = "https://api.zotero.org"
+
+# Descargas en curso por adjunto: (lib_type, lib_id, key) -> asyncio.Task
+_inflight = {}
+_stats = {"downloads": 0, "coalesced": 0}
+
+
+def temp_path_for(dest: Path, suffix: str = ".part") -> Path:
+    """Ruta temporal única junto a `dest` (mismo sistema de ficheros, para os.replace)."""
+    return dest.parent / f".{dest.name}.{uuid.uuid4().hex}{suffix}"
+
+
+def _remove(path: Path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+async def stream_to_file(client: httpx.AsyncClient, url: str, dest: Path, **kwargs):
+    """Descarga `url` por bloques a `dest`. Lanza httpx.HTTPStatusError si falla."""
+    async with client.stream("GET", url, **kwargs) as response:
+        response.raise_for_status()
+        with open(dest, "wb") as f:
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                f.write(chunk)
+
+
+def extract_member(zip_path: Path, member: str, dest: Path) -> bool:
+    """
+    Copia `member` del zip a `dest` con un buffer acotado y lo publica con un
+    rename atómico. Devuelve False si el zip no contiene ese fichero.
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        if member not in zf.namelist():
+            return False
+        tmp = temp_path_for(dest)
+        try:
+            with zf.open(member) as src, open(tmp, "wb") as out:
+                shutil.copyfileobj(src, out, CHUNK_SIZE)
+            os.replace(tmp, dest)
+        finally:
+            _remove(tmp)
+    return True
+
+
+async def download_from_webdav(attachment_key: str, filename: str, dest: Path) -> bool:
+    """
+    Descarga `{WEBDAV_URL}/zotero/{key}.zip` y extrae `filename` en `dest`.
+    Devuelve False si WebDAV no está configurado o no tiene el fichero, para
+    que se intente con Zotero Storage.
+    """
+    webdav_url = os.getenv("WEBDAV_URL")
+    webdav_user = os.getenv("WEBDAV_USER")
+    webdav_pass = os.getenv("WEBDAV_PASS")
+    if not (webdav_url and webdav_user and webdav_pass):
+        return False
+
+    print(f"Attempting download from WebDAV for {attachment_key}")
+    file_url = f"{webdav_url}/zotero/{attachment_key}.zip"
+    zip_path = temp_path_for(dest, ".zip.part")
+    try:
+        await stream_to_file(get_http_client("webdav"), file_url, zip_path, auth=(webdav_user, webdav_pass))
+        # La descompresión es CPU y disco: fuera del event loop
+        if await asyncio.to_thread(extract_member, zip_path, filename, dest):
+            print(f"File downloaded from WebDAV and saved locally: {dest}")
+            return True
+        print(f"File '{filename}' not found inside ZIP for attachment {attachment_key}")
+    except httpx.HTTPStatusError as e:
+        print(f"HTTP error accessing WebDAV for attachment {attachment_key}: {e.response.status_code}")
+    except httpx.RequestError as e:
+        print(f"Error accessing WebDAV for attachment {attachment_key}: {e}")
+    except zipfile.BadZipFile:
+        print(f"Error: Bad ZIP file for attachment {attachment_key} from {file_url}")
+    except OSError as e:
+        print(f"Error saving file locally {dest} after WebDAV download: {e}")
+    except Exception as e:
+        # Zip cifrado, método de compresión no soportado, CRC incorrecto...
+        print(f"Error processing ZIP for attachment {attachment_key}: {e}")
+    finally:
+        _remove(zip_path)
+    print("Falling back to Zotero Storage download.")
+    return False
+
+
+async def download_from_zotero_storage(lib_type: str, lib_id: str, attachment_key: str, dest: Path):
+    """
+    Descarga el fichero desde Zotero Storage (`/items/{key}/file`, que redirige
+    al almacenamiento) por bloques. Equivale a zot.file() sin cargarlo en memoria.
+    """
+    prefix = "users" if lib_type == "user" else "groups"
+    url = f"{ZOTERO_API_URL}/{prefix}/{lib_id}/items/{attachment_key}/file"
+    headers = {"Zotero-API-Key": os.getenv("ZOTERO_API_KEY", ""), "Zotero-API-Version": "3"}
+    tmp = temp_path_for(dest)
+    print(f"Attempting download from Zotero Storage for: {dest.name}")
+    try:
+        await stream_to_file(get_http_client("zotero"), url, tmp, headers=headers)
+        os.replace(tmp, dest)
+        print(f"File downloaded from Zotero Storage and saved locally: {dest}")
+    except httpx.HTTPStatusError as e:
+        print(f"Error fetching attachment {attachment_key} from Zotero Storage: {e}")
+        if e.response.status_code == 404:
+            raise HTTPException(404, f"Adjunto {attachment_key} no encontrado en Zotero Storage")
+        raise HTTPException(500, f"Error al obtener el adjunto desde Zotero Storage: {e}")
+    except (httpx.RequestError, OSError) as e:
+        print(f"Error fetching attachment {attachment_key} from Zotero Storage: {e}")
+        raise HTTPException(500, f"Error al obtener el adjunto desde Zotero Storage: {e}")
+    finally:
+        _remove(tmp)
+
+
+async def download_attachment(lib_type: str, lib_id: str, attachment_key: str, filename: str, dest: Path) -> Path:
+    """Descarga el adjunto a `dest`: primero WebDAV (si está configurado) y si no Zotero Storage."""
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if not await download_from_webdav(attachment_key, filename, dest):
+        await download_from_zotero_storage(lib_type, lib_id, attachment_key, dest)
+    return dest
+
+
+async def ensure_downloaded(lib_type: str, lib_id: str, attachment_key: str, filename: str,
+                            md5: str | None = None, mtime: int | None = None) -> Path:
+    """
+    Ruta local del adjunto en el almacén (backend/store.py), descargándolo si
+    no hay copia de esa versión. Si ya hay una descarga en curso del mismo
+    adjunto se espera a esa en lugar de lanzar otra.
+    """
+    path = await asyncio.to_thread(store.lookup, lib_type, lib_id, attachment_key, filename, md5, mtime)
+    if path:
+        print(f"Serving existing local file: {path}")
+        return path
+    print(f"Local file missing or outdated. Attempting download for: {filename}")
+    key = (lib_type, str(lib_id), attachment_key)
+    task = _inflight.get(key)
+    if task is None:
+        _stats["downloads"] += 1
+        dest = store.entry_path(attachment_key, md5, filename)
+        task = asyncio.ensure_future(_download_and_record(lib_type, lib_id, attachment_key, filename, dest, md5, mtime))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        _stats["coalesced"] += 1
+        print(f"Download of {attachment_key} already in progress, waiting for it...")
+    # shield: si un cliente se desconecta no se cancela la descarga de los demás
+    return await asyncio.shield(task)
+
+
+async def _download_and_record(lib_type, lib_id, attachment_key, filename, dest, md5, mtime):
+    await download_attachment(lib_type, lib_id, attachment_key, filename, dest)
+    if md5 and await asyncio.to_thread(store.file_md5, dest) != md5:
+        print(f"Warning: downloaded {dest} does not match the md5 stored in Zotero.")
+    else:
+        store.mark_current(dest, mtime)
+    await asyncio.to_thread(store.record, lib_type, lib_id, attachment_key, md5, filename, dest)
+    return dest
+
+
+def download_stats() -> dict:
+    return {**_stats, "in_progress": len(_inflight)}
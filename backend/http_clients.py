@@ -0,0 +1,155 @@
+"""
+Clientes HTTP compartidos durante toda la vida de la aplicación.
+
+Crear un cliente por petición obliga a repetir la conexión TCP y el
+handshake TLS en cada mensaje. Aquí se crean una vez y se reutilizan:
+
+- get_http_client(name): httpx.AsyncClient por servicio (WebDAV, Zotero,
+  OpenRouter), con pool de conexiones, keep-alive, HTTP/2 si está instalado
+  `h2` (httpx[http2]), límite de conexiones por servicio y timeouts.
+- get_openai_client(api_key) / get_genai_client(api_key): clientes de los
+  SDK, uno por clave de API (el usuario puede mandar la suya).
+- get_redis_client(): cliente de Redis (REDIS_URL) de la caché de
+  respuestas de los LLM, o None si no está configurado.
+
+close_all() los cierra; main.py la llama al apagar la aplicación.
+"""
+import asyncio
+import os
+from collections import OrderedDict
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+# Clientes de SDK que se conservan (claves de API distintas)
+MAX_SDK_CLIENTS = 16
+# Un cliente desalojado se cierra pasado este tiempo, para que terminen las
+# peticiones que lo estén usando (las respuestas de un LLM tardan minutos)
+EVICTED_CLIENT_GRACE = 600
+
+SERVICES = {
+    # Descargas grandes: lectura larga, pocas conexiones simultáneas por servidor
+    "webdav": {"timeout": httpx.Timeout(30.0, read=120.0), "max_connections": 8},
+    "zotero": {"timeout": httpx.Timeout(30.0, read=120.0), "max_connections": 8, "follow_redirects": True},
+    # Las respuestas de los LLM pueden tardar minutos
+    "openrouter": {"timeout": httpx.Timeout(30.0, read=300.0), "max_connections": 20,
+                   "base_url": "https://openrouter.ai/api/v1"},
+    "llm": {"timeout": httpx.Timeout(30.0, read=300.0), "max_connections": 20},
+}
+
+_http_clients = {}
+_sdk_clients = OrderedDict()
+_closing = []
+_closing_tasks = set()
+_redis = {}
+
+
+def _new_http_client(service: str) -> httpx.AsyncClient:
+    config = dict(SERVICES[service])
+    max_connections = config.pop("max_connections")
+    return httpx.AsyncClient(
+        http2=HTTP2,
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                            keepalive_expiry=60.0),
+        **config,
+    )
+
+
+def get_http_client(service: str) -> httpx.AsyncClient:
+    """Cliente compartido del servicio (ver SERVICES)."""
+    client = _http_clients.get(service)
+    if client is None or client.is_closed:
+        client = _http_clients[service] = _new_http_client(service)
+    return client
+
+
+def _cached_sdk_client(key, factory):
+    client = _sdk_clients.get(key)
+    if client is None:
+        client = _sdk_clients[key] = factory()
+        if len(_sdk_clients) > MAX_SDK_CLIENTS:
+            _, oldest = _sdk_clients.popitem(last=False)
+            _retire(oldest)
+    else:
+        _sdk_clients.move_to_end(key)
+    return client
+
+
+def _retire(client):
+    """Programa el cierre de un cliente desalojado; sin event loop lo cerrará close_all()."""
+    _closing.append(client)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    task = loop.create_task(_close_later(client))
+    _closing_tasks.add(task)
+    task.add_done_callback(_closing_tasks.discard)
+
+
+async def _close_later(client):
+    await asyncio.sleep(EVICTED_CLIENT_GRACE)
+    if client in _closing:
+        _closing.remove(client)
+        await _close(client)
+
+
+def get_openai_client(api_key: str):
+    """AsyncOpenAI compartido para esa clave, sobre un pool httpx propio."""
+    from openai import AsyncOpenAI
+    return _cached_sdk_client(
+        ("openai", api_key),
+        # Los reintentos los hace backend/llm_gateway.py, igual para todos los proveedores
+        lambda: AsyncOpenAI(api_key=api_key, http_client=_new_http_client("llm"), max_retries=0),
+    )
+
+
+def get_genai_client(api_key: str):
+    """genai.Client compartido para esa clave (se usa su interfaz asíncrona, client.aio)."""
+    from google import genai
+    return _cached_sdk_client(("google", api_key), lambda: genai.Client(api_key=api_key))
+
+
+def get_redis_client():
+    """Cliente de Redis compartido (con su propio pool de conexiones), o None sin REDIS_URL."""
+    url = os.getenv("REDIS_URL")
+    if not url:
+        return None
+    client = _redis.get(url)
+    if client is None:
+        import redis.asyncio as aioredis
+        # Timeouts cortos: si Redis no está, la caché pasa a SQLite sin retrasar la respuesta
+        client = _redis[url] = aioredis.from_url(url, socket_connect_timeout=1, socket_timeout=2)
+    return client
+
+
+async def _close(client):
+    try:
+        if isinstance(client, httpx.AsyncClient):
+            await client.aclose()
+        elif hasattr(client, "aio"):  # genai.Client
+            await client.aio.aclose()
+            client.close()
+        else:  # AsyncOpenAI, Redis
+            await client.close()
+    except Exception as e:
+        print(f"Error closing HTTP client: {e}")
+
+
+async def close_all():
+    """Cierra todos los clientes; al volver a pedirlos se crean de nuevo."""
+    clients = list(_http_clients.values()) + list(_sdk_clients.values()) + _closing + list(_redis.values())
+    _http_clients.clear()
+    _sdk_clients.clear()
+    _redis.clear()
+    _closing.clear()
+    for task in list(_closing_tasks):
+        task.cancel()
+    for client in clients:
+        await _close(client)
+    print(f"Closed {len(clients)} shared HTTP clients.")
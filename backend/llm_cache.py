@@ -0,0 +1,139 @@
+"""
+Caché de respuestas de los LLM.
+
+La misma pregunta sobre el mismo documento ("resume este artículo") se
+repite a menudo, también entre usuarios del grupo. La respuesta se guarda con
+una clave que es el hash de proveedor, modelo, historial normalizado, prompt
+y contenido del documento (el md5 del PDF o el texto del .txt), de modo que
+un documento distinto o una versión nueva del PDF no reutiliza respuestas.
+La clave de API no forma parte de la clave: la respuesta se comparte.
+
+Se guarda en Redis si REDIS_URL está configurado y, si no lo está o no
+responde, en la tabla llm_cache de SQLite. Las entradas caducan a los
+LLM_CACHE_TTL segundos. En SQLite el tamaño se limita a LLM_CACHE_MAX_MB
+borrando las menos usadas; en Redis todas las claves llevan TTL, así que el
+límite es el `maxmemory` del servidor con la política volatile-lru.
+
+Cabeceras de la petición para saltarse la caché:
+- `X-LLM-Cache: bypass` o `Cache-Control: no-cache`: no se lee la caché,
+  pero la respuesta nueva sustituye a la guardada.
+- `Cache-Control: no-store`: ni se lee ni se guarda.
+La respuesta indica lo ocurrido en `X-LLM-Cache: HIT | MISS | BYPASS`.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+from backend import db
+from backend.http_clients import get_redis_client
+
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_MB = int(os.getenv("LLM_CACHE_MAX_MB", "64"))
+REDIS_PREFIX = "zotreader:llm:"
+# Tras un fallo de Redis se usa SQLite durante este tiempo antes de volver a probar
+REDIS_RETRY_INTERVAL = 30
+
+_redis_down_until = 0.0
+_stats = {"hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0, "redis_errors": 0}
+
+
+async def cache_key(provider_name: str, call) -> str:
+    """Hash de todo lo que determina la respuesta de una llamada (LLMCall)."""
+    document = await call.document.content_hash() if call.document else None
+    payload = {
+        "provider": provider_name,
+        "model": call.model,
+        "messages": [{"role": m["role"], "content": m["content"].strip()} for m in call.messages],
+        "prompt": (call.prompt or "").strip(),
+        "document": document,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def read_mode(headers) -> str:
+    """'use', 'refresh' (no leer, sí guardar) u 'off' según las cabeceras de la petición."""
+    cache_control = headers.get("cache-control", "").lower()
+    if "no-store" in cache_control:
+        return "off"
+    if "no-cache" in cache_control or headers.get("x-llm-cache", "").lower() == "bypass":
+        return "refresh"
+    return "use"
+
+
+def _redis():
+    if time.time() < _redis_down_until:
+        return None
+    return get_redis_client()
+
+
+def _redis_failed(e):
+    global _redis_down_until
+    _stats["redis_errors"] += 1
+    _redis_down_until = time.time() + REDIS_RETRY_INTERVAL
+    print(f"[WARN] Redis unavailable for the LLM cache ({e}), using SQLite for {REDIS_RETRY_INTERVAL}s.")
+
+
+async def get(key: str) -> str | None:
+    redis = _redis()
+    response = None
+    if redis is not None:
+        try:
+            value = await redis.get(REDIS_PREFIX + key)
+            response = value.decode("utf-8") if value is not None else None
+        except Exception as e:
+            _redis_failed(e)
+            redis = None
+    if redis is None:
+        response = await asyncio.to_thread(db.get_llm_response, key)
+        if response is not None:
+            # El último acceso se anota en segundo plano: la respuesta no lo espera
+            asyncio.get_running_loop().run_in_executor(None, db.touch_llm_response, key)
+    _stats["hits" if response is not None else "misses"] += 1
+    return response
+
+
+async def put(key: str, provider_name: str, model: str, response: str):
+    """Guarda la respuesta. Un fallo de la caché nunca hace fallar la petición."""
+    if not response:
+        return
+    redis = _redis()
+    try:
+        if redis is not None:
+            try:
+                await redis.set(REDIS_PREFIX + key, response.encode("utf-8"), ex=LLM_CACHE_TTL)
+                _stats["stores"] += 1
+                return
+            except Exception as e:
+                _redis_failed(e)
+        _stats["evictions"] += await asyncio.to_thread(
+            db.put_llm_response, key, provider_name, model, response, LLM_CACHE_TTL, LLM_CACHE_MAX_MB * 1024 * 1024)
+        _stats["stores"] += 1
+    except Exception as e:
+        print(f"[ERROR] Could not store the LLM response in the cache: {e}")
+
+
+def record_bypass():
+    _stats["bypassed"] += 1
+
+
+def stats() -> dict:
+    entries, size = db.llm_cache_usage()
+    return {**_stats,
+            "backend": "redis" if os.getenv("REDIS_URL") and time.time() >= _redis_down_until else "sqlite",
+            "sqlite_entries": entries, "sqlite_bytes": size, "ttl": LLM_CACHE_TTL, "max_mb": LLM_CACHE_MAX_MB}
+
+
+async def clear() -> int:
+    """Vacía la caché (Redis y SQLite). Devuelve las entradas borradas."""
+    removed = await asyncio.to_thread(db.clear_llm_cache)
+    redis = _redis()
+    if redis is not None:
+        try:
+            keys = [key async for key in redis.scan_iter(match=REDIS_PREFIX + "*", count=500)]
+            if keys:
+                removed += await redis.delete(*keys)
+        except Exception as e:
+            _redis_failed(e)
+    return removed
@@ -0,0 +1,115 @@
+"""
+Registro de los PDF subidos a los proveedores de LLM.
+
+Mandar el PDF entero (en base64 o subiéndolo) en cada turno de /process-pdf
+repite la transferencia y la codificación del documento en cada pregunta.
+Gemini y OpenAI tienen una API de ficheros: el PDF se sube una vez y los
+turnos siguientes lo referencian por su id/URI. El registro (tabla
+provider_files de SQLite) asocia proveedor, cuenta (hash de la clave de API,
+porque los ficheros son de la cuenta que los sube) y hash del contenido con
+el fichero subido y su caducidad:
+
+- Gemini borra los ficheros a las 48 horas; se registran hasta una hora antes.
+- En OpenAI se suben con caducidad LLM_FILE_TTL (purpose "user_data").
+
+Si el proveedor ya no tiene el fichero (borrado a mano, otra caducidad...),
+el gateway olvida el registro y lo vuelve a subir (forget()).
+
+OpenRouter no tiene API de ficheros: el PDF va siempre en la petición. Para
+no leerlo y codificarlo en cada turno se guarda el data URL de los últimos
+documentos usados, hasta DATA_URL_MEMO_MB.
+"""
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from backend import db
+
+LLM_FILE_TTL = int(os.getenv("LLM_FILE_TTL", str(7 * 24 * 3600)))
+GEMINI_FILE_TTL = 48 * 3600
+# Se deja de usar un fichero un rato antes de que caduque en el proveedor
+EXPIRY_MARGIN = 3600
+DATA_URL_MEMO_MB = int(os.getenv("LLM_DATA_URL_MEMO_MB", "64"))
+
+# Subidas en curso: (provider, account, document_hash) -> asyncio.Task
+_inflight = {}
+_data_urls = OrderedDict()
+_stats = {"uploads": 0, "reused": 0, "coalesced": 0, "stale": 0, "data_url_hits": 0, "data_url_misses": 0}
+
+
+def account_of(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def expiry(expiration_time=None, ttl: int = LLM_FILE_TTL) -> float:
+    """Hasta cuándo se usa un fichero: su caducidad en el proveedor (o ahora + ttl) menos EXPIRY_MARGIN."""
+    if isinstance(expiration_time, datetime):
+        expires_at = expiration_time.timestamp()
+    elif isinstance(expiration_time, (int, float)):
+        expires_at = float(expiration_time)
+    else:
+        expires_at = time.time() + ttl
+    return expires_at - EXPIRY_MARGIN
+
+
+async def provider_file(provider_name: str, api_key: str, document, upload) -> dict:
+    """
+    Fichero del documento en el proveedor: {"key", "file_id", "uri", "mime_type"}.
+    Si no está registrado se sube con `upload(document)`, que devuelve
+    (file_id, uri, mime_type, expires_at). Las peticiones simultáneas del
+    mismo documento comparten una sola subida.
+    """
+    key = (provider_name, account_of(api_key), await document.content_hash())
+    row = await asyncio.to_thread(db.get_provider_file, *key)
+    if row:
+        _stats["reused"] += 1
+        file_id, uri, mime_type = row
+        return {"key": key, "file_id": file_id, "uri": uri, "mime_type": mime_type}
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_upload_and_record(key, document, upload))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        _stats["coalesced"] += 1
+    # shield: si un cliente se desconecta no se cancela la subida de los demás
+    return await asyncio.shield(task)
+
+
+async def _upload_and_record(key, document, upload):
+    _stats["uploads"] += 1
+    file_id, uri, mime_type, expires_at = await upload(document)
+    await asyncio.to_thread(db.put_provider_file, *key, file_id, uri, mime_type, expires_at)
+    return {"key": key, "file_id": file_id, "uri": uri, "mime_type": mime_type}
+
+
+async def forget(key):
+    """Olvida un fichero que el proveedor ya no tiene; la próxima llamada lo sube de nuevo."""
+    _stats["stale"] += 1
+    print(f"[WARN] {key[0]} no longer has the uploaded file for {key[2]}, uploading it again.")
+    await asyncio.to_thread(db.delete_provider_file, *key)
+
+
+async def data_url(document) -> str:
+    """data URL (base64) del PDF, memorizado para los turnos siguientes sobre el mismo documento."""
+    key = await document.content_hash()
+    value = _data_urls.get(key)
+    if value is not None:
+        _stats["data_url_hits"] += 1
+        _data_urls.move_to_end(key)
+        return value
+    _stats["data_url_misses"] += 1
+    value = await document.data_url()
+    _data_urls[key] = value
+    limit = DATA_URL_MEMO_MB * 1024 * 1024
+    while _data_urls and sum(len(v) for v in _data_urls.values()) > limit:
+        _data_urls.popitem(last=False)
+    return value
+
+
+def stats() -> dict:
+    return {**_stats, "registered": db.count_provider_files(), "uploading": len(_inflight),
+            "data_urls": len(_data_urls)}
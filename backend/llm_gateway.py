@@ -0,0 +1,596 @@
+"""
+Pasarela común a los modelos de lenguaje (Gemini, OpenAI y OpenRouter).
+
+Los routers de backend/apis/ son adaptadores finos: reciben los modelos
+compartidos (ChatRequest, ProcessPdfRequest) y llaman a chat() o
+process_pdf(). Todo lo demás se hace aquí una sola vez para todos los
+proveedores:
+
+- normalizar el historial (roles user/assistant/system),
+- preparar el documento de /process-pdf: el .txt de markdown_api (o, si es
+  largo, sus pasajes relevantes para la pregunta, backend/retrieval.py)
+  envuelto en [DOCUMENTO]...[/DOCUMENTO] o el PDF, subido una sola vez a Gemini y OpenAI
+  y referenciado en los turnos siguientes (backend/llm_files.py),
+- limitar las llamadas simultáneas a cada proveedor (LLM_MAX_CONCURRENCY),
+- reintentar los errores transitorios (429, 5xx, red) con espera exponencial
+  con jitter; en streaming, solo mientras no ha llegado ningún fragmento,
+- cortar las llamadas que no responden en LLM_TIMEOUT segundos (en
+  streaming, el tiempo máximo entre dos fragmentos),
+- medir peticiones, errores, latencia, tiempo hasta el primer fragmento y
+  tokens por proveedor (metrics(), en /api/llm/metrics),
+- y servir desde la caché de respuestas las preguntas repetidas
+  (backend/llm_cache.py).
+
+Cada proveedor implementa Provider.complete() y Provider.stream() con su API.
+"""
+import asyncio
+import base64
+import json
+import os
+import random
+import time
+from collections import deque
+from typing import List, Optional
+
+import httpx
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from backend import llm_cache, llm_files, retrieval
+from backend.apis.streaming import sse_response
+from backend.http_clients import get_genai_client, get_http_client, get_openai_client
+from backend.store import file_md5, resolve_local
+
+# Llamadas simultáneas por proveedor; las demás esperan turno
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "300"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 20.0
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+PDF_HARD_LIMIT = 100 * 1024 * 1024  # 100 MB
+# Errores con los que un proveedor puede indicar que ya no tiene un fichero
+# subido: 404, o 400/403 si el mensaje nombra el fichero (Gemini responde 403
+# "File files/... not found or permission denied")
+STALE_FILE_STATUS = {400, 403}
+# Muestras de latencia que se conservan por proveedor para los percentiles
+LATENCY_SAMPLES = 200
+
+
+class ChatRequest(BaseModel):
+    api_key: str | None = None
+    model: str
+    history: List[dict]  # acepta dicts del frontend
+
+
+class ProcessPdfRequest(BaseModel):
+    api_key: str | None = None
+    model: str
+    pdf_filename: str
+    prompt: str
+    history: Optional[List[dict]] = None
+
+
+class ProviderError(Exception):
+    """Error devuelto por un proveedor, con su código HTTP (decide si se reintenta)."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# md5 de los PDF ya leídos, por (ruta, tamaño, mtime): no se vuelve a leer el fichero
+_document_hashes = {}
+
+
+class Document:
+    """Documento de /process-pdf: texto ya extraído (.txt) o un PDF que se lee al enviarlo."""
+
+    def __init__(self, path, text: str | None = None):
+        self.path = path
+        self.text = text
+        # Pasajes del texto que se mandan en lugar del texto entero (documentos largos)
+        self.excerpt = None
+        self.size = path.stat().st_size
+
+    async def content_hash(self) -> str:
+        """md5 del PDF (memorizado por ruta, tamaño y mtime) o sha256 del texto."""
+        if self.text is not None:
+            return retrieval.text_hash(self.text)
+        stat = self.path.stat()
+        memo_key = (str(self.path), stat.st_size, stat.st_mtime_ns)
+        digest = _document_hashes.get(memo_key)
+        if digest is None:
+            digest = _document_hashes[memo_key] = "pdf:" + await asyncio.to_thread(file_md5, self.path)
+        return digest
+
+    def wrap(self, prompt: str) -> str:
+        if self.excerpt is not None:
+            return ("[DOCUMENTO]\n(Fragmentos del documento relevantes para la pregunta, con su página entre "
+                    f"corchetes; cítala al usarlos.)\n\n{self.excerpt}\n[/DOCUMENTO]\n\n{prompt}")
+        return f"[DOCUMENTO]\n{self.text}\n[/DOCUMENTO]\n\n{prompt}"
+
+    def _encode(self) -> str:
+        return f"data:application/pdf;base64,{base64.b64encode(self.path.read_bytes()).decode('utf-8')}"
+
+    async def data_url(self) -> str:
+        # Leer y codificar un PDF de decenas de MB bloquearía el event loop
+        return await asyncio.to_thread(self._encode)
+
+
+class LLMCall:
+    """Una llamada ya normalizada; el proveedor anota en ella los tokens usados."""
+
+    def __init__(self, api_key: str, model: str, messages: list, document: Document | None = None,
+                 prompt: str | None = None):
+        self.api_key = api_key
+        self.model = model
+        self.messages = messages
+        self.document = document
+        self.prompt = prompt
+        self.input_tokens = None
+        self.output_tokens = None
+        # Fichero subido que usa la llamada, si lo hay (ver llm_files.provider_file)
+        self.file = None
+        self.file_refreshed = False
+
+    def set_usage(self, input_tokens, output_tokens):
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+
+
+def normalize_history(history) -> list:
+    """Historial del frontend como [{role: user|assistant|system, content: str}]."""
+    messages = []
+    for msg in history or []:
+        role = msg.get("role")
+        role = "assistant" if role == "model" else role
+        content = msg.get("content")
+        if role not in ("user", "assistant", "system") or not content:
+            continue
+        messages.append({"role": role, "content": content if isinstance(content, str) else str(content)})
+    return messages
+
+
+async def load_document(pdf_filename: str) -> Document:
+    path = resolve_local(pdf_filename)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"File not found: {pdf_filename}")
+    if path.suffix.lower() == ".txt":
+        return Document(path, await asyncio.to_thread(path.read_text, encoding="utf-8"))
+    document = Document(path)
+    if document.size > PDF_HARD_LIMIT:
+        raise HTTPException(status_code=413, detail=f"PDF demasiado grande (> {PDF_HARD_LIMIT // 1024 // 1024} MB)")
+    return document
+
+
+# --- Proveedores ---
+
+class Provider:
+    name = ""
+    label = ""
+    env_key = ""
+
+    async def complete(self, call: LLMCall) -> str:
+        raise NotImplementedError
+
+    async def stream(self, call: LLMCall):
+        """Generador asíncrono con los fragmentos de texto de la respuesta."""
+        raise NotImplementedError
+        yield
+
+
+class OpenAIProvider(Provider):
+    name, label, env_key = "openai", "OpenAI", "OPENAI_API_KEY"
+    # Orden de las partes del último mensaje de /process-pdf
+    file_first = True
+
+    async def messages(self, call: LLMCall) -> list:
+        messages = list(call.messages)
+        if call.document is None:
+            return messages
+        if call.document.text is not None:
+            content = [{"type": "text", "text": call.document.wrap(call.prompt)}]
+        else:
+            file_part = {"type": "file", "file": await self.file_reference(call)}
+            prompt_part = {"type": "text", "text": call.prompt}
+            content = [file_part, prompt_part] if self.file_first else [prompt_part, file_part]
+        messages.append({"role": "user", "content": content})
+        return messages
+
+    async def file_reference(self, call: LLMCall) -> dict:
+        """El PDF como fichero subido (file_id), que se reutiliza en los turnos siguientes."""
+        client = get_openai_client(call.api_key)
+
+        async def upload(document):
+            uploaded = await client.files.create(
+                file=document.path, purpose="user_data",
+                expires_after={"anchor": "created_at", "seconds": llm_files.LLM_FILE_TTL})
+            return uploaded.id, None, "application/pdf", llm_files.expiry(uploaded.expires_at)
+
+        registered = await llm_files.provider_file(self.name, call.api_key, call.document, upload)
+        call.file = registered
+        return {"file_id": registered["file_id"]}
+
+    async def complete(self, call):
+        client = get_openai_client(call.api_key)
+        response = await client.chat.completions.create(model=call.model, messages=await self.messages(call))
+        if response.usage:
+            call.set_usage(response.usage.prompt_tokens, response.usage.completion_tokens)
+        return response.choices[0].message.content
+
+    async def stream(self, call):
+        client = get_openai_client(call.api_key)
+        stream = await client.chat.completions.create(model=call.model, messages=await self.messages(call),
+                                                      stream=True, stream_options={"include_usage": True})
+        try:
+            async for chunk in stream:
+                if chunk.usage:
+                    call.set_usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+
+
+class OpenRouterProvider(OpenAIProvider):
+    """API compatible con la de OpenAI, llamada con el cliente httpx compartido."""
+    name, label, env_key = "openrouter", "OpenRouter", "OPENROUTER_API_KEY"
+    file_first = False
+
+    async def file_reference(self, call: LLMCall) -> dict:
+        # Sin API de ficheros: el PDF va en cada petición, codificado una sola vez
+        return {"filename": call.document.path.name, "file_data": await llm_files.data_url(call.document)}
+
+    def _headers(self, call):
+        return {"Authorization": f"Bearer {call.api_key}", "Content-Type": "application/json"}
+
+    def _record_usage(self, call, usage):
+        if usage:
+            call.set_usage(usage.get("prompt_tokens"), usage.get("completion_tokens"))
+
+    async def complete(self, call):
+        payload = {"model": call.model, "messages": await self.messages(call)}
+        response = await get_http_client("openrouter").post("/chat/completions", headers=self._headers(call), json=payload)
+        if not response.is_success:
+            raise ProviderError(response.status_code, response.text)
+        data = response.json()
+        if data.get("error"):
+            raise ProviderError(data["error"].get("code") or 500, data["error"].get("message", str(data["error"])))
+        self._record_usage(call, data.get("usage"))
+        return data["choices"][0]["message"]["content"]
+
+    async def stream(self, call):
+        payload = {"model": call.model, "messages": await self.messages(call), "stream": True}
+        async with get_http_client("openrouter").stream("POST", "/chat/completions", headers=self._headers(call),
+                                                        json=payload) as response:
+            if not response.is_success:
+                raise ProviderError(response.status_code, (await response.aread()).decode())
+            async for line in response.aiter_lines():
+                # Las líneas que empiezan por ":" son comentarios de keep-alive
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get("error"):
+                    raise ProviderError(chunk["error"].get("code") or 500, chunk["error"].get("message", str(chunk["error"])))
+                self._record_usage(call, chunk.get("usage"))
+                choices = chunk.get("choices") or [{}]
+                text = choices[0].get("delta", {}).get("content")
+                if text:
+                    yield text
+
+
+class GeminiProvider(Provider):
+    name, label, env_key = "google", "Gemini", "GOOGLE_API_KEY"
+
+    async def contents(self, call: LLMCall, client) -> list:
+        from google.genai import types
+        contents = [
+            types.Content(role="model" if m["role"] == "assistant" else "user", parts=[types.Part(text=m["content"])])
+            # Gemini solo admite los roles user y model en el historial
+            for m in call.messages if m["role"] != "system"
+        ]
+        document = call.document
+        if document is None:
+            return contents
+        if document.text is not None:
+            parts = [types.Part(text=document.wrap(call.prompt))]
+        else:
+            async def upload(document):
+                uploaded = await client.aio.files.upload(
+                    file=str(document.path), config={"mime_type": "application/pdf", "display_name": document.path.name})
+                return (uploaded.name, uploaded.uri, uploaded.mime_type or "application/pdf",
+                        llm_files.expiry(uploaded.expiration_time, llm_files.GEMINI_FILE_TTL))
+
+            registered = await llm_files.provider_file(self.name, call.api_key, document, upload)
+            call.file = registered
+            parts = [types.Part.from_uri(file_uri=registered["uri"], mime_type=registered["mime_type"]),
+                     types.Part(text=call.prompt)]
+        contents.append(types.Content(role="user", parts=parts))
+        return contents
+
+    def _check(self, call, response):
+        """Anota los tokens y lanza ProviderError si Gemini ha bloqueado la respuesta."""
+        usage = getattr(response, "usage_metadata", None)
+        if usage and usage.prompt_token_count is not None:
+            call.set_usage(usage.prompt_token_count, usage.candidates_token_count)
+        block_reason = getattr(getattr(response, "prompt_feedback", None), "block_reason", None)
+        if block_reason:
+            raise ProviderError(400, f"Response blocked due to: {block_reason}")
+
+    async def complete(self, call):
+        client = get_genai_client(call.api_key)
+        response = await client.aio.models.generate_content(model=call.model, contents=await self.contents(call, client))
+        self._check(call, response)
+        answer = (response.text or "").strip()
+        if not answer:
+            raise ProviderError(500, "Gemini devolvió una respuesta vacía.")
+        return answer
+
+    async def stream(self, call):
+        client = get_genai_client(call.api_key)
+        stream = await client.aio.models.generate_content_stream(model=call.model,
+                                                                 contents=await self.contents(call, client))
+        try:
+            async for chunk in stream:
+                self._check(call, chunk)
+                if chunk.text:
+                    yield chunk.text
+        finally:
+            if hasattr(stream, "aclose"):
+                await stream.aclose()
+
+
+PROVIDERS = {provider.name: provider for provider in (GeminiProvider(), OpenAIProvider(), OpenRouterProvider())}
+
+
+# --- Concurrencia, reintentos y métricas ---
+
+_semaphores = {name: asyncio.Semaphore(LLM_MAX_CONCURRENCY) for name in PROVIDERS}
+_metrics = {
+    name: {"requests": 0, "streams": 0, "errors": 0, "retries": 0, "timeouts": 0, "in_flight": 0,
+           "input_tokens": 0, "output_tokens": 0,
+           "latency": deque(maxlen=LATENCY_SAMPLES), "first_token": deque(maxlen=LATENCY_SAMPLES)}
+    for name in PROVIDERS
+}
+
+
+def _status_of(error) -> int | None:
+    for attr in ("status_code", "code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def _is_retryable(error) -> bool:
+    if isinstance(error, (HTTPException, TimeoutError)):
+        return False
+    if isinstance(error, httpx.TransportError):
+        return True
+    status = _status_of(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # Errores de conexión de los SDK (openai.APIConnectionError, APITimeoutError)
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+async def _backoff(provider: Provider, attempt: int, error):
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    _metrics[provider.name]["retries"] += 1
+    print(f"[WARN] {provider.label} call failed ({error}), retrying in {delay:.1f}s...")
+    await asyncio.sleep(delay)
+
+
+def _record(provider: Provider, call: LLMCall, start: float):
+    m = _metrics[provider.name]
+    m["latency"].append(time.monotonic() - start)
+    m["input_tokens"] += call.input_tokens or 0
+    m["output_tokens"] += call.output_tokens or 0
+
+
+async def _refresh_stale_file(call: LLMCall, error) -> bool:
+    """
+    Si la llamada usaba un fichero subido y el proveedor la rechaza como si no
+    lo tuviera, olvida el registro para que el reintento lo suba de nuevo (una vez).
+    """
+    if call.file is None or call.file_refreshed:
+        return False
+    status = _status_of(error)
+    if status != 404:
+        # Otros 400/403 (modelo, clave, cuota, prompt demasiado largo) no tienen que ver con el fichero
+        message = str(error)
+        names = [name for name in (call.file["file_id"], call.file["uri"]) if name]
+        if status not in STALE_FILE_STATUS or not any(name in message for name in names):
+            return False
+    await llm_files.forget(call.file["key"])
+    call.file = None
+    call.file_refreshed = True
+    return True
+
+
+def _timeout_error(provider: Provider) -> TimeoutError:
+    _metrics[provider.name]["timeouts"] += 1
+    return TimeoutError(f"{provider.label} did not respond within {LLM_TIMEOUT:.0f}s")
+
+
+async def complete(provider: Provider, call: LLMCall) -> str:
+    m = _metrics[provider.name]
+    m["requests"] += 1
+    async with _semaphores[provider.name]:
+        m["in_flight"] += 1
+        start = time.monotonic()
+        try:
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                try:
+                    async with asyncio.timeout(LLM_TIMEOUT):
+                        text = await provider.complete(call)
+                    break
+                except TimeoutError:
+                    raise _timeout_error(provider) from None
+                except Exception as e:
+                    if attempt < LLM_MAX_RETRIES and await _refresh_stale_file(call, e):
+                        continue
+                    if attempt == LLM_MAX_RETRIES or not _is_retryable(e):
+                        raise
+                    await _backoff(provider, attempt, e)
+        except Exception:
+            m["errors"] += 1
+            raise
+        finally:
+            m["in_flight"] -= 1
+    _record(provider, call, start)
+    return text
+
+
+async def stream(provider: Provider, call: LLMCall):
+    """Fragmentos de la respuesta, con los mismos límites, reintentos y métricas que complete()."""
+    m = _metrics[provider.name]
+    m["requests"] += 1
+    m["streams"] += 1
+    async with _semaphores[provider.name]:
+        m["in_flight"] += 1
+        start = time.monotonic()
+        deltas = None
+        try:
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                deltas = provider.stream(call)
+                try:
+                    async with asyncio.timeout(LLM_TIMEOUT):
+                        first = await anext(deltas)
+                    break
+                except StopAsyncIteration:
+                    first = None
+                    break
+                except TimeoutError:
+                    raise _timeout_error(provider) from None
+                except Exception as e:
+                    await deltas.aclose()
+                    if attempt < LLM_MAX_RETRIES and await _refresh_stale_file(call, e):
+                        continue
+                    if attempt == LLM_MAX_RETRIES or not _is_retryable(e):
+                        raise
+                    await _backoff(provider, attempt, e)
+            m["first_token"].append(time.monotonic() - start)
+            if first:
+                yield first
+            while True:
+                try:
+                    async with asyncio.timeout(LLM_TIMEOUT):
+                        text = await anext(deltas)
+                except StopAsyncIteration:
+                    break
+                except TimeoutError:
+                    raise _timeout_error(provider) from None
+                yield text
+            _record(provider, call, start)
+        except Exception:
+            m["errors"] += 1
+            raise
+        finally:
+            m["in_flight"] -= 1
+            if deltas is not None:
+                await deltas.aclose()
+
+
+def _percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+
+
+def metrics() -> dict:
+    """Contadores, latencias (media, p50, p95 en segundos) y tokens por proveedor."""
+    result = {}
+    for name, m in _metrics.items():
+        result[name] = {
+            **{key: value for key, value in m.items() if not isinstance(value, deque)},
+            "latency": {"avg": round(sum(m["latency"]) / len(m["latency"]), 3) if m["latency"] else None,
+                        "p50": _percentile(m["latency"], 0.5), "p95": _percentile(m["latency"], 0.95)},
+            "first_token": {"p50": _percentile(m["first_token"], 0.5), "p95": _percentile(m["first_token"], 0.95)},
+        }
+    return result
+
+
+# --- Entrada desde los routers ---
+
+def _provider_and_key(provider_name: str, api_key: str | None):
+    provider = PROVIDERS[provider_name]
+    api_key = api_key or os.getenv(provider.env_key)
+    if not api_key:
+        raise HTTPException(status_code=401, detail=f"{provider.label} API key is required.")
+    return provider, api_key
+
+
+async def _replay(text: str):
+    yield text
+
+
+async def _store_when_complete(deltas, key: str, provider: Provider, call: LLMCall):
+    """Pasa los fragmentos y guarda la respuesta en la caché solo si el stream termina entero."""
+    parts = []
+    try:
+        async for text in deltas:
+            parts.append(text)
+            yield text
+        await llm_cache.put(key, provider.name, call.model, "".join(parts))
+    finally:
+        await deltas.aclose()
+
+
+async def _respond(provider: Provider, call: LLMCall, request: Request, use_stream: bool, operation: str):
+    mode = llm_cache.read_mode(request.headers)
+    key = await llm_cache.cache_key(provider.name, call) if mode != "off" else None
+    cached = await llm_cache.get(key) if mode == "use" else None
+    if cached is not None:
+        response = await sse_response(request, _replay(cached)) if use_stream else JSONResponse({"response": cached})
+        response.headers["X-LLM-Cache"] = "HIT"
+        return response
+    if mode != "use":
+        llm_cache.record_bypass()
+    try:
+        if use_stream:
+            deltas = stream(provider, call)
+            if key:
+                deltas = _store_when_complete(deltas, key, provider, call)
+            response = await sse_response(request, deltas)
+        else:
+            text = await complete(provider, call)
+            if key:
+                await llm_cache.put(key, provider.name, call.model, text)
+            response = JSONResponse({"response": text})
+    except HTTPException:
+        raise
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        print(f"[ERROR] {provider.label} {operation} error: {e}")
+        raise HTTPException(status_code=400, detail=f"{provider.label} {operation} error: {e}")
+    response.headers["X-LLM-Cache"] = "MISS" if mode == "use" else "BYPASS"
+    return response
+
+
+async def chat(provider_name: str, req: ChatRequest, request: Request, use_stream: bool = False):
+    provider, api_key = _provider_and_key(provider_name, req.api_key)
+    messages = normalize_history(req.history)
+    if not messages or messages[-1]["role"] != "user":
+        raise HTTPException(status_code=400, detail="History must end with a user message.")
+    return await _respond(provider, LLMCall(api_key, req.model, messages), request, use_stream, "chat")
+
+
+async def process_pdf(provider_name: str, req: ProcessPdfRequest, request: Request, use_stream: bool = False):
+    provider, api_key = _provider_and_key(provider_name, req.api_key)
+    document = await load_document(req.pdf_filename)
+    messages = normalize_history(req.history)
+    if document.text is not None:
+        # La pregunta y la anterior del usuario (para preguntas de seguimiento)
+        query = " ".join([req.prompt] + [m["content"] for m in messages if m["role"] == "user"][-1:])
+        document.excerpt = await retrieval.relevant_passages(await document.content_hash(), document.text, query)
+    call = LLMCall(api_key, req.model, messages, document, req.prompt)
+    return await _respond(provider, call, request, use_stream, "PDF processing")
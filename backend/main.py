@@ -3,19 +3,18 @@ load_dotenv()
 
 import os
 import json
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks
+import asyncio
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import Response, FileResponse # Modified import: Added FileResponse
+from fastapi.responses import Response, FileResponse, StreamingResponse, JSONResponse # Modified import: Added FileResponse
 from operator import itemgetter
-from pyzotero import zotero
 import hashlib
-import requests
+import base64
 import time
-import zipfile
-import io
+import re
 from pathlib import Path
-import glob # Added
+from datetime import datetime, timezone
 from pydantic import BaseModel # Added for response model
 
 # Import the google api router directly
@@ -25,16 +24,20 @@ from backend.apis.openrouter_api import router as openrouter_router
 from backend.annotations.handlers import router as annotations_router  # Use full import for Docker context
 from backend.apis.markdown_api import router as markdown_router, generate_md_for_pdf
 from backend.settings import DOWNLOADS_DIR
-from backend.db import get_collections, get_subcollections, get_items, search_items, get_connection
+from backend.downloads import ensure_downloaded, download_stats
+from backend.http_clients import close_all as close_http_clients
+from backend.llm_gateway import PROVIDERS as LLM_PROVIDERS, metrics as llm_gateway_metrics
+from backend import llm_cache, llm_files, retrieval
+from backend import prefetch, store
+from backend.zotero_client import ChildrenResolver, ZoteroError, client_stats, get_client, new_sync_client
+from backend.utils import format_creators, file_etag, etag_matches
+from backend.db import get_collections, get_subcollections, get_items, search_items, get_read_db, read_pool_stats, get_attachment_info
 
 API_KEY = os.getenv("ZOTERO_API_KEY")
 USER_ID = os.getenv("ZOTERO_USER_ID")
 if not (API_KEY and USER_ID):
     raise RuntimeError("Faltan ZOTERO_API_KEY o ZOTERO_USER_ID en variables de entorno")
 
-# instancia para tu biblioteca personal
-user_zot = zotero.Zotero(USER_ID, "user", API_KEY)
-
 # Cache setup
 CACHE_DIR = Path("backend/cache")
 LIBRARIES_CACHE_FILE = CACHE_DIR / "libraries.json"
@@ -43,9 +46,6 @@ CACHE_DIR.mkdir(parents=True, exist_ok=True) # Ensure cache directory exists
 # Global variable to hold cached libraries
 cached_libraries = []
 
-def group_client(group_id: str):
-    return zotero.Zotero(group_id, "group", API_KEY)
-
 # --- Cache Functions ---
 
 # Library Cache
@@ -72,12 +72,12 @@ def save_libraries_cache():
     except IOError as e:
         print(f"Error saving libraries cache: {e}")
 
-def fetch_libraries_from_zotero():
+async def fetch_libraries_from_zotero():
     global cached_libraries
     print("Fetching libraries from Zotero API...")
     try:
         libs = [{"id": USER_ID, "type": "user", "name": "Mi biblioteca"}]
-        groups = user_zot.groups()
+        groups = await get_client("user", USER_ID).groups()
         for g in groups:
             libs.append({"id": g["id"], "type": "group", "name": g["data"]["name"]})
         cached_libraries = libs
@@ -88,64 +88,24 @@ def fetch_libraries_from_zotero():
         # Decide if you want to clear cache or keep old one on error
         # cached_libraries = [] # Option: clear cache on error
 
-# Item Cache
-def get_items_cache_path(lib_type: str, lib_id: str, collection_key: str = None) -> Path:
-    """Generates the path for the item cache file."""
-    if collection_key:
-        return CACHE_DIR / f"items_{lib_type}_{lib_id}_collection_{collection_key}.json"
-    else:
-        return CACHE_DIR / f"items_{lib_type}_{lib_id}.json"
-
-def load_items_cache(lib_type: str, lib_id: str, collection_key: str = None):
-    """Loads items from the cache file if it exists."""
-    cache_file = get_items_cache_path(lib_type, lib_id, collection_key)
-    if cache_file.exists():
+# Los listados de ítems se sirven desde SQLite; estos ficheros de la caché
+# JSON anterior (items_{tipo}_{id}[_collection_{clave}].json) ya no se usan
+def remove_legacy_item_caches():
+    for cache_file in CACHE_DIR.glob("items_*.json"):
         try:
-            with open(cache_file, 'r') as f:
-                print(f"Loading items from cache: {cache_file}")
-                return json.load(f)
-        except json.JSONDecodeError:
-            print(f"Error decoding items cache: {cache_file}")
-            return None # Indicate cache read failure
-    print(f"Items cache file not found: {cache_file}")
-    return None
-
-def save_items_cache(lib_type: str, lib_id: str, items_data, collection_key: str = None):
-    """Saves items data to the cache file."""
-    cache_file = get_items_cache_path(lib_type, lib_id, collection_key)
-    try:
-        with open(cache_file, 'w') as f:
-            json.dump(items_data, f, indent=4)
-        print(f"Items cache saved: {cache_file}")
-    except IOError as e:
-        print(f"Error saving items cache {cache_file}: {e}")
+            cache_file.unlink()
+            print(f"Deleted legacy item cache: {cache_file}")
+        except OSError as e:
+            print(f"Error deleting cache file {cache_file}: {e}")
 
-def format_item(it, zot):
-    """Helper function to format a single Zotero item, ensuring hasAttachment is accurate."""
+def format_item(it, children):
+    """Helper function to format a single Zotero item; `children` are its child items, used for hasAttachment."""
     data = it.get('data', {})
     tags = data.get('tags', [])
     item_key = it.get('key')
-    has_attachment = False # Default to false
-
-    # Use Pyzotero's children() method to check for actual attachments
-    # This is the most reliable way when fetching lists initially.
-    if item_key:
-        try:
-            # print(f"Checking children for item: {item_key}") # Optional: uncomment for debugging
-            children = zot.children(item_key)
-            # print(f"Children found for {item_key}: {len(children)}") # Optional: uncomment for debugging
-            for child in children:
-                child_data = child.get('data', {})
-                if child_data.get('itemType') == 'attachment':
-                    # print(f"Attachment found for {item_key}") # Optional: uncomment for debugging
-                    has_attachment = True
-                    break # Found one, no need to check further
-        except Exception as e:
-            # Log the error but continue; assume no attachment if children check fails
-            print(f"Error fetching/checking children for item {item_key}: {e}")
-            # Keep has_attachment as False
-    else:
+    if not item_key:
         print("Warning: Item found without a key during formatting.")
+    has_attachment = any(child.get('data', {}).get('itemType') == 'attachment' for child in children)
 
     return {
         "key": item_key,
@@ -159,21 +119,39 @@ def format_item(it, zot):
         "url": data.get("url", "")
     }
 
-def fetch_and_cache_items(lib_type: str, lib_id: str, collection_key: str = None):
-    """Fetches items from Zotero, formats them, saves to cache, and returns them."""
-    zot = user_zot if lib_type == "user" else group_client(lib_id)
+def format_listing_item(row):
+    """Fila de db.get_listing_items con el mismo formato que format_item."""
+    from backend.db import TAG_SEPARATOR
+    return {
+        "key": row["id"],
+        "title": row["title"] or "",
+        "itemType": row["item_type"],
+        "creators": row["creators"],
+        "date": row["date"],
+        "tags": row["tags"].split(TAG_SEPARATOR) if row["tags"] else [],
+        "hasAttachment": bool(row["has_attachment"]),
+        "abstractNote": row["abstract_note"] or "",
+        "url": row["url"] or "",
+    }
+
+def children_resolver(lib_type: str, lib_id: str) -> ChildrenResolver:
+    """Dependencia: un resolvedor de hijos por petición, que memoriza lo que ya ha pedido."""
+    return ChildrenResolver(get_client(lib_type, lib_id))
+
+async def fetch_items_from_zotero(lib_type: str, lib_id: str, collection_key: str = None, resolver: ChildrenResolver = None):
+    """Fetches items from Zotero and formats them (only for libraries not yet synchronized to SQLite)."""
+    zot = get_client(lib_type, lib_id)
+    resolver = resolver or ChildrenResolver(zot)
     print(f"Fetching items from Zotero for {lib_type}/{lib_id}" + (f"/collection/{collection_key}" if collection_key else ""))
     try:
         if collection_key:
-            items_data = zot.everything(zot.collection_items(collection_key, itemType="-attachment || annotation"))
+            items_data = await zot.collection_items(collection_key, itemType="-attachment || annotation")
         else:
-            items_data = zot.everything(zot.top(itemType="-attachment || annotation"))
-
-        # Format items - Pass zot instance to format_item
-        result = [format_item(it, zot) for it in items_data]
+            items_data = await zot.top(itemType="-attachment || annotation")
 
-        save_items_cache(lib_type, lib_id, result, collection_key)
-        return result
+        # Hijos de todos los ítems en bloque (ver ChildrenResolver)
+        children = await resolver.children_many(items_data)
+        return [format_item(it, children.get(it.get('key'), [])) for it in items_data]
     except Exception as e:
         print(f"Error fetching items for {lib_type}/{lib_id}" + (f"/collection/{collection_key}" if collection_key else "") + f": {e}")
         raise HTTPException(status_code=500, detail=f"Error fetching items: {e}")
@@ -187,6 +165,7 @@ app.add_middleware(
     allow_origins=["*"],  # ajuste rápido
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Sync-State", "X-Library-Version", "X-Synced-At"],
 )
 
 # Include the Google API router with the /api prefix
@@ -197,15 +176,59 @@ app.include_router(annotations_router, prefix="/api")  # Añadir el router de an
 app.include_router(markdown_router, prefix="/api")
 
 # --- Application Startup Logic ---
+async def background_sync(fetch_libraries: bool = False):
+    """Sincronización en segundo plano; los errores se registran, no se propagan."""
+    try:
+        if fetch_libraries:
+            await fetch_libraries_from_zotero()
+        await sync_sqlite_from_zotero()
+    except Exception as e:
+        print(f"Error in background synchronization: {e}")
+
+startup_tasks = set()
+
 @app.on_event("startup")
-def startup_event():
-    if not load_libraries_cache():
-        fetch_libraries_from_zotero()
-    # Sincronizar SQLite antes de que el frontend haga peticiones
-    print("Synchronizing SQLite database on backend startup...")
-    sync_sqlite_from_zotero()
+async def startup_event():
+    # El servidor arranca sirviendo lo que ya hay en SQLite y en la caché de
+    # bibliotecas; la sincronización con Zotero se hace en segundo plano y su
+    # progreso se consulta en /api/sync/status
+    cache_loaded = load_libraries_cache()
+    remove_legacy_item_caches()
+    print("Starting background SQLite synchronization...")
+    task = asyncio.create_task(background_sync(not cache_loaded))
+    startup_tasks.add(task)
+    task.add_done_callback(startup_tasks.discard)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Los clientes HTTP y de los SDK de LLM se comparten entre peticiones
+    # (backend/http_clients.py); se cierran al parar el servidor
+    await close_http_clients()
 # --- End Startup Logic ---
 
+# --- Freshness headers ---
+LIBRARY_PATH = re.compile(r"^/api/(?:sqlite/)?libraries/(user|group)/([^/]+)")
+
+@app.middleware("http")
+async def freshness_headers(request, call_next):
+    """
+    Añade a las respuestas de la API el estado de la sincronización y, en las
+    rutas de una biblioteca, la versión de Zotero y la fecha de los datos
+    servidos, para que el cliente sepa si puede estar viendo datos antiguos.
+    """
+    response = await call_next(request)
+    if request.url.path.startswith("/api/"):
+        from backend.sync import get_sync_running, library_state
+        response.headers["X-Sync-State"] = "syncing" if get_sync_running() else "idle"
+        match = LIBRARY_PATH.match(request.url.path)
+        state = match and library_state(match.group(1), match.group(2))
+        if state:
+            version, synced_at = state
+            response.headers["X-Library-Version"] = str(version)
+            if synced_at:
+                response.headers["X-Synced-At"] = datetime.fromtimestamp(synced_at, timezone.utc).isoformat()
+    return response
+
 
 # --- New Configuration Endpoint ---
 
@@ -228,172 +251,106 @@ def get_api_config():
 # --- End New Configuration Endpoint ---
 
 
-# Helper function to format creators
-def format_creators(creators_list):
-    if not creators_list:
-        return ""
-    names = []
-    for creator in creators_list:
-        # Prioritize lastName if available
-        last_name = creator.get('lastName')
-        first_name = creator.get('firstName')
-        if last_name:
-            name = last_name
-            if first_name:
-                name += f", {first_name}"
-        elif first_name: # Handle case where only firstName exists
-            name = first_name
-        else: # Handle case where neither exists (e.g., institutional author in 'name')
-            name = creator.get('name', '')
-        names.append(name)
-    return "; ".join(names) # Use semicolon for multiple creators
-
 @app.get("/api/libraries")
-def libraries():
+async def libraries():
     """Devuelve Mi biblioteca + grupos a los que tengas acceso (desde caché)"""
     global cached_libraries
     if not cached_libraries: # Fallback if cache is empty for some reason
-         fetch_libraries_from_zotero()
+         await fetch_libraries_from_zotero()
     return cached_libraries
 
-def sync_sqlite_from_zotero():
+async def sync_sqlite_from_zotero(full: bool = False):
     """
-    Sincroniza todas las colecciones e ítems de Zotero a la base de datos SQLite.
-    Borra primero las tablas y repuebla todo.
+    Sincroniza colecciones e ítems de Zotero a la base de datos SQLite.
+    Es incremental: cada biblioteca solo descarga lo modificado desde la última
+    versión sincronizada (ver backend/sync.py). Con full=True se descarga todo.
+    Las bibliotecas se sincronizan en paralelo; el progreso se consulta en
+    /api/sync/status.
     """
-    from backend.db import get_connection, insert_collection, insert_item, insert_item_collection, get_all_items
-    conn = get_connection()
-    cur = conn.cursor()
-    # Limpiar tablas
-    cur.execute('DELETE FROM collections')
-    cur.execute('DELETE FROM items')
-    cur.execute('DELETE FROM item_collections')
-    conn.commit()
     # Sincronizar usuario y grupos
     libs = [{"id": USER_ID, "type": "user", "name": "Mi biblioteca"}]
+    groups_ok = True
     try:
-        groups = user_zot.groups()
+        groups = await get_client("user", USER_ID).groups()
         for g in groups:
             libs.append({"id": g["id"], "type": "group", "name": g["data"]["name"]})
     except Exception as e:
+        groups_ok = False
         print(f"Error getting groups: {e}")
-    for lib in libs:
-        lib_type = lib["type"]
-        lib_id = lib["id"]
-        zot = user_zot if lib_type == "user" else group_client(lib_id)
-        # Colecciones
-        try:
-            cols = zot.everything(zot.collections())
-            for col in cols:
-                data = col["data"]
-                insert_collection(
-                    id=col["key"],
-                    name=data["name"],
-                    parent_id=data["parentCollection"] if data.get("parentCollection") else None,
-                    library_type=lib_type,
-                    library_id=lib_id
-                )
-        except Exception as e:
-            print(f"Error synchronizing collections for {lib_type}/{lib_id}: {e}")
-        # Ítems principales (sin attachments ni anotaciones)
-        try:
-            items = zot.everything(zot.top(itemType="-attachment || annotation"))
-            for it in items:
-                data = it.get("data", {})
-                insert_item(
-                    id=it["key"],
-                    title=data.get("title", ""),
-                    library_type=lib_type,
-                    library_id=lib_id,
-                    metadata=json.dumps(data)
-                )
-                col_keys = data.get("collections", [])
-                for col_id in col_keys:
-                    insert_item_collection(
-                        item_id=it["key"],
-                        collection_id=col_id,
-                        library_type=lib_type,
-                        library_id=lib_id
-                    )
-        except Exception as e:
-            print(f"Error synchronizing items for {lib_type}/{lib_id}: {e}")
-        # Attachments independientes
-        try:
-            attachments = zot.everything(zot.items(itemType="attachment"))
-            cur.execute('SELECT id FROM items WHERE library_type=? AND library_id=?', (lib_type, lib_id))
-            existing_items = set(row[0] for row in cur.fetchall())
-            for att in attachments:
-                data = att.get("data", {})
-                parent = data.get("parentItem")
-                if not parent or parent not in existing_items:
-                    insert_item(
-                        id=att["key"],
-                        title=data.get("title", data.get("filename", "(Attachment)")),
-                        library_type=lib_type,
-                        library_id=lib_id,
-                        metadata=json.dumps(data)
-                    )
-                    col_keys = data.get("collections", [])
-                    for col_id in col_keys:
-                        insert_item_collection(
-                            item_id=att["key"],
-                            collection_id=col_id,
-                            library_type=lib_type,
-                            library_id=lib_id
-                        )
-        except Exception as e:
-            print(f"Error synchronizing standalone attachments for {lib_type}/{lib_id}: {e}")
-    conn.close()
+    # La sincronización usa pyzotero en sus propios hilos
+    await asyncio.to_thread(sync_and_prune_libraries, libs, groups_ok, full)
+
+def sync_and_prune_libraries(libs, groups_ok: bool, full: bool = False):
+    from backend.db import delete_library, get_synced_libraries
+    from backend.sync import load_library_state, sync_libraries
+    # Cada descarga usa su propio cliente (ver backend/sync.py)
+    sync_libraries(libs, new_sync_client, full=full)
+    # Eliminar bibliotecas (grupos) a las que ya no se tiene acceso
+    if groups_ok:
+        current = {(lib["type"], str(lib["id"])) for lib in libs}
+        for lib_type, lib_id in get_synced_libraries():
+            if (lib_type, str(lib_id)) not in current:
+                print(f"Removing stale library {lib_type}/{lib_id} from SQLite")
+                delete_library(lib_type, lib_id)
+    load_library_state()
     print("SQLite synchronization completed.")
 
+@app.get("/api/sync/status")
+def sync_status():
+    """
+    Estado de la sincronización: progreso, tiempos y errores por biblioteca
+    de la pasada en curso o de la última, y en `stored` la versión y la fecha
+    de los datos que hay ahora en SQLite. En `zotero_api`, los contadores del
+    cliente de la API web (peticiones, 304 y reintentos).
+    """
+    from backend.sync import get_sync_status
+    return {**get_sync_status(), "zotero_api": client_stats()}
+
 @app.post("/api/refresh-libraries") # Using POST for action
-def refresh_libraries():
-    """Forces library cache update, deletes item caches, and synchronizes SQLite."""
+async def refresh_libraries(full: bool = False):
+    """Forces library cache update and synchronizes SQLite (the item listings are served from it).
+    SQLite sync is incremental unless full=true is passed."""
     global cached_libraries
-    fetch_libraries_from_zotero() # Fetches and saves library cache
-
-    # Clear item caches
-    print("Deleting item caches...")
-    deleted_count = 0
-    try:
-        cache_pattern = str(CACHE_DIR / "items_*.json")
-        for f in glob.glob(cache_pattern):
-            if Path(f).name.startswith("items_"):
-                try:
-                    os.remove(f)
-                    deleted_count += 1
-                    print(f"Deleted: {f}")
-                except OSError as e:
-                    print(f"Error deleting cache file {f}: {e}")
-    except Exception as e:
-        print(f"Error searching for item cache files: {e}")
+    await fetch_libraries_from_zotero() # Fetches and saves library cache
 
     # Sincronizar SQLite
     print("Synchronizing SQLite database...")
-    sync_sqlite_from_zotero()
+    await sync_sqlite_from_zotero(full=full)
+
+    return {"message": "Library cache updated. SQLite synchronized."}
 
-    return {"message": f"Library cache updated. {deleted_count} item caches deleted. SQLite synchronized."}
+async def library_items(lib_type: str, lib_id: str, request: Request, resolver: ChildrenResolver,
+                        collection_key: str = None):
+    """
+    Listado de ítems desde SQLite. El ETag es la versión de la biblioteca
+    sincronizada: mientras no cambie, el cliente recibe un 304. Si la
+    biblioteca aún no se ha sincronizado nunca, se pide a Zotero.
+    """
+    from backend.db import get_listing_items
+    from backend.sync import library_state
+    state = library_state(lib_type, lib_id)
+    if state is None:
+        return await fetch_items_from_zotero(lib_type, lib_id, collection_key, resolver)
+    etag = f'W/"{state[0]}{f"-{collection_key}" if collection_key else ""}"'
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    rows = await asyncio.to_thread(get_listing_items, lib_type, lib_id, collection_key)
+    return JSONResponse([format_listing_item(row) for row in rows], headers={"ETag": etag})
 
 
 @app.get("/api/libraries/{lib_type}/{lib_id}/items")
-def items(lib_type: str, lib_id: str):
-    """Devuelve los ítems principales de una biblioteca (desde caché si es posible)."""
-    cached_items = load_items_cache(lib_type, lib_id)
-    if cached_items is not None:
-        return cached_items
-    else:
-        # Fetch from Zotero, cache, and return
-        return fetch_and_cache_items(lib_type, lib_id)
+async def items(lib_type: str, lib_id: str, request: Request, resolver: ChildrenResolver = Depends(children_resolver)):
+    """Devuelve los ítems principales de una biblioteca (desde SQLite)."""
+    return await library_items(lib_type, lib_id, request, resolver)
 
 @app.get("/api/libraries/{lib_type}/{lib_id}/items/{item_key}")
-def item_detail(lib_type: str, lib_id: str, item_key: str):
-    zot = user_zot if lib_type == "user" else group_client(lib_id)
+async def item_detail(lib_type: str, lib_id: str, item_key: str,
+                      resolver: ChildrenResolver = Depends(children_resolver)):
     try:
-        item = zot.item(item_key)
+        item, children = await asyncio.gather(resolver.client.item(item_key), resolver.children(item_key))
         data = item[0]['data'] if isinstance(item, list) else item['data']
         # Obtener tags y adjuntos
         tags = data.get('tags', [])
-        children = zot.children(item_key)
         
         # Filtrar adjuntos - primero identificamos todos los attachments
         attachments = [child for child in children if child.get('data', {}).get('itemType') == 'attachment']
@@ -432,10 +389,9 @@ def item_detail(lib_type: str, lib_id: str, item_key: str):
         raise HTTPException(404, "Elemento no encontrado")
 
 @app.get("/api/libraries/{lib_type}/{lib_id}/collections")
-def collections(lib_type: str, lib_id: str):
-    zot = user_zot if lib_type == "user" else group_client(lib_id)
+async def collections(lib_type: str, lib_id: str):
     try:
-        cols = zot.collections()
+        cols = await get_client(lib_type, lib_id).collections()
         # Estructura esperada por el frontend: key, data, meta
         sorted_cols = sorted(cols, key=lambda x: x['data']['name'].lower())
         return [
@@ -450,10 +406,9 @@ def collections(lib_type: str, lib_id: str):
         raise HTTPException(status_code=500, detail="Error al recuperar colecciones")
 
 @app.get("/api/libraries/{lib_type}/{lib_id}/collections/{collection_key}/subcollections")
-def subcollections(lib_type: str, lib_id: str, collection_key: str):
-    zot = user_zot if lib_type == "user" else group_client(lib_id)
+async def subcollections(lib_type: str, lib_id: str, collection_key: str):
     try:
-        sub_cols = zot.collections_sub(collection_key)
+        sub_cols = await get_client(lib_type, lib_id).collections_sub(collection_key)
         sorted_sub_cols = sorted(sub_cols, key=lambda x: x['data']['name'].lower())
         return [
             {
@@ -467,181 +422,134 @@ def subcollections(lib_type: str, lib_id: str, collection_key: str):
         raise HTTPException(status_code=500, detail="Error al recuperar subcolecciones")
 
 @app.get("/api/libraries/{lib_type}/{lib_id}/collections/{collection_key}/items")
-def collection_items(lib_type: str, lib_id: str, collection_key: str):
-    """Devuelve los ítems de una colección específica (desde caché si es posible)."""
-    cached_items = load_items_cache(lib_type, lib_id, collection_key)
-    if cached_items is not None:
-        return cached_items
-    else:
-        # Fetch from Zotero, cache, and return
-        return fetch_and_cache_items(lib_type, lib_id, collection_key)
+async def collection_items(lib_type: str, lib_id: str, collection_key: str, request: Request,
+                           resolver: ChildrenResolver = Depends(children_resolver)):
+    """Devuelve los ítems de una colección específica (desde SQLite)."""
+    return await library_items(lib_type, lib_id, request, resolver, collection_key)
 
-@app.get("/api/libraries/{lib_type}/{lib_id}/attachments/{attachment_key}/file")
-async def get_attachment_file(lib_type: str, lib_id: str, attachment_key: str, background_tasks: BackgroundTasks): # Changed to async def
-    webdav_url = os.getenv("WEBDAV_URL")
-    webdav_user = os.getenv("WEBDAV_USER")
-    webdav_pass = os.getenv("WEBDAV_PASS")
-    zot = user_zot if lib_type == "user" else group_client(lib_id)
+# La URL del adjunto no cambia con su contenido: el navegador puede guardarlo
+# pero debe revalidarlo (If-None-Match) antes de reutilizarlo
+ATTACHMENT_CACHE_CONTROL = "private, no-cache"
 
-    # 1. Get attachment metadata first to determine filename and content type
-    try:
-        item = zot.item(attachment_key) # This might block, consider async library if performance is critical
-        if not item or 'data' not in item or not item['data'].get('filename'):
+@app.get("/api/libraries/{lib_type}/{lib_id}/attachments/{attachment_key}/file")
+async def get_attachment_file(lib_type: str, lib_id: str, attachment_key: str, request: Request, background_tasks: BackgroundTasks): # Changed to async def
+    # 1. Metadatos del adjunto desde SQLite (sincronizados); solo si no están
+    # se pregunta a Zotero
+    info = await asyncio.to_thread(get_attachment_info, attachment_key, lib_type, lib_id)
+    if not info or not info.get("filename"):
+        try:
+            item = await get_client(lib_type, lib_id).item(attachment_key)
+        except Exception as e:
+            print(f"Error fetching Zotero metadata for {attachment_key}: {e}")
+            if isinstance(e, ZoteroError) and e.status_code == 404:
+                raise HTTPException(404, f"Adjunto {attachment_key} no encontrado en Zotero: {e}")
+            raise HTTPException(500, f"Error al obtener metadatos del adjunto desde Zotero: {e}")
+        data = (item or {}).get('data', {})
+        if not data.get('filename'):
             print(f"Metadata for attachment {attachment_key} not found or missing filename.")
             raise HTTPException(404, "Metadatos del adjunto no encontrados o incompletos.")
+        info = {"filename": data['filename'], "content_type": data.get('contentType'),
+                "md5": data.get('md5'), "mtime": data.get('mtime'), "version": item.get('version')}
+
+    filename = info['filename']
+    content_type = info.get('content_type') or 'application/octet-stream'
+
+    # El md5 de Zotero identifica el contenido: si el cliente ya tiene esa
+    # versión basta con un 304, sin tocar el disco ni descargar nada
+    if info.get('md5'):
+        etag = file_etag(None, info['md5'])
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": ATTACHMENT_CACHE_CONTROL})
+
+    # 2. La copia del almacén local se sirve sin más si es de la versión actual
+    # (md5 de Zotero); si no, se descarga (WebDAV y si no Zotero Storage)
+    local_path = await ensure_downloaded(lib_type, lib_id, attachment_key, filename,
+                                         md5=info.get('md5'), mtime=info.get('mtime'))
+    # Trigger Markdown generation in background if .txt does not exist
+    txt_path = local_path.with_suffix('.txt')
+    if not txt_path.exists():
+        background_tasks.add_task(generate_md_for_pdf, store.relative(local_path))
+    etag = file_etag(local_path, info.get('md5'))
+    headers = {"ETag": etag, "Cache-Control": ATTACHMENT_CACHE_CONTROL}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    # FileResponse atiende Range/If-Range (pdf.js pide el PDF por trozos)
+    return FileResponse(path=local_path, media_type=content_type, filename=filename, headers=headers)
+
+@app.post("/api/libraries/{lib_type}/{lib_id}/attachments/{attachment_key}/pin")
+def pin_attachment(lib_type: str, lib_id: str, attachment_key: str, pinned: bool = True):
+    """Fija (o con pinned=false suelta) la copia local de un adjunto para que no se borre al liberar espacio."""
+    if not store.set_pinned(lib_type, lib_id, attachment_key, pinned):
+        raise HTTPException(404, "El adjunto no tiene copia local")
+    return {"attachment_key": attachment_key, "pinned": pinned}
+
+class PrefetchRequest(BaseModel):
+    lib_type: str
+    lib_id: str
+    collection_id: str | None = None  # None: toda la biblioteca
+    recursive: bool = True
+    concurrency: int = 4
+    markdown: bool = True  # generar el .txt de cada PDF al terminar su descarga
+
+@app.post("/api/prefetch")
+async def start_prefetch(req: PrefetchRequest):
+    """Descarga en segundo plano los PDFs de una biblioteca o colección. Devuelve el trabajo creado."""
+    return await prefetch.start_job(req.lib_type, req.lib_id, req.collection_id, req.recursive,
+                                    req.concurrency, req.markdown)
+
+@app.get("/api/prefetch")
+def list_prefetch_jobs():
+    return prefetch.list_jobs()
+
+@app.get("/api/prefetch/{job_id}")
+def get_prefetch_job(job_id: str):
+    """Progreso de un trabajo de precarga."""
+    job = prefetch.get_job(job_id)
+    if job is None:
+        raise HTTPException(404, "Trabajo de precarga no encontrado")
+    return job
+
+@app.delete("/api/prefetch/{job_id}")
+def cancel_prefetch_job(job_id: str):
+    if not prefetch.cancel_job(job_id):
+        raise HTTPException(404, "No hay ningún trabajo de precarga en curso con ese id")
+    return {"id": job_id, "state": "cancelling"}
+
+@app.get("/api/downloads/stats")
+def downloads_stats():
+    """Aciertos, fallos y desalojos del almacén local, espacio usado y descargas en curso."""
+    return {**store.stats(), "downloads": download_stats()}
+
+@app.get("/api/{provider}/list-local-pdfs", response_model=list[str])
+def list_local_pdfs(provider: str):
+    """PDF descargados que se pueden mandar a un proveedor de LLM (igual para todos)."""
+    if provider not in LLM_PROVIDERS:
+        raise HTTPException(status_code=404, detail=f"Proveedor desconocido: {provider}")
+    # Rutas relativas a la carpeta de descargas ({key}_{md5}/fichero.pdf, ver backend/store.py)
+    return store.list_pdfs()
+
+@app.get("/api/llm/metrics")
+def llm_metrics():
+    """
+    Peticiones, errores, reintentos, latencias y tokens por proveedor de LLM,
+    uso de la caché de respuestas, de los ficheros subidos a los proveedores
+    y de la recuperación de pasajes.
+    """
+    return {**llm_gateway_metrics(), "cache": llm_cache.stats(), "files": llm_files.stats(),
+            "retrieval": retrieval.stats()}
 
-        filename = item['data']['filename']
-        content_type = item['data'].get('contentType', 'application/octet-stream')
-        local_path = DOWNLOADS_DIR / filename
-        print(f"Checking for local file: {local_path}")
-
-    except Exception as e:
-        print(f"Error fetching Zotero metadata for {attachment_key}: {e}")
-        # Check if it's a pyzotero specific error for not found?
-        if "404" in str(e): # Basic check
-            raise HTTPException(404, f"Adjunto {attachment_key} no encontrado en Zotero: {e}")
-        else:
-            raise HTTPException(500, f"Error al obtener metadatos del adjunto desde Zotero: {e}")
-
-    # 2. Check if file exists locally
-    if local_path.exists():
-        print(f"Serving existing local file: {local_path}")
-        # Trigger Markdown generation in background if .txt does not exist
-        txt_path = local_path.with_suffix('.txt')
-        if not txt_path.exists():
-            background_tasks.add_task(generate_md_for_pdf, local_path.name)
-        return FileResponse(path=local_path, media_type=content_type, filename=filename)
-
-    # 3. File not found locally, proceed to download
-    print(f"Local file not found. Attempting download for: {filename}")
-
-    # --- Try WebDAV first if configured ---
-    if webdav_url and webdav_user and webdav_pass:
-        print(f"Attempting download from WebDAV for {attachment_key}")
-        file_url = f"{webdav_url}/zotero/{attachment_key}.zip"
-        try:
-            # Use httpx for async requests
-            import httpx
-            async with httpx.AsyncClient(auth=(webdav_user, webdav_pass), timeout=30.0) as client: # Increased timeout
-                response = await client.get(file_url)
-                response.raise_for_status() # Raise HTTPError for bad responses
-
-            if response.status_code == 200:
-                try:
-                    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
-                        # Find the correct file within the zip (matching the expected filename)
-                        target_entry = None
-                        for name in zf.namelist():
-                             # Normalize names for comparison if needed, or check if filename is exactly in namelist
-                             # Simple check: if the expected filename is directly in the zip
-                             if name == filename:
-                                 target_entry = name
-                                 break
-                             # Add more robust matching if needed (e.g., case-insensitive, ignoring paths)
-
-                        if target_entry:
-                            file_data = zf.read(target_entry)
-                            # Save file locally (ensure directory exists)
-                            DOWNLOADS_DIR.mkdir(parents=True, exist_ok=True)
-                            try:
-                                with open(local_path, 'wb') as f:
-                                    f.write(file_data)
-                                print(f"File downloaded from WebDAV and saved locally: {local_path}")
-                                # Trigger Markdown generation in background if .txt does not exist
-                                txt_path = local_path.with_suffix('.txt')
-                                if not txt_path.exists():
-                                    background_tasks.add_task(generate_md_for_pdf, local_path.name)
-                                # Serve the newly saved local file
-                                return FileResponse(path=local_path, media_type=content_type, filename=filename)
-                            except IOError as e:
-                                print(f"Error saving file locally {local_path} after WebDAV download: {e}")
-                                raise HTTPException(status_code=500, detail=f"Error al guardar el archivo localmente tras descarga WebDAV: {e}")
-                        else:
-                             print(f"File '{filename}' not found inside ZIP for attachment {attachment_key}")
-                             # Decide: Fallback to Zotero Storage or raise error?
-                             # For now, let's try Zotero Storage if WebDAV zip didn't contain the expected file.
-                             print("Falling back to Zotero Storage download.")
-                             # The code will naturally fall through to the Zotero Storage section below
-
-                except zipfile.BadZipFile:
-                    print(f"Error: Bad ZIP file for attachment {attachment_key} from {file_url}")
-                    # Fallback to Zotero Storage? Or raise error? Let's try Zotero Storage.
-                    print("Falling back to Zotero Storage download due to bad ZIP.")
-                    # Fall through
-                except Exception as e:
-                    print(f"Error processing ZIP for attachment {attachment_key}: {e}")
-                    # Fallback to Zotero Storage? Or raise error? Let's try Zotero Storage.
-                    print(f"Falling back to Zotero Storage download due to ZIP processing error: {e}")
-                    # Fall through
-
-            # If status code was not 200 (and didn't raise for status for some reason)
-            # or if the specific file wasn't found in the zip, we might fall through here.
-            # Let's add explicit print if WebDAV download failed before Zotero attempt.
-            print(f"WebDAV download attempt failed or did not yield the file '{filename}'. Status: {response.status_code if 'response' in locals() else 'N/A'}")
-
-
-        except httpx.RequestError as e:
-            print(f"Error accessing WebDAV for attachment {attachment_key}: {e}")
-            # Fallback to Zotero Storage if WebDAV connection fails
-            print("Falling back to Zotero Storage download due to WebDAV connection error.")
-            # Fall through
-        except httpx.HTTPStatusError as e:
-             print(f"HTTP error accessing WebDAV for attachment {attachment_key}: {e.response.status_code} - {e.response.text}")
-             if e.response.status_code == 404:
-                 print(f"Attachment zip {attachment_key}.zip not found on WebDAV.")
-             # Fallback to Zotero Storage if WebDAV request fails
-             print("Falling back to Zotero Storage download due to WebDAV HTTP error.")
-             # Fall through
-
-
-    # --- Fallback to Zotero Storage ---
-    # This section is reached if:
-    # 1. WebDAV is not configured.
-    # 2. WebDAV download failed (connection error, HTTP error, bad zip, file not in zip).
-    print(f"Attempting download from Zotero Storage for: {filename}")
-    try:
-        # Download file content from Zotero (this might block)
-        # Consider using an async Zotero library if this becomes a bottleneck
-        file_content = zot.file(attachment_key) # This gets the raw content
-        if not file_content:
-            print(f"Could not download file content for {filename} ({attachment_key}) from Zotero.")
-            raise HTTPException(404, "No se pudo descargar el contenido del adjunto desde Zotero.")
-
-        # Save file locally (ensure directory exists)
-        DOWNLOADS_DIR.mkdir(parents=True, exist_ok=True)
-        try:
-            with open(local_path, 'wb') as f:
-                f.write(file_content)
-            print(f"File downloaded from Zotero Storage and saved locally: {local_path}")
-            # Trigger Markdown generation in background if .txt does not exist
-            txt_path = local_path.with_suffix('.txt')
-            if not txt_path.exists():
-                background_tasks.add_task(generate_md_for_pdf, local_path.name)
-            # Serve the newly saved local file
-            return FileResponse(path=local_path, media_type=content_type, filename=filename)
-        except IOError as e:
-            print(f"Error saving file locally {local_path} after Zotero download: {e}")
-            raise HTTPException(status_code=500, detail=f"Error al guardar el archivo localmente tras descarga Zotero: {e}")
-
-    except Exception as e:
-        # Catch potential exceptions from pyzotero or file operations
-        print(f"Error fetching/processing attachment {attachment_key} from Zotero Storage: {e}")
-        if "404" in str(e): # Basic check
-            raise HTTPException(404, f"Adjunto {attachment_key} no encontrado en Zotero Storage: {e}")
-        else:
-            raise HTTPException(500, f"Error al obtener el adjunto desde Zotero Storage: {e}")
-
-    # If all methods failed (e.g., WebDAV failed AND Zotero Storage failed)
-    print(f"All methods failed to retrieve attachment {attachment_key} ({filename})")
-    raise HTTPException(status_code=404, detail="No se pudo obtener el adjunto por ningún método.")
+@app.delete("/api/llm/cache")
+async def clear_llm_cache():
+    """Vacía la caché de respuestas de los LLM (Redis y SQLite)."""
+    return {"removed": await llm_cache.clear()}
 
 
 # --- Endpoints para notas y anotaciones ---
 
 @app.get("/api/libraries/{lib_type}/{lib_id}/items/{item_key}/notes")
-def get_notes_and_annotations(lib_type: str, lib_id: str, item_key: str):
-    zot = user_zot if lib_type == "user" else group_client(lib_id)
-    children = zot.children(item_key)
+async def get_notes_and_annotations(lib_type: str, lib_id: str, item_key: str,
+                                    resolver: ChildrenResolver = Depends(children_resolver)):
+    children = await resolver.children(item_key)
     notes = [c for c in children if c['data']['itemType'] == 'note']
     annotations = [c for c in children if c['data']['itemType'] == 'annotation']
     return {
@@ -651,42 +559,27 @@ def get_notes_and_annotations(lib_type: str, lib_id: str, item_key: str):
 
 # --- New Endpoint to Clear Downloads ---
 @app.post("/api/clear-downloads")
-def clear_downloads():
-    """Deletes all files in the downloads directory."""
-    deleted_count = 0
-    errors = []
+def clear_downloads(all: bool = False):
+    """Deletes the local copies of attachments. Pinned and annotated documents are kept unless all=true."""
     print(f"Attempting to delete files in: {DOWNLOADS_DIR}")
     if not DOWNLOADS_DIR.exists() or not DOWNLOADS_DIR.is_dir():
         print("Downloads directory does not exist.")
         return {"message": "Downloads directory does not exist.", "deleted_count": 0}
-
     try:
-        for item in DOWNLOADS_DIR.iterdir():
-            if item.is_file():
-                try:
-                    item.unlink() # Delete the file
-                    deleted_count += 1
-                    print(f"Deleted: {item.name}")
-                except OSError as e:
-                    error_msg = f"Error deleting file {item.name}: {e}"
-                    print(error_msg)
-                    errors.append(error_msg)
-    except Exception as e:
-        error_msg = f"Unexpected error while iterating downloads directory: {e}"
+        deleted_count = store.clear(include_protected=all)
+    except OSError as e:
+        error_msg = f"Unexpected error while clearing downloads directory: {e}"
         print(error_msg)
         raise HTTPException(status_code=500, detail=error_msg)
-
-    if errors:
-        return {
-            "message": f"Process completed with errors. {deleted_count} files deleted.",
-            "deleted_count": deleted_count,
-            "errors": errors
-        }
-    else:
-        return {"message": f"All files ({deleted_count}) in the downloads directory have been deleted.", "deleted_count": deleted_count}
+    return {"message": f"{deleted_count} downloaded documents deleted.", "deleted_count": deleted_count}
 
 # --- End New Endpoint ---
 
+@app.get("/api/sqlite/pool-stats")
+def sqlite_pool_stats():
+    """Métricas del pool de conexiones de lectura (aciertos, fallos, conexiones ociosas)."""
+    return read_pool_stats()
+
 @app.get("/api/sqlite/libraries/{lib_type}/{lib_id}/collections")
 def sqlite_collections(lib_type: str, lib_id: str):
     """Devuelve todas las colecciones (y subcolecciones) desde SQLite."""
@@ -696,64 +589,123 @@ def sqlite_collections(lib_type: str, lib_id: str):
         {"id": row[0], "name": row[1], "parent_id": row[2]} for row in rows
     ]
 
+# Campos que pueden pedirse con ?fields= en los listados de ítems SQLite
+SQLITE_ITEM_FIELDS = ("id", "key", "title", "metadata", "hasAttachment", "itemType", "creators",
+                      "date", "year", "tags", "publisher", "publicationTitle")
+
+def parse_item_fields(fields: str | None):
+    """Convierte ?fields=a,b,c en un conjunto validado (None = todos los campos)."""
+    if not fields:
+        return None
+    requested = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = requested - set(SQLITE_ITEM_FIELDS)
+    if unknown:
+        raise HTTPException(400, f"Campos desconocidos: {', '.join(sorted(unknown))}")
+    return requested
+
+def wants_metadata(fields) -> bool:
+    """Solo se lee y parsea el JSON de metadata si se pide explícitamente (o no hay proyección)."""
+    return fields is None or "metadata" in fields
+
+def format_sqlite_item(row, fields=None):
+    """Formatea una fila de los listados de ítems (columnas desnormalizadas), proyectando solo `fields` si se indica."""
+    from backend.db import TAG_SEPARATOR
+    item = {
+        "id": row["id"],
+        "key": row["id"],  # Usar el mismo valor para key e id
+        "title": row["title"],
+        "hasAttachment": bool(row["has_attachment"]),
+        "itemType": row["item_type"],
+        "creators": row["creators"],
+        "date": row["date"],
+        "year": row["year"],  # clave de orden (sort=year) y del cursor
+        "tags": row["tags"].split(TAG_SEPARATOR) if row["tags"] else [],
+        "publisher": row["publisher"],
+        "publicationTitle": row["publication_title"]
+    }
+    if wants_metadata(fields):
+        item["metadata"] = json.loads(row["metadata"]) if row["metadata"] else {}
+    if fields is not None:
+        item = {k: v for k, v in item.items() if k in fields}
+    return item
+
+def encode_cursor(sort_value, item_id) -> str:
+    return base64.urlsafe_b64encode(json.dumps([sort_value, item_id]).encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        sort_value, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return sort_value, item_id
+    except Exception:
+        raise HTTPException(400, "Cursor inválido")
+
 @app.get("/api/sqlite/libraries/{lib_type}/{lib_id}/items")
-def sqlite_all_items(lib_type: str, lib_id: str):
-    """Devuelve todos los ítems de una biblioteca desde SQLite."""
-    from backend.db import get_all_items
-    rows = get_all_items(lib_type, lib_id)
-    zot = user_zot if lib_type == "user" else group_client(lib_id)
-    result = []
-    
-    for row in rows:
-        item_id, title, metadata_str = row
-        metadata = json.loads(metadata_str) if metadata_str else {}
-        
-        # Verificar si tiene adjuntos
-        has_attachment = False
-        try:
-            children = zot.children(item_id)
-            for child in children:
-                if child.get('data', {}).get('itemType') == 'attachment':
-                    has_attachment = True
-                    break
-        except Exception as e:
-            print(f"Error verificando adjuntos para ítem {item_id}: {e}")
-        
-        result.append({
-            "id": item_id,
-            "key": item_id,  # Usar el mismo valor para key e id
-            "title": title,
-            "metadata": metadata,
-            "hasAttachment": has_attachment,
-            "itemType": metadata.get("itemType", ""),
-            "creators": format_creators(metadata.get("creators", [])),
-            "date": metadata.get("date", ""),
-            "tags": [t.get('tag') for t in metadata.get("tags", [])],
-            "publisher": metadata.get("publisher", ""),
-            "publicationTitle": metadata.get("publicationTitle", metadata.get("publication", ""))
-        })
-    
-    return result
+def sqlite_all_items(lib_type: str, lib_id: str, limit: int | None = None, cursor: str | None = None,
+                     sort: str = "title", desc: bool = False, fields: str | None = None, stream: bool = False,
+                     item_type: str | None = None, tag: str | None = None):
+    """
+    Devuelve los ítems de una biblioteca desde SQLite.
+
+    - Sin `limit` devuelve la lista completa (comportamiento original).
+    - Con `limit` devuelve {"items": [...], "next_cursor": ...}; `cursor` pide la página siguiente.
+    - `sort` (title, key, year, creators, itemType) y `desc` ordenan por columnas indexadas.
+    - `item_type` y `tag` filtran usando índices.
+    - `fields=id,title,...` limita los campos devueltos; sin metadata no se lee el JSON.
+    - `stream=true` devuelve NDJSON (un ítem por línea) a medida que se lee de la base
+      de datos; si quedan más páginas, la última línea es {"next_cursor": ...}.
+    """
+    from backend.db import ITEM_SORT_KEYS, iter_items
+    if sort not in ITEM_SORT_KEYS:
+        raise HTTPException(400, f"sort debe ser uno de: {', '.join(ITEM_SORT_KEYS)}")
+    if limit is not None:
+        limit = max(1, min(limit, 5000))
+    field_set = parse_item_fields(fields)
+    after = decode_cursor(cursor) if cursor else None
+    # Se pide una fila de más para saber si hay página siguiente
+    rows = iter_items(lib_type, lib_id, sort=sort, descending=desc, after=after,
+                      limit=limit + 1 if limit is not None else None,
+                      with_metadata=wants_metadata(field_set), item_type=item_type, tag=tag)
+
+    def page():
+        """Genera (ítem, None) y, si hay más páginas, (None, next_cursor) al final."""
+        last = None
+        for count, row in enumerate(rows):
+            if limit is not None and count == limit:
+                yield None, encode_cursor(last[0], last[1])
+                return
+            last = (row["sort_value"], row["id"])
+            yield format_sqlite_item(row, field_set), None
+
+    if stream:
+        def ndjson():
+            for item, next_cursor in page():
+                line = item if item is not None else {"next_cursor": next_cursor}
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    items, next_cursor = [], None
+    for item, nc in page():
+        if item is not None:
+            items.append(item)
+        else:
+            next_cursor = nc
+    if limit is None:
+        return items
+    return {"items": items, "next_cursor": next_cursor}
 
 @app.get("/api/sqlite/libraries/{lib_type}/{lib_id}/collections/{collection_id}/subcollections")
-def sqlite_subcollections(lib_type: str, lib_id: str, collection_id: str):
+def sqlite_subcollections(lib_type: str, lib_id: str, collection_id: str, conn=Depends(get_read_db)):
     """Devuelve las subcolecciones de una colección desde SQLite, incluyendo el número de subcolecciones hijas."""
-    from backend.db import get_connection
-    rows = get_subcollections(collection_id, lib_type, lib_id)
-    result = []
-    conn = get_connection()
-    cur = conn.cursor()
-    for row in rows:
-        sub_id, sub_name = row
-        cur.execute('''SELECT COUNT(*) FROM collections WHERE parent_id=? AND library_type=? AND library_id=?''', (sub_id, lib_type, lib_id))
-        num = cur.fetchone()[0]
-        result.append({
-            "id": sub_id,
-            "name": sub_name,
-            "numCollections": num
-        })
-    conn.close()
-    return result
+    rows = conn.execute('''
+        SELECT c.id, c.name,
+               (SELECT COUNT(*) FROM collections s
+                WHERE s.parent_id = c.id AND s.library_type = c.library_type AND s.library_id = c.library_id)
+        FROM collections c WHERE c.parent_id=? AND c.library_type=? AND c.library_id=?
+    ''', (collection_id, lib_type, lib_id)).fetchall()
+    return [
+        {"id": sub_id, "name": sub_name, "numCollections": num}
+        for sub_id, sub_name, num in rows
+    ]
 
 @app.get("/api/sqlite/libraries/{lib_type}/{lib_id}/collections/{collection_id}/items")
 def sqlite_collection_items(lib_type: str, lib_id: str, collection_id: str):
@@ -764,70 +716,38 @@ def sqlite_collection_items(lib_type: str, lib_id: str, collection_id: str):
     ]
 
 @app.get("/api/sqlite/libraries/{lib_type}/{lib_id}/collections/{collection_id}/items_recursive")
-def sqlite_collection_items_recursive(lib_type: str, lib_id: str, collection_id: str, recursive: bool = True):
-    """Devuelve los ítems de una colección y, si recursive=True, de todas sus subcolecciones (sin duplicados)."""
-    from backend.db import get_items_for_collection, get_subcollections
-    zot = user_zot if lib_type == "user" else group_client(lib_id)
-    seen = set()
-    result = []
-    
-    def collect_items(col_id):
-        rows = get_items_for_collection(col_id, lib_type, lib_id)
-        for row in rows:
-            item_id, title, metadata_str = row
-            if item_id not in seen:
-                seen.add(item_id)
-                metadata = json.loads(metadata_str) if metadata_str else {}
-                
-                # Verificar si tiene adjuntos
-                has_attachment = False
-                try:
-                    children = zot.children(item_id)
-                    for child in children:
-                        if child.get('data', {}).get('itemType') == 'attachment':
-                            has_attachment = True
-                            break
-                except Exception as e:
-                    print(f"Error verificando adjuntos para ítem {item_id}: {e}")
-                
-                result.append({
-                    "id": item_id,
-                    "key": item_id,  # Usar el mismo valor para key e id
-                    "title": title,
-                    "metadata": metadata,
-                    "hasAttachment": has_attachment,
-                    "itemType": metadata.get("itemType", ""),
-                    "creators": format_creators(metadata.get("creators", [])),
-                    "date": metadata.get("date", ""),
-                    "tags": [t.get('tag') for t in metadata.get("tags", [])],
-                    "publisher": metadata.get("publisher", ""),
-                    "publicationTitle": metadata.get("publicationTitle", metadata.get("publication", ""))
-                })
-        
-        if recursive:
-            for subcol in get_subcollections(col_id, lib_type, lib_id):
-                collect_items(subcol[0])
-    
-    collect_items(collection_id)
-    return result
+def sqlite_collection_items_recursive(lib_type: str, lib_id: str, collection_id: str, recursive: bool = True,
+                                      fields: str | None = None, item_type: str | None = None, tag: str | None = None):
+    """Devuelve los ítems de una colección y, si recursive=True, de todas sus subcolecciones (sin duplicados).
+    `fields=id,title,...` limita los campos devueltos; `item_type` y `tag` filtran."""
+    from backend.db import get_items_for_collection, get_items_recursive
+    field_set = parse_item_fields(fields)
+    query = get_items_recursive if recursive else get_items_for_collection
+    rows = query(collection_id, lib_type, lib_id, with_metadata=wants_metadata(field_set), item_type=item_type, tag=tag)
+    return [format_sqlite_item(row, field_set) for row in rows]
 
 @app.get("/api/sqlite/libraries/{lib_type}/{lib_id}/items/search")
-def sqlite_search_items(lib_type: str, lib_id: str, q: str):
-    """Busca ítems por texto en SQLite."""
-    rows = search_items(q, lib_type, lib_id)
+def sqlite_search_items(lib_type: str, lib_id: str, q: str, limit: int = 50, offset: int = 0):
+    """Búsqueda de texto completo (título, autores, resumen, etiquetas, publicación y texto del PDF), ordenada por relevancia."""
+    limit = max(1, min(limit, 200))
+    rows = search_items(q, lib_type, lib_id, limit=limit, offset=max(0, offset))
     return [
-        {"id": row[0], "title": row[1], "metadata": row[2]} for row in rows
+        {
+            "id": row[0],
+            "key": row[0],
+            "title": row[1],
+            "metadata": row[2],
+            "hasAttachment": bool(row[3]),
+            "score": row[4],
+            "snippet": row[5]
+        } for row in rows
     ]
 
 @app.get("/api/sqlite/libraries/{lib_type}/{lib_id}/items/{item_id}")
-def sqlite_item_detail(lib_type: str, lib_id: str, item_id: str):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute('''
+def sqlite_item_detail(lib_type: str, lib_id: str, item_id: str, conn=Depends(get_read_db)):
+    row = conn.execute('''
         SELECT id, title, metadata FROM items WHERE id=? AND library_type=? AND library_id=?
-    ''', (item_id, lib_type, lib_id))
-    row = cur.fetchone()
-    conn.close()
+    ''', (item_id, lib_type, lib_id)).fetchone()
     
     if not row:
         raise HTTPException(404, "Ítem no encontrado en SQLite")
@@ -835,43 +755,27 @@ def sqlite_item_detail(lib_type: str, lib_id: str, item_id: str):
     # metadata es un string JSON, lo parseamos si existe
     metadata = json.loads(row[2]) if row[2] else {}
     
-    # Consultar los attachments directamente a Zotero para asegurarnos de tener la información más actualizada
-    zot = user_zot if lib_type == "user" else group_client(lib_id)
-    try:
-        children = zot.children(item_id)
-        
-        # Filtrar adjuntos - solo mantener PDFs cuando hay múltiples adjuntos
-        filtered_children = [
-            att for att in children 
-            if att.get('data', {}).get('itemType') == 'attachment'
-        ]
-        
-        # Si hay más de un adjunto, filtrar solo por PDFs
-        if len(filtered_children) > 1:
-            pdf_attachments = [
-                att for att in filtered_children
-                if att.get('data', {}).get('contentType') == 'application/pdf'
-            ]
-            # Si encontramos PDFs, usamos solo esos, de lo contrario mantenemos todos los adjuntos
-            if pdf_attachments:
-                total_attachments = len(filtered_children)
-                filtered_children = pdf_attachments
-                pdf_count = len(filtered_children)
-                print(f"Item {item_id}: Filtered to {pdf_count} PDF attachments from {total_attachments} total attachments")
-                
-        # Formatear la lista de adjuntos
-        attachments = [
-            {
-                "key": att['key'],
-                "title": att['data'].get('title', ''),
-                "filename": att['data'].get('filename', ''),
-                "contentType": att['data'].get('contentType', '')
-            }
-            for att in filtered_children
-        ]
-    except Exception as e:
-        print(f"Error obteniendo adjuntos para el ítem {item_id}: {e}")
-        attachments = []
+    # Adjuntos precalculados durante la sincronización (tabla attachments)
+    from backend.db import get_attachments
+    filtered_children = get_attachments(item_id, lib_type, lib_id)
+    
+    # Si hay más de un adjunto, filtrar solo por PDFs
+    if len(filtered_children) > 1:
+        pdf_attachments = [att for att in filtered_children if att[3] == 'application/pdf']
+        # Si encontramos PDFs, usamos solo esos, de lo contrario mantenemos todos los adjuntos
+        if pdf_attachments:
+            filtered_children = pdf_attachments
+    
+    # Formatear la lista de adjuntos
+    attachments = [
+        {
+            "key": att[0],
+            "title": att[1] or '',
+            "filename": att[2] or '',
+            "contentType": att[3] or ''
+        }
+        for att in filtered_children
+    ]
     
     return {
         "id": row[0],
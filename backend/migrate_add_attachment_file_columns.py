@@ -0,0 +1,39 @@
+"""
+Migración: añade a attachments las columnas md5, mtime y version del fichero.
+
+init_db() la aplica al arrancar; también se puede ejecutar a mano con
+`python -m backend.migrate_add_attachment_file_columns`.
+
+Con ellas el endpoint de ficheros sabe sin llamar a Zotero si la copia local
+está al día. Los adjuntos ya sincronizados no traen estos datos y la
+sincronización incremental no los volvería a pedir, así que la migración
+borra sync_state y fuerza una sincronización completa.
+"""
+
+NEW_COLUMNS = {
+    "md5": "TEXT",
+    "mtime": "INTEGER",
+    "version": "INTEGER",
+}
+
+
+def migrate(conn) -> bool:
+    """Aplica la migración si hace falta. Devuelve True si se ha aplicado."""
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(attachments)")
+    columns = {row[1] for row in cur.fetchall()}
+    missing = {name: decl for name, decl in NEW_COLUMNS.items() if name not in columns}
+    if not missing:
+        return False
+    for name, decl in missing.items():
+        cur.execute(f"ALTER TABLE attachments ADD COLUMN {name} {decl}")
+    cur.execute("DELETE FROM sync_state")
+    conn.commit()
+    print("Migration applied: attachments.md5/mtime/version added, full resync scheduled.")
+    return True
+
+
+if __name__ == "__main__":
+    # Importar backend.db ejecuta init_db(), que aplica esta migración
+    import backend.db  # noqa: F401
+    print("Database schema is up to date.")
@@ -0,0 +1,31 @@
+"""
+Migración: añade la columna items.has_attachment.
+
+init_db() la aplica al arrancar; también se puede ejecutar a mano con
+`python -m backend.migrate_add_has_attachment`.
+
+La tabla attachments la crea init_db(), pero en una base de datos ya
+sincronizada estaría vacía, porque la sincronización incremental solo pide lo
+modificado desde la última versión. Por eso la migración borra sync_state y
+fuerza una sincronización completa en el siguiente arranque.
+"""
+
+
+def migrate(conn) -> bool:
+    """Aplica la migración si hace falta. Devuelve True si se ha aplicado."""
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(items)")
+    columns = {row[1] for row in cur.fetchall()}
+    if "has_attachment" in columns:
+        return False
+    cur.execute("ALTER TABLE items ADD COLUMN has_attachment INTEGER NOT NULL DEFAULT 0")
+    cur.execute("DELETE FROM sync_state")
+    conn.commit()
+    print("Migration applied: items.has_attachment added, full resync scheduled.")
+    return True
+
+
+if __name__ == "__main__":
+    # Importar backend.db ejecuta init_db(), que aplica esta migración
+    import backend.db  # noqa: F401
+    print("Database schema is up to date.")
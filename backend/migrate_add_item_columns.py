@@ -0,0 +1,59 @@
+"""
+Migración: añade a items las columnas desnormalizadas (creators, date, year,
+item_type, publication_title, publisher) y rellena la tabla item_tags.
+
+init_db() la aplica al arrancar; también se puede ejecutar a mano con
+`python -m backend.migrate_add_item_columns`.
+
+Los valores se calculan a partir del JSON de metadata ya guardado, así que no
+hace falta volver a sincronizar con Zotero.
+"""
+import json
+
+from backend.utils import item_fields
+
+NEW_COLUMNS = {
+    "creators": "TEXT NOT NULL DEFAULT ''",
+    "date": "TEXT NOT NULL DEFAULT ''",
+    "year": "INTEGER NOT NULL DEFAULT 0",
+    "item_type": "TEXT NOT NULL DEFAULT ''",
+    "publication_title": "TEXT NOT NULL DEFAULT ''",
+    "publisher": "TEXT NOT NULL DEFAULT ''",
+}
+
+
+def migrate(conn) -> bool:
+    """Aplica la migración si hace falta. Devuelve True si se ha aplicado."""
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(items)")
+    columns = {row[1] for row in cur.fetchall()}
+    missing = {name: decl for name, decl in NEW_COLUMNS.items() if name not in columns}
+    if not missing:
+        return False
+    for name, decl in missing.items():
+        cur.execute(f"ALTER TABLE items ADD COLUMN {name} {decl}")
+    rows = cur.execute("SELECT id, library_type, library_id, metadata FROM items").fetchall()
+    updates, tags = [], []
+    for item_id, library_type, library_id, metadata in rows:
+        fields = item_fields(json.loads(metadata) if metadata else {})
+        updates.append((
+            fields["creators"], fields["date"], fields["year"], fields["item_type"],
+            fields["publication_title"], fields["publisher"], item_id, library_type, library_id,
+        ))
+        tags.extend((item_id, library_type, library_id, tag) for tag in fields["tags"])
+    cur.executemany('''
+        UPDATE items SET creators=?, date=?, year=?, item_type=?, publication_title=?, publisher=?
+        WHERE id=? AND library_type=? AND library_id=?
+    ''', updates)
+    cur.executemany('''
+        INSERT OR IGNORE INTO item_tags (item_id, library_type, library_id, tag) VALUES (?, ?, ?, ?)
+    ''', tags)
+    conn.commit()
+    print(f"Migration applied: denormalized item columns added for {len(rows)} items.")
+    return True
+
+
+if __name__ == "__main__":
+    # Importar backend.db ejecuta init_db(), que aplica esta migración
+    import backend.db  # noqa: F401
+    print("Database schema is up to date.")
@@ -0,0 +1,130 @@
+"""
+Precarga de adjuntos: descarga al almacén local (backend/store.py) los PDFs
+de una biblioteca o colección antes de que alguien los abra, y después
+genera su .txt con markdown_api.
+
+Cada trabajo corre como una tarea asyncio con un número acotado de descargas
+simultáneas. Usa ensure_downloaded, así que comparte las descargas en curso
+con las peticiones de los usuarios y no repite las que ya están en local.
+"""
+import asyncio
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from backend import store
+from backend.db import get_file_attachments
+from backend.downloads import ensure_downloaded
+
+MAX_CONCURRENCY = 8
+# Trabajos terminados que se conservan para poder consultar su resultado
+MAX_FINISHED_JOBS = 20
+
+_jobs = {}
+_tasks = {}
+
+
+def _job_summary(job):
+    return {key: value for key, value in job.items() if key != "errors"} | {"errors": job["errors"][-20:]}
+
+
+def list_jobs() -> list:
+    return [_job_summary(job) for job in _jobs.values()]
+
+
+def get_job(job_id: str):
+    job = _jobs.get(job_id)
+    return _job_summary(job) if job else None
+
+
+def _forget_old_jobs():
+    finished = [job_id for job_id, job in _jobs.items() if job["state"] != "running"]
+    for job_id in finished[:-MAX_FINISHED_JOBS]:
+        del _jobs[job_id]
+
+
+async def start_job(lib_type: str, lib_id: str, collection_id: str | None = None, recursive: bool = True,
+                    concurrency: int = 4, markdown: bool = True) -> dict:
+    """Crea y lanza un trabajo de precarga; vuelve en cuanto tiene la lista de adjuntos."""
+    # En una colección grande la consulta tarda: fuera del event loop
+    attachments = await asyncio.to_thread(get_file_attachments, lib_type, str(lib_id), collection_id, recursive)
+    job_id = uuid.uuid4().hex[:12]
+    job = {
+        "id": job_id,
+        "library_type": lib_type,
+        "library_id": str(lib_id),
+        "collection_id": collection_id,
+        "recursive": recursive,
+        "state": "running",
+        "total": len(attachments),
+        "done": 0,
+        "downloaded": 0,
+        "cached": 0,
+        "failed": 0,
+        "markdown": {"enabled": markdown, "done": 0, "failed": 0},
+        "started_at": time.time(),
+        "finished_at": None,
+        "errors": [],
+    }
+    _forget_old_jobs()
+    _jobs[job_id] = job
+    concurrency = max(1, min(concurrency, MAX_CONCURRENCY))
+    task = asyncio.ensure_future(_run(job, attachments, concurrency, markdown))
+    _tasks[job_id] = task
+    task.add_done_callback(lambda _: _tasks.pop(job_id, None))
+    print(f"Prefetch job {job_id} started: {len(attachments)} attachments from {lib_type}/{lib_id}"
+          f"{f' collection {collection_id}' if collection_id else ''}")
+    return _job_summary(job)
+
+
+def cancel_job(job_id: str) -> bool:
+    task = _tasks.get(job_id)
+    if task is None:
+        return False
+    task.cancel()
+    return True
+
+
+async def _run(job, attachments, concurrency, markdown):
+    downloads = asyncio.Semaphore(concurrency)
+    # La extracción de texto es CPU: de una en una para no acaparar la máquina
+    extraction = asyncio.Semaphore(1)
+
+    async def prefetch_one(key, filename, md5, mtime):
+        async with downloads:
+            try:
+                cached = store.entry_path(key, md5, filename).exists()
+                path = await ensure_downloaded(job["library_type"], job["library_id"],
+                                               key, filename, md5=md5, mtime=mtime)
+                job["cached" if cached else "downloaded"] += 1
+            except Exception as e:
+                job["failed"] += 1
+                job["errors"].append({"attachment": key, "error": getattr(e, "detail", str(e))})
+                return
+            finally:
+                job["done"] += 1
+        if markdown and not path.with_suffix(".txt").exists():
+            async with extraction:
+                await _extract_markdown(job, key, path)
+
+    try:
+        await asyncio.gather(*(prefetch_one(key, filename, md5, mtime)
+                               for key, filename, _, md5, mtime in attachments))
+        job["state"] = "done"
+    except asyncio.CancelledError:
+        job["state"] = "cancelled"
+    finally:
+        job["finished_at"] = time.time()
+        print(f"Prefetch job {job['id']} {job['state']}: {job['downloaded']} downloaded, "
+              f"{job['cached']} already local, {job['failed']} failed.")
+
+
+async def _extract_markdown(job, key, path):
+    from backend.apis.markdown_api import generate_md_for_pdf
+    try:
+        await asyncio.to_thread(generate_md_for_pdf, store.relative(path))
+        job["markdown"]["done"] += 1
+    except HTTPException as e:
+        job["markdown"]["failed"] += 1
+        job["errors"].append({"attachment": key, "error": f"markdown: {e.detail}"})
@@ -0,0 +1,155 @@
+"""
+Recuperación de pasajes de los .txt de markdown_api para /process-pdf.
+
+Meter el texto entero de un libro en cada turno supera el contexto de los
+modelos y multiplica el coste. Los documentos de más de RAG_FULL_TEXT_CHARS
+se parten en fragmentos de unos RAG_CHUNK_CHARS caracteres (por párrafos)
+que se indexan con FTS5 en SQLite (tabla document_chunks). En cada turno se
+mandan solo los RAG_TOP_K fragmentos más relevantes para la pregunta según
+BM25, en el orden del documento y con su página, hasta RAG_MAX_CHARS; así el
+prompt tiene un tamaño acotado sea cual sea la longitud del documento.
+
+Las páginas salen de los saltos de página (\\f) que deja la extracción del
+PDF; si el texto no los tiene, los fragmentos se identifican por su número.
+Si la pregunta no coincide con ningún fragmento ("resume el documento") se
+manda una muestra repartida por todo el documento.
+
+El índice se crea al generar el .txt (markdown_api) o, si no existe, en el
+primer turno sobre el documento. Se identifica por el hash del texto, así que
+un .txt regenerado se vuelve a indexar.
+"""
+import asyncio
+import hashlib
+import os
+import re
+
+from backend import db
+
+RAG_CHUNK_CHARS = int(os.getenv("RAG_CHUNK_CHARS", "1500"))
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "8"))
+RAG_MAX_CHARS = int(os.getenv("RAG_MAX_CHARS", "12000"))
+# Documentos más cortos que esto se siguen mandando enteros
+RAG_FULL_TEXT_CHARS = int(os.getenv("RAG_FULL_TEXT_CHARS", "24000"))
+# Documentos que se conservan indexados (se borran los menos usados)
+RAG_MAX_DOCUMENTS = int(os.getenv("RAG_MAX_DOCUMENTS", "500"))
+
+_stats = {"indexed": 0, "retrievals": 0, "sampled": 0, "full_text": 0, "context_chars": 0}
+
+
+def text_hash(text: str) -> str:
+    """Identificador del contenido de un .txt (el mismo que Document.content_hash)."""
+    return "txt:" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def split_chunks(text: str, size: int = RAG_CHUNK_CHARS) -> list:
+    """
+    Fragmentos de unos `size` caracteres formados por párrafos enteros:
+    [(page_start, page_end, text)]. Sin saltos de página, page_* es None.
+    """
+    pages = text.split("\f")
+    numbered = len(pages) > 1
+    paragraphs = []
+    for number, page in enumerate(pages, start=1):
+        page_number = number if numbered else None
+        for paragraph in re.split(r"\n\s*\n", page):
+            paragraph = paragraph.strip()
+            # Un párrafo enorme (tablas, texto sin saltos de línea) se corta por palabras
+            while len(paragraph) > size:
+                cut = paragraph.rfind(" ", 0, size)
+                cut = cut if cut > size // 2 else size
+                paragraphs.append((page_number, paragraph[:cut].strip()))
+                paragraph = paragraph[cut:].strip()
+            if paragraph:
+                paragraphs.append((page_number, paragraph))
+
+    chunks, current, length = [], [], 0
+    for page_number, paragraph in paragraphs:
+        if current and length + len(paragraph) > size:
+            chunks.append(_chunk(current))
+            current, length = [], 0
+        current.append((page_number, paragraph))
+        length += len(paragraph) + 2
+    if current:
+        chunks.append(_chunk(current))
+    return chunks
+
+
+def _chunk(paragraphs):
+    return paragraphs[0][0], paragraphs[-1][0], "\n\n".join(paragraph for _, paragraph in paragraphs)
+
+
+def index_text(document_hash: str, text: str):
+    """Indexa (o reindexa) el texto de un documento. Devuelve (first_rowid, last_rowid, chunks)."""
+    chunks = split_chunks(text)
+    _stats["indexed"] += 1
+    print(f"Indexed {len(chunks)} passages of document {document_hash[:16]}")
+    return db.replace_document_chunks(document_hash, chunks, RAG_MAX_DOCUMENTS)
+
+
+def index_generated_text(text: str):
+    """
+    Indexa el texto que markdown_api acaba de escribir en el .txt, normalizado
+    como lo leerá load_document (saltos de línea universales). Los documentos
+    cortos no se indexan: se mandan enteros.
+    """
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    if len(text) > RAG_FULL_TEXT_CHARS:
+        try:
+            index_text(text_hash(text), text)
+        except Exception as e:
+            print(f"[ERROR] Could not index the passages of the generated text: {e}")
+
+
+def _label(page_start, page_end, position):
+    if page_start is None:
+        return f"[fragmento {position}]"
+    if page_end is None or page_end == page_start:
+        return f"[p. {page_start}]"
+    return f"[pp. {page_start}-{page_end}]"
+
+
+def _select(document_hash: str, text: str, query: str) -> str:
+    index = db.get_document_index(document_hash)
+    if index:
+        db.touch_document_index(document_hash)
+    else:
+        index = index_text(document_hash, text)
+    first, last, count = index
+    if count == 0:
+        return ""
+    rows = db.search_document_chunks(first, last, query, RAG_TOP_K)
+    if rows:
+        _stats["retrievals"] += 1
+    else:
+        # Sin coincidencias: fragmentos repartidos uniformemente por el documento
+        _stats["sampled"] += 1
+        step = max(1, count // RAG_TOP_K)
+        rows = db.get_document_chunks(list(range(first, last + 1, step))[:RAG_TOP_K])
+    selected, total = [], 0
+    # Se recortan por relevancia (o en orden, en la muestra) y se presentan en el orden del documento
+    for row in rows:
+        if total + len(row[3]) > RAG_MAX_CHARS and selected:
+            break
+        selected.append(row)
+        total += len(row[3])
+    selected.sort(key=lambda row: row[0])
+    passages = "\n\n".join(f"{_label(page_start, page_end, rowid - first + 1)}\n{chunk}"
+                           for rowid, page_start, page_end, chunk in selected)
+    _stats["context_chars"] += len(passages)
+    return passages
+
+
+async def relevant_passages(document_hash: str, text: str, query: str) -> str | None:
+    """
+    Pasajes del texto relevantes para `query`, con su página, o None si el
+    documento es lo bastante corto para mandarlo entero.
+    """
+    if len(text) <= RAG_FULL_TEXT_CHARS:
+        _stats["full_text"] += 1
+        return None
+    return await asyncio.to_thread(_select, document_hash, text, query)
+
+
+def stats() -> dict:
+    documents, chunks = db.count_indexed_documents()
+    return {**_stats, "documents": documents, "chunks": chunks}
@@ -4,4 +4,7 @@ from pathlib import Path
 # Define la ruta de descargas de PDFs de forma robusta y única
 DOWNLOADS_DIR = Path(os.getenv("DOWNLOADS_DIR", Path(__file__).parent / "downloaded_pdfs"))
 DOWNLOADS_DIR.mkdir(parents=True, exist_ok=True)
+# Espacio máximo en disco para DOWNLOADS_DIR (PDFs y sus .txt), en MB; 0 = sin límite.
+# Al superarlo se borran los documentos menos usados que no estén fijados ni anotados.
+DOWNLOADS_MAX_MB = int(os.getenv("DOWNLOADS_MAX_MB", "2048"))
 # ...puedes añadir más settings globales aquí si lo necesitas...
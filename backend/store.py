@@ -0,0 +1,271 @@
+"""
+Almacén local de adjuntos descargados.
+
+Cada copia vive en DOWNLOADS_DIR/{key}_{md5[:8]}/{filename}, así que dos
+adjuntos con el mismo nombre de fichero no chocan y una versión nueva del
+fichero en Zotero (otro md5) va a otra ruta. El .txt que genera markdown_api
+queda en la misma carpeta. La tabla local_files indexa las copias con su
+tamaño y último acceso.
+
+El espacio ocupado se limita a DOWNLOADS_MAX_MB: al superarlo se borran las
+carpetas menos usadas, salvo las fijadas (pinned) y las que tienen anotaciones.
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from backend import db
+from backend.settings import DOWNLOADS_DIR, DOWNLOADS_MAX_MB
+
+CHUNK_SIZE = 1024 * 1024
+# Las copias usadas en el último minuto no se borran: pueden estar sirviéndose
+RECENT_SECONDS = 60
+
+# last_access solo se actualiza cada medio minuto por copia: pdf.js hace muchas
+# peticiones Range seguidas al mismo fichero
+TOUCH_INTERVAL = 30
+_last_touch = {}
+
+_evict_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "evictions": 0, "evicted_bytes": 0}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def entry_path(attachment_key: str, md5: str | None, filename: str) -> Path:
+    return DOWNLOADS_DIR / f"{attachment_key}_{(md5 or 'nomd5')[:8]}" / Path(filename).name
+
+
+def relative(path: Path) -> str:
+    """Ruta relativa a DOWNLOADS_DIR, la que usan list-local-pdfs y pdf_filename."""
+    return path.relative_to(DOWNLOADS_DIR).as_posix()
+
+
+def resolve_local(relpath: str) -> Path | None:
+    """Fichero de DOWNLOADS_DIR a partir de su ruta relativa, o None si no existe o sale del directorio."""
+    root = DOWNLOADS_DIR.resolve()
+    path = (root / relpath).resolve()
+    if not path.is_relative_to(root) or not path.is_file():
+        return None
+    return path
+
+
+def attachment_of(path: Path) -> tuple | None:
+    """
+    (attachment_key, library_type, library_id) de una copia del almacén. Si no
+    está en el índice, la clave sale de su carpeta {key}_{md5} (sin biblioteca).
+    """
+    row = db.get_local_file_by_path(relative(path))
+    if row:
+        return tuple(row)
+    folder = path.parent
+    if folder.parent == DOWNLOADS_DIR and "_" in folder.name:
+        return folder.name.split("_", 1)[0], None, None
+    return None
+
+
+def list_pdfs() -> list[str]:
+    return sorted(relative(p) for p in DOWNLOADS_DIR.rglob("*.pdf") if p.is_file())
+
+
+def file_md5(path: Path) -> str:
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_current(path: Path, md5: str | None = None, mtime: int | None = None) -> bool:
+    """
+    Indica si una copia local corresponde al fichero de Zotero, como hace el
+    cliente de Zotero: si coincide la fecha de modificación (mtime, en ms) no
+    se lee el fichero; si no, se compara el md5. Sin md5 conocido, cualquier
+    copia local vale.
+    """
+    if not path.exists():
+        return False
+    if not md5:
+        return True
+    if mtime and int(path.stat().st_mtime) == int(mtime) // 1000:
+        return True
+    if file_md5(path) != md5:
+        print(f"Local copy {path} is stale (md5 differs from Zotero).")
+        return False
+    mark_current(path, mtime)
+    return True
+
+
+def mark_current(path: Path, mtime: int | None):
+    """Pone a la copia local el mtime de Zotero para no volver a calcular su md5."""
+    if mtime:
+        os.utime(path, (time.time(), int(mtime) / 1000))
+
+
+def lookup(lib_type: str, lib_id: str, attachment_key: str, filename: str,
+           md5: str | None = None, mtime: int | None = None) -> Path | None:
+    """
+    Ruta de la copia local al día del adjunto, o None si hay que descargarlo.
+    Las copias de la estructura plana anterior (DOWNLOADS_DIR/filename) se
+    mueven a su carpeta si su md5 es el del adjunto, en lugar de descargarlas
+    otra vez; sin md5 no se sabe de qué adjunto son y se descarga de nuevo.
+    """
+    path = entry_path(attachment_key, md5, filename)
+    if path.exists():
+        _count("hits")
+        key = (lib_type, str(lib_id), attachment_key)
+        if time.time() - _last_touch.get(key, 0) > TOUCH_INTERVAL:
+            _last_touch[key] = time.time()
+            row = db.get_local_file(attachment_key, lib_type, str(lib_id))
+            if row is None or row[2] != relative(path):
+                # Copia sin registrar (índice borrado, descarga interrumpida antes
+                # de registrarla): se registra para que cuente en el desalojo y se pueda fijar
+                record(lib_type, lib_id, attachment_key, md5, filename, path)
+            else:
+                db.touch_local_file(attachment_key, lib_type, str(lib_id))
+        return path
+    legacy = DOWNLOADS_DIR / Path(filename).name
+    if md5 and legacy.is_file() and file_md5(legacy) == md5:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(legacy, path)
+        if legacy.with_suffix(".txt").exists():
+            os.replace(legacy.with_suffix(".txt"), path.with_suffix(".txt"))
+        mark_current(path, mtime)
+        print(f"Moved legacy download {legacy.name} to {relative(path)}")
+        _count("hits")
+        record(lib_type, lib_id, attachment_key, md5, filename, path)
+        return path
+    _count("misses")
+    return None
+
+
+def record(lib_type: str, lib_id: str, attachment_key: str, md5: str | None, filename: str, path: Path):
+    """Registra una copia recién descargada, borra la versión anterior y aplica el límite de espacio."""
+    lib_id = str(lib_id)
+    previous = db.get_local_file(attachment_key, lib_type, lib_id)
+    if previous and previous[2] != relative(path):
+        old = DOWNLOADS_DIR / previous[2]
+        if old.parent != path.parent:
+            shutil.rmtree(old.parent, ignore_errors=True)
+        else:
+            # Mismo md5 con otro nombre (adjunto renombrado en Zotero): la
+            # carpeta es la de la copia nueva, solo sobra el fichero anterior
+            for stale in (old, old.with_suffix(".txt")):
+                if stale != path:
+                    stale.unlink(missing_ok=True)
+    db.upsert_local_file(attachment_key, lib_type, lib_id, md5, filename, relative(path), _dir_size(path.parent))
+    evict()
+
+
+def set_pinned(lib_type: str, lib_id: str, attachment_key: str, pinned: bool) -> bool:
+    return db.set_local_file_pinned(attachment_key, lib_type, str(lib_id), pinned)
+
+
+def _dir_size(path: Path) -> int:
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    except FileNotFoundError:
+        return 0
+
+
+def _is_annotated(filename: str, title: str) -> bool:
+    from backend.annotations.handlers import get_annotation_path
+    # El lector guarda las anotaciones con el título del adjunto o su nombre de fichero
+    return any(name and get_annotation_path(name).exists() for name in (title, filename))
+
+
+def _entries(measure: bool = False):
+    """
+    Entradas del índice con el tamaño guardado al registrarlas o, con
+    measure=True, el tamaño real de su carpeta (incluye el .txt generado después).
+    """
+    return [
+        {
+            "key": key, "library_type": lib_type, "library_id": lib_id, "filename": filename,
+            "dir": DOWNLOADS_DIR / Path(path).parent,
+            "size": _dir_size(DOWNLOADS_DIR / Path(path).parent) if measure else size,
+            "last_access": last_access, "pinned": bool(pinned), "title": title,
+        }
+        for key, lib_type, lib_id, filename, path, size, last_access, pinned, title in db.list_local_files()
+    ]
+
+
+def _remove_entry(entry):
+    shutil.rmtree(entry["dir"], ignore_errors=True)
+    db.delete_local_file(entry["key"], entry["library_type"], entry["library_id"])
+
+
+def evict(max_bytes: int | None = None) -> int:
+    """
+    Borra las copias menos usadas hasta quedar dentro del límite. Las fijadas,
+    las anotadas y las usadas en el último minuto se conservan aunque se
+    supere. Devuelve el número de copias borradas.
+    """
+    budget = DOWNLOADS_MAX_MB * 1024 * 1024 if max_bytes is None else max_bytes
+    if not budget:
+        return 0
+    evicted = 0
+    with _evict_lock:
+        # Con los tamaños del índice basta para saber si sobra espacio; las
+        # carpetas solo se recorren cuando hay que borrar
+        if sum(e["size"] for e in _entries()) <= budget:
+            return 0
+        entries = _entries(measure=True)
+        total = sum(e["size"] for e in entries)
+        now = time.time()
+        for entry in entries:
+            if total <= budget:
+                break
+            if entry["pinned"] or now - entry["last_access"] < RECENT_SECONDS:
+                continue
+            if _is_annotated(entry["filename"], entry["title"]):
+                continue
+            _remove_entry(entry)
+            total -= entry["size"]
+            evicted += 1
+            _count("evictions")
+            _count("evicted_bytes", entry["size"])
+            print(f"Evicted {entry['dir'].name} ({entry['size']} bytes) from the downloads store")
+    return evicted
+
+
+def clear(include_protected: bool = False) -> int:
+    """
+    Borra las copias locales. Salvo con include_protected, se conservan las
+    fijadas y las anotadas. También borra los ficheros sueltos de la
+    estructura anterior. Devuelve el número de elementos borrados.
+    """
+    deleted = 0
+    with _evict_lock:
+        for entry in _entries():
+            if not include_protected and (entry["pinned"] or _is_annotated(entry["filename"], entry["title"])):
+                continue
+            _remove_entry(entry)
+            deleted += 1
+        for item in DOWNLOADS_DIR.iterdir():
+            if item.is_file():
+                item.unlink()
+                deleted += 1
+    return deleted
+
+
+def stats() -> dict:
+    entries = _entries()
+    with _stats_lock:
+        counters = dict(_stats)
+    lookups = counters["hits"] + counters["misses"]
+    return {
+        **counters,
+        "hit_ratio": round(counters["hits"] / lookups, 3) if lookups else None,
+        "entries": len(entries),
+        "pinned": sum(1 for e in entries if e["pinned"]),
+        "total_bytes": sum(e["size"] for e in entries),
+        "max_bytes": DOWNLOADS_MAX_MB * 1024 * 1024,
+    }
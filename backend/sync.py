@@ -0,0 +1,308 @@
+"""
+Sincronización incremental Zotero -> SQLite.
+
+Cada biblioteca guarda en `sync_state` la última Last-Modified-Version vista.
+En cada pasada solo se piden los objetos modificados desde esa versión
+(parámetro `since`) y se aplican los borrados del endpoint `/deleted` y los
+ítems movidos a la papelera, de modo que el coste depende del tamaño del
+cambio y no del tamaño de la biblioteca. En una pasada completa (sin versión
+guardada o con full=True) se descarga todo y se borra lo que ya no está.
+
+Primero se descarga todo lo necesario y después se escribe en una sola
+transacción, así que los lectores nunca ven una biblioteca a medias.
+
+Las bibliotecas se sincronizan en paralelo (`sync_libraries`) y, dentro de
+cada una, colecciones, ítems, borrados y papelera se piden a la vez. Todas
+las peticiones pasan por un pool acotado y respetan el `Backoff` que mande
+Zotero; las escrituras en SQLite siguen siendo de una en una.
+"""
+import copy
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.db import (
+    delete_attachments,
+    delete_collections,
+    delete_items,
+    get_library_keys,
+    get_library_version,
+    get_sync_state,
+    refresh_has_attachment,
+    replace_item_collections,
+    replace_item_tags,
+    set_library_version,
+    transaction,
+    upsert_attachments,
+    upsert_collections,
+    upsert_items,
+    upsert_search_rows,
+)
+from backend.utils import item_fields
+from backend.zotero_client import backoff_remaining, record_backoff
+
+# Peticiones simultáneas a Zotero (entre todas las bibliotecas) y bibliotecas
+# que se sincronizan a la vez
+SYNC_WORKERS = int(os.getenv("ZOTERO_SYNC_WORKERS", "4"))
+SYNC_LIBRARY_WORKERS = int(os.getenv("ZOTERO_SYNC_LIBRARY_WORKERS", "4"))
+
+_fetch_pool = ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix="zotero-fetch")
+
+# Estado de la sincronización en curso o de la última, para /api/sync/status
+_status_lock = threading.Lock()
+_run_lock = threading.Lock()
+_status = {"running": False, "started_at": None, "finished_at": None, "duration": None, "libraries": {}}
+
+# Versión y fecha de la última sincronización correcta por biblioteca, en
+# memoria para poder añadirlas a cada respuesta sin consultar sync_state
+_library_state = None
+
+
+def _wait_backoff(zot):
+    """Espera el Backoff compartido (ver backend/zotero_client.py) y lo copia al cliente."""
+    remaining = backoff_remaining()
+    if remaining > 0:
+        print(f"Zotero backoff active, waiting {remaining:.1f}s...")
+        time.sleep(remaining)
+    if hasattr(zot, "backoff_until"):
+        zot.backoff_until = max(zot.backoff_until, time.time() + backoff_remaining())
+
+
+def _record_backoff(zot):
+    """Publica el Backoff/Retry-After que haya recibido el cliente."""
+    remaining = getattr(zot, "backoff_until", 0.0) - time.time()
+    if remaining > 0:
+        record_backoff(remaining)
+
+
+def _update_status(lib_type, lib_id, **fields):
+    with _status_lock:
+        _status["libraries"].setdefault(f"{lib_type}/{lib_id}", {}).update(fields)
+
+
+def _timed_fetch(lib_type, lib_id, step, new_client, fetch):
+    """Ejecuta una descarga con su propio cliente y guarda cuánto ha tardado."""
+    def run():
+        zot = new_client()
+        _wait_backoff(zot)
+        start = time.time()
+        try:
+            return fetch(zot)
+        finally:
+            _record_backoff(zot)
+            with _status_lock:
+                lib = _status["libraries"].setdefault(f"{lib_type}/{lib_id}", {})
+                lib.setdefault("timings", {})[step] = round(time.time() - start, 3)
+    return _fetch_pool.submit(run)
+
+
+def load_library_state():
+    """Recarga desde sync_state la versión sincronizada de cada biblioteca."""
+    global _library_state
+    state = get_sync_state()
+    with _status_lock:
+        _library_state = state
+
+
+def library_state(lib_type: str, lib_id: str):
+    """(versión, synced_at) de la biblioteca, o None si nunca se ha sincronizado."""
+    if _library_state is None:
+        load_library_state()
+    return _library_state.get((lib_type, str(lib_id)))
+
+
+def get_sync_running() -> bool:
+    return _status["running"]
+
+
+def get_sync_status() -> dict:
+    """Copia del estado de sincronización (global y por biblioteca)."""
+    if _library_state is None:
+        load_library_state()
+    with _status_lock:
+        status = copy.deepcopy(_status)
+        stored = dict(_library_state or {})
+    # Lo que hay ahora en SQLite, que es lo que sirve la API mientras sincroniza
+    status["stored"] = {
+        f"{lt}/{lid}": {"version": version, "synced_at": synced_at}
+        for (lt, lid), (version, synced_at) in stored.items()
+    }
+    status["backoff_remaining"] = round(backoff_remaining(), 1)
+    return status
+
+
+def sync_library(new_client, lib_type: str, lib_id: str, full: bool = False) -> dict:
+    """
+    Sincroniza una biblioteca a partir de la versión guardada.
+    `new_client` devuelve un cliente de Zotero para la biblioteca; cada
+    descarga usa el suyo porque pyzotero guarda estado de paginación en la
+    instancia y no se puede compartir entre hilos.
+    Con full=True se ignora la versión guardada y se descarga todo de nuevo.
+    La versión solo avanza si todos los pasos terminan sin error, así que una
+    pasada fallida se repite entera en la siguiente sincronización.
+    """
+    lib_id = str(lib_id)
+    since = 0 if full else get_library_version(lib_type, lib_id)
+    # Se lee la versión antes de descargar: lo que cambie durante la pasada
+    # tendrá una versión mayor y se volverá a pedir en la siguiente.
+    remote_version = _timed_fetch(lib_type, lib_id, "version", new_client,
+                                  lambda zot: zot.last_modified_version()).result()
+    if since and remote_version == since:
+        print(f"{lib_type}/{lib_id} is up to date (version {since}).")
+        return {"version": since, "collections": 0, "items": 0, "deleted": 0}
+
+    print(f"Synchronizing {lib_type}/{lib_id} since version {since} (remote {remote_version})...")
+    _update_status(lib_type, lib_id, state="fetching")
+
+    # Colecciones nuevas o modificadas
+    cols_job = _timed_fetch(lib_type, lib_id, "collections", new_client,
+                            lambda zot: zot.everything(zot.collections(since=since)))
+    # Ítems nuevos o modificados. Las anotaciones nunca son ítems principales,
+    # así que se excluyen en la petición para no descargarlas.
+    items_job = _timed_fetch(lib_type, lib_id, "items", new_client,
+                             lambda zot: zot.everything(zot.items(since=since, itemType="-annotation")))
+    # Borrados y papelera (no tiene sentido en la primera sincronización)
+    deleted_job = trash_job = None
+    if since:
+        deleted_job = _timed_fetch(lib_type, lib_id, "deleted", new_client,
+                                   lambda zot: zot.deleted(since=since))
+        trash_job = _timed_fetch(lib_type, lib_id, "trash", new_client,
+                                 lambda zot: zot.everything(zot.trash(since=since)))
+
+    cols = cols_job.result()
+    changed = items_job.result()
+    deleted_cols, removed_items = [], []
+    if since:
+        deleted = deleted_job.result()
+        deleted_cols = list(deleted.get("collections", []))
+        trashed = [it["key"] for it in trash_job.result()]
+        removed_items = list(deleted.get("items", [])) + trashed
+
+    col_rows = [
+        (
+            col["key"],
+            col["data"]["name"],
+            col["data"]["parentCollection"] if col["data"].get("parentCollection") else None,
+            lib_type,
+            lib_id,
+        )
+        for col in cols
+    ]
+    item_rows, item_col_rows, attachment_rows, search_rows, tag_rows = [], [], [], [], []
+    child_keys, top_keys = [], []
+    for it in changed:
+        data = it.get("data", {})
+        if data.get("parentItem"):
+            # Adjuntos y notas hijas no se listan como ítems; los adjuntos se
+            # guardan aparte para calcular hasAttachment sin llamar a Zotero
+            child_keys.append(it["key"])
+            if data.get("itemType") == "attachment":
+                attachment_rows.append((
+                    it["key"], data["parentItem"], lib_type, lib_id,
+                    data.get("title", ""), data.get("filename", ""),
+                    data.get("contentType", ""), data.get("linkMode", ""),
+                    data.get("md5"), data.get("mtime"), it.get("version", data.get("version")),
+                ))
+            continue
+        top_keys.append(it["key"])
+        title = data.get("title", "")
+        if data.get("itemType") == "attachment":
+            title = title or data.get("filename", "(Attachment)")
+        fields = item_fields(data)
+        item_rows.append((
+            it["key"], title, lib_type, lib_id, json.dumps(data),
+            fields["creators"], fields["date"], fields["year"], fields["item_type"],
+            fields["publication_title"], fields["publisher"],
+        ))
+        tag_rows.extend((it["key"], lib_type, lib_id, tag) for tag in fields["tags"])
+        search_rows.append((
+            it["key"], lib_type, lib_id, title, fields["creators"],
+            data.get("abstractNote", ""), " ".join(fields["tags"]), fields["publication_title"],
+        ))
+        for col_id in data.get("collections", []):
+            item_col_rows.append((it["key"], col_id, lib_type, lib_id))
+
+    _update_status(lib_type, lib_id, state="writing")
+    write_start = time.time()
+    with transaction() as conn:
+        if not since:
+            # Pasada completa: /deleted y la papelera no sirven sin versión de
+            # partida, así que se borra todo lo local que Zotero no ha devuelto
+            # (/items no incluye los ítems de la papelera)
+            local_cols, local_items, local_attachments = get_library_keys(conn, lib_type, lib_id)
+            fetched = {it["key"] for it in changed}
+            deleted_cols = sorted(local_cols - {col["key"] for col in cols})
+            removed_items = sorted((local_items | local_attachments) - fetched)
+        upsert_collections(conn, col_rows)
+        upsert_items(conn, item_rows)
+        upsert_search_rows(conn, search_rows)
+        # Las colecciones y etiquetas de cada ítem modificado se reemplazan
+        replace_item_collections(conn, top_keys, item_col_rows, lib_type, lib_id)
+        replace_item_tags(conn, top_keys, tag_rows, lib_type, lib_id)
+        # Un ítem que ahora tiene padre deja de ser principal, y viceversa
+        delete_items(conn, child_keys, lib_type, lib_id)
+        delete_attachments(conn, top_keys, lib_type, lib_id)
+        upsert_attachments(conn, attachment_rows)
+        delete_collections(conn, deleted_cols, lib_type, lib_id)
+        delete_items(conn, removed_items, lib_type, lib_id)
+        delete_attachments(conn, removed_items, lib_type, lib_id)
+        refresh_has_attachment(conn, lib_type, lib_id)
+        set_library_version(conn, lib_type, lib_id, remote_version)
+    with _status_lock:
+        _status["libraries"][f"{lib_type}/{lib_id}"].setdefault("timings", {})["write"] = round(time.time() - write_start, 3)
+        if _library_state is not None:
+            _library_state[(lib_type, lib_id)] = (remote_version, time.time())
+
+    deleted_count = len(deleted_cols) + len(removed_items)
+    print(f"{lib_type}/{lib_id} synchronized to version {remote_version}: "
+          f"{len(cols)} collections, {len(changed)} items changed, {deleted_count} deleted.")
+    return {"version": remote_version, "collections": len(cols), "items": len(changed), "deleted": deleted_count}
+
+
+def _sync_one(lib, new_client, full):
+    lib_type, lib_id = lib["type"], str(lib["id"])
+    start = time.time()
+    _update_status(lib_type, lib_id, state="running", started_at=start)
+    try:
+        stats = sync_library(new_client, lib_type, lib_id, full=full)
+    except Exception as e:
+        print(f"Error synchronizing {lib_type}/{lib_id}: {e}")
+        _update_status(lib_type, lib_id, state="error", error=str(e),
+                       finished_at=time.time(), duration=round(time.time() - start, 3))
+        return None
+    _update_status(lib_type, lib_id, state="done", error=None, finished_at=time.time(),
+                   duration=round(time.time() - start, 3), **stats)
+    return stats
+
+
+def sync_libraries(libs, client_for, full: bool = False) -> dict:
+    """
+    Sincroniza varias bibliotecas en paralelo.
+    `libs` es una lista de {"type", "id", ...} y `client_for(lib_type, lib_id)`
+    crea un cliente de Zotero nuevo. Devuelve {"type/id": stats o None si ha
+    fallado}. Si ya hay una sincronización en curso, espera a que termine.
+    """
+    with _run_lock:
+        start = time.time()
+        with _status_lock:
+            _status.update(running=True, started_at=start, finished_at=None, duration=None)
+            _status["libraries"] = {
+                f"{lib['type']}/{lib['id']}": {"state": "pending", "name": lib.get("name")} for lib in libs
+            }
+        try:
+            workers = max(1, min(SYNC_LIBRARY_WORKERS, len(libs)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="zotero-sync") as pool:
+                futures = {
+                    f"{lib['type']}/{lib['id']}": pool.submit(
+                        _sync_one, lib,
+                        lambda lt=lib["type"], lid=lib["id"]: client_for(lt, lid), full)
+                    for lib in libs
+                }
+                results = {key: fut.result() for key, fut in futures.items()}
+        finally:
+            with _status_lock:
+                _status.update(running=False, finished_at=time.time(), duration=round(time.time() - start, 3))
+        print(f"Synchronized {len(libs)} libraries in {time.time() - start:.1f}s.")
+        return results
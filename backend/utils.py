@@ -0,0 +1,51 @@
+import re
+
+# Helper function to format creators
+def format_creators(creators_list):
+    if not creators_list:
+        return ""
+    names = []
+    for creator in creators_list:
+        # Prioritize lastName if available
+        last_name = creator.get('lastName')
+        first_name = creator.get('firstName')
+        if last_name:
+            name = last_name
+            if first_name:
+                name += f", {first_name}"
+        elif first_name: # Handle case where only firstName exists
+            name = first_name
+        else: # Handle case where neither exists (e.g., institutional author in 'name')
+            name = creator.get('name', '')
+        names.append(name)
+    return "; ".join(names) # Use semicolon for multiple creators
+
+def item_fields(data):
+    """Campos desnormalizados de un ítem de Zotero (columnas de items y sus etiquetas)."""
+    date = data.get("date", "")
+    year = re.search(r"\b(\d{4})\b", date)
+    return {
+        "creators": format_creators(data.get("creators", [])),
+        "date": date,
+        "year": int(year.group(1)) if year else 0,
+        "item_type": data.get("itemType", ""),
+        "publication_title": data.get("publicationTitle", data.get("publication", "")),
+        "publisher": data.get("publisher", ""),
+        "tags": [t.get("tag") for t in data.get("tags", []) if t.get("tag")],
+    }
+
+# --- Validadores HTTP (ETag / If-None-Match) ---
+
+def file_etag(path, md5=None):
+    """ETag fuerte de un fichero: su md5 de Zotero si se conoce, si no mtime y tamaño."""
+    if md5:
+        return f'"{md5}"'
+    stat = path.stat()
+    return f'"{int(stat.st_mtime)}-{stat.st_size}"'
+
+def etag_matches(if_none_match, etag):
+    """Comprueba la cabecera If-None-Match (lista de ETags o *) contra el ETag actual."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
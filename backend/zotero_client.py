@@ -0,0 +1,280 @@
+"""
+Cliente asíncrono de la API web de Zotero para las rutas de la API.
+
+pyzotero es síncrono: llamado desde un endpoint `async def` bloquea el event
+loop y, como guarda el estado de paginación en la instancia, obliga a crear
+un cliente nuevo por petición. Este módulo usa el cliente httpx compartido
+(backend/http_clients.py) y un ZoteroClient cacheado por biblioteca:
+
+- Las respuestas se guardan con su Last-Modified-Version y su ETag y se
+  repiten con If-Modified-Since-Version / If-None-Match; si Zotero responde
+  304 se devuelve la copia guardada.
+- Se respeta el `Backoff` y el `Retry-After` (429/503) de Zotero. El Backoff
+  se aplica a la clave de API, así que se comparte con la sincronización
+  (backend/sync.py) mediante backoff_remaining()/record_backoff().
+- ChildrenResolver resuelve en bloque los hijos que necesita una petición.
+- Los contadores de peticiones, 304 y reintentos (client_stats()) se
+  publican en /api/sync/status.
+
+La sincronización con SQLite sigue usando pyzotero en hilos (new_sync_client).
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from pyzotero import zotero
+
+from backend.http_clients import get_http_client
+
+API_URL = "https://api.zotero.org"
+# Máximo de resultados por página
+PAGE_SIZE = 100
+# Reintentos tras un 429/503 y espera si Zotero no manda Retry-After
+MAX_RETRIES = 3
+DEFAULT_RETRY_AFTER = 5
+# Respuestas guardadas por biblioteca para las peticiones condicionales (un
+# listado de varias páginas ocupa dos: su primera página y el listado entero)
+RESPONSE_CACHE_SIZE = 64
+# Peticiones /children simultáneas en ChildrenResolver
+CHILDREN_CONCURRENCY = 8
+# Páginas simultáneas de un mismo listado
+PAGE_CONCURRENCY = 8
+# Con hasta estos ítems se pide siempre un /children por ítem; con más se
+# compara con lo que cuesta pedir todos los hijos de la biblioteca (una
+# petición por cada PAGE_SIZE hijos)
+LIBRARY_PASS_THRESHOLD = 10
+# Hijos directos de un ítem principal (las anotaciones cuelgan de los adjuntos)
+TOP_LEVEL_CHILD_TYPES = "attachment || note"
+
+_backoff_lock = threading.Lock()
+_backoff_until = 0.0
+
+_clients = {}
+_stats = {"requests": 0, "not_modified": 0, "retries": 0}
+
+
+class ZoteroError(Exception):
+    """Respuesta de error de la API de Zotero."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"Zotero API error {status_code}: {message}")
+        self.status_code = status_code
+
+
+def backoff_remaining() -> float:
+    return max(0.0, _backoff_until - time.time())
+
+
+def record_backoff(seconds: float):
+    """Ninguna petición a Zotero (de este módulo o de la sincronización) sale antes de `seconds`."""
+    global _backoff_until
+    with _backoff_lock:
+        _backoff_until = max(_backoff_until, time.time() + seconds)
+
+
+def _seconds(value, default=None):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def new_sync_client(lib_type: str, lib_id: str):
+    """Cliente pyzotero nuevo para la sincronización (uno por descarga, ver backend/sync.py)."""
+    return zotero.Zotero(lib_id, lib_type, os.getenv("ZOTERO_API_KEY"))
+
+
+def get_client(lib_type: str, lib_id: str) -> "ZoteroClient":
+    """ZoteroClient de la biblioteca; se crea una vez y se reutiliza."""
+    key = (lib_type, str(lib_id))
+    client = _clients.get(key)
+    if client is None:
+        client = _clients[key] = ZoteroClient(lib_type, str(lib_id), os.getenv("ZOTERO_API_KEY"))
+    return client
+
+
+def client_stats() -> dict:
+    return {**_stats, "libraries": len(_clients), "backoff_remaining": round(backoff_remaining(), 1)}
+
+
+class ZoteroClient:
+    def __init__(self, lib_type: str, lib_id: str, api_key: str):
+        self.lib_type = lib_type
+        self.lib_id = lib_id
+        self.prefix = f"{API_URL}/{'users' if lib_type == 'user' else 'groups'}/{lib_id}"
+        self.headers = {"Zotero-API-Key": api_key or "", "Zotero-API-Version": "3"}
+        self._responses = OrderedDict()
+
+    async def _send(self, url, params, headers):
+        """GET con Backoff y reintentos tras 429/503."""
+        for attempt in range(MAX_RETRIES + 1):
+            wait = backoff_remaining()
+            if wait > 0:
+                print(f"Zotero backoff active, waiting {wait:.1f}s...")
+                await asyncio.sleep(wait)
+            _stats["requests"] += 1
+            response = await get_http_client("zotero").get(url, params=params, headers=headers)
+            backoff = _seconds(response.headers.get("Backoff"))
+            if backoff:
+                record_backoff(backoff)
+            if response.status_code not in (429, 503) or attempt == MAX_RETRIES:
+                return response
+            _stats["retries"] += 1
+            retry_after = _seconds(response.headers.get("Retry-After"), DEFAULT_RETRY_AFTER)
+            print(f"Zotero answered {response.status_code} for {url}, retrying in {retry_after:.1f}s...")
+            record_backoff(retry_after)
+
+    async def get(self, path: str, **params):
+        """
+        JSON de `path` (relativo a la biblioteca) y el Total-Results de la
+        respuesta. Si ya se pidió antes, la petición es condicional.
+        """
+        data, total, _ = await self._get(path, params)
+        return data, total
+
+    async def _get(self, path, params, store=True):
+        """Como get(); además indica si Zotero respondió 304. Con store=False la respuesta no se guarda."""
+        params = {key: value for key, value in params.items() if value is not None}
+        cache_key = (path, tuple(sorted(params.items())))
+        cached = self._responses.get(cache_key)
+        headers = dict(self.headers)
+        if cached:
+            if cached["version"]:
+                headers["If-Modified-Since-Version"] = cached["version"]
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+        response = await self._send(self.prefix + path, params, headers)
+        if response.status_code == 304 and cached:
+            _stats["not_modified"] += 1
+            self._responses.move_to_end(cache_key)
+            return cached["data"], cached["total"], True
+        if not response.is_success:
+            raise ZoteroError(response.status_code, response.text)
+        data = response.json()
+        total = int(response.headers.get("Total-Results", 0)) or None
+        version, etag = response.headers.get("Last-Modified-Version"), response.headers.get("ETag")
+        if store and (version or etag):
+            self._remember(cache_key, {"version": version, "etag": etag, "data": data, "total": total})
+        return data, total, False
+
+    def _remember(self, cache_key, entry):
+        self._responses[cache_key] = entry
+        self._responses.move_to_end(cache_key)
+        while len(self._responses) > RESPONSE_CACHE_SIZE:
+            self._responses.popitem(last=False)
+
+    async def everything(self, path: str, **params) -> list:
+        """
+        Todas las páginas de un listado; tras la primera, el resto se piden
+        a la vez (hasta PAGE_CONCURRENCY). Las páginas siguientes no se
+        guardan una a una, lo que vaciaría la caché con un listado grande: se
+        guarda el listado entero, que se reutiliza mientras la primera página
+        responda 304 (If-Modified-Since-Version cubre toda la biblioteca).
+        """
+        first, total, unchanged = await self._get(path, {"limit": PAGE_SIZE, "start": 0, **params})
+        if not total or total <= len(first):
+            return list(first)
+        listing_key = ("everything", path, tuple(sorted(params.items())))
+        listing = self._responses.get(listing_key)
+        if unchanged and listing:
+            self._responses.move_to_end(listing_key)
+            return list(listing["data"])
+        semaphore = asyncio.Semaphore(PAGE_CONCURRENCY)
+
+        async def page(start):
+            async with semaphore:
+                data, _, _ = await self._get(path, {"limit": PAGE_SIZE, "start": start, **params}, store=False)
+                return data
+        pages = await asyncio.gather(*(page(start) for start in range(PAGE_SIZE, total, PAGE_SIZE)))
+        items = list(first) + [it for data in pages for it in data]
+        self._remember(listing_key, {"data": items})
+        return list(items)
+
+    async def item(self, key: str) -> dict:
+        data, _ = await self.get(f"/items/{key}")
+        return data
+
+    async def children(self, key: str) -> list:
+        return await self.everything(f"/items/{key}/children")
+
+    async def top(self, **params) -> list:
+        return await self.everything("/items/top", **params)
+
+    async def collection_items(self, collection_key: str, **params) -> list:
+        return await self.everything(f"/collections/{collection_key}/items", **params)
+
+    async def collections(self) -> list:
+        return await self.everything("/collections")
+
+    async def collections_sub(self, collection_key: str) -> list:
+        return await self.everything(f"/collections/{collection_key}/collections")
+
+    async def groups(self) -> list:
+        """Grupos del usuario (solo en la biblioteca de usuario)."""
+        return await self.everything("/groups")
+
+
+class ChildrenResolver:
+    """
+    Hijos de los ítems de una biblioteca, memorizados durante una petición.
+
+    Para pocos ítems se pide /items/{key}/children de cada uno (en paralelo);
+    para más de LIBRARY_PASS_THRESHOLD, si son más que las páginas de adjuntos
+    y notas de la biblioteca (Total-Results / PAGE_SIZE), se hace una sola
+    pasada por todos ellos agrupados por parentItem. En una biblioteca grande
+    un listado corto sigue usando /children. La pasada solo sirve para ítems
+    principales: los hijos de un adjunto (anotaciones) no se incluyen.
+    """
+
+    def __init__(self, client: ZoteroClient):
+        self.client = client
+        self._children = {}
+
+    async def children(self, key: str) -> list:
+        return (await self.children_many([key]))[key]
+
+    async def children_many(self, items) -> dict:
+        """
+        {clave: [hijos]} de `items`, que son claves o ítems de la API; de
+        estos se salta a los que Zotero indica sin hijos (meta.numChildren == 0).
+        """
+        all_keys, missing = [], []
+        for it in items:
+            key = it if isinstance(it, str) else it["key"]
+            all_keys.append(key)
+            if not isinstance(it, str) and not it.get("meta", {}).get("numChildren", 1):
+                self._children.setdefault(key, [])
+            elif key not in self._children:
+                missing.append(key)
+        missing = list(dict.fromkeys(missing))
+        if len(missing) > LIBRARY_PASS_THRESHOLD and await self._library_pass_is_cheaper(len(missing)):
+            await self._load_library_children(missing)
+        elif missing:
+            semaphore = asyncio.Semaphore(CHILDREN_CONCURRENCY)
+
+            async def fetch(key):
+                async with semaphore:
+                    self._children[key] = await self.client.children(key)
+            await asyncio.gather(*(fetch(key) for key in missing))
+        return {key: self._children.get(key, []) for key in all_keys}
+
+    async def _library_pass_is_cheaper(self, count: int) -> bool:
+        # La primera página es la misma que pedirá everything(): queda guardada y
+        # allí se repite como petición condicional
+        first, total = await self.client.get("/items", limit=PAGE_SIZE, start=0, itemType=TOP_LEVEL_CHILD_TYPES)
+        pages = -(-(total or len(first)) // PAGE_SIZE)
+        return pages < count
+
+    async def _load_library_children(self, keys):
+        children = await self.client.everything("/items", itemType=TOP_LEVEL_CHILD_TYPES)
+        by_parent = {}
+        for child in children:
+            parent = child.get("data", {}).get("parentItem")
+            if parent:
+                by_parent.setdefault(parent, []).append(child)
+        print(f"Resolved children of {len(keys)} items in {self.client.lib_type}/{self.client.lib_id} "
+              f"from {len(children)} library children")
+        for key in keys:
+            self._children[key] = by_parent.get(key, [])
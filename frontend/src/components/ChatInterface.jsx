@@ -117,6 +117,7 @@ export default function ChatInterface() {
   const [sendAsMarkdown, setSendAsMarkdown] = useState(true); // Por defecto activado
   const [isLoading, setIsLoading] = useState(false);
   const chatRef = useRef(null);
+  const abortRef = useRef(null); // AbortController de la respuesta en streaming
 
   // Auto-scroll al final del chat
   useEffect(() => {
@@ -185,6 +186,69 @@ export default function ChatInterface() {
   };
 
   // Chat handlers
+
+  // Envía la petición con ?stream=true y va añadiendo al último mensaje los
+  // fragmentos que llegan por SSE ({type: 'delta'|'done'|'error'})
+  const streamReply = async (url, body) => {
+    const controller = new AbortController();
+    abortRef.current = controller;
+    try {
+      const res = await fetch(`${url}?stream=true`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'X-Session-Id': window.localStorage.getItem('session_id') || ''
+        },
+        body: JSON.stringify(body),
+        signal: controller.signal
+      });
+      if (res.status === 413) {
+        const detail = await res.text();
+        alert(detail);
+        return;
+      }
+      if (!res.ok) {
+        const data = await res.json().catch(() => ({}));
+        setMessages(prev => [...prev, { role: 'model', content: `Error: ${data.detail || 'Unknown error'}` }]);
+        return;
+      }
+      // Llega el primer fragmento: se sustituye el indicador de carga por la respuesta
+      setMessages(prev => [...prev, { role: 'model', content: '' }]);
+      setIsLoading(false);
+      const appendToReply = (text) => setMessages(prev => {
+        const last = prev[prev.length - 1];
+        return [...prev.slice(0, -1), { ...last, content: last.content + text }];
+      });
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const raw of events) {
+          if (!raw.startsWith('data: ')) continue;
+          const event = JSON.parse(raw.slice(6));
+          if (event.type === 'delta') {
+            appendToReply(event.text);
+          } else if (event.type === 'error') {
+            appendToReply(`\n\nError: ${event.detail}`);
+          }
+        }
+      }
+    } catch (err) {
+      // AbortError: el usuario ha pulsado Stop y se conserva lo recibido
+      if (err.name !== 'AbortError') {
+        setMessages(prev => [...prev, { role: 'model', content: `Error: ${err.message}` }]);
+      }
+    } finally {
+      abortRef.current = null;
+      setIsLoading(false);
+    }
+  };
+
   const handleSend = async () => {
     if (!input.trim()) return;
     const userMsg = { role: 'user', content: input };
@@ -209,137 +273,31 @@ export default function ChatInterface() {
       fileToSend = selectedPdf.replace(/\.pdf$/i, '.txt');
     }
 
-    if (api === 'google' || api === 'openai') {
+    if (api === 'google' || api === 'openai' || api === 'openrouter') {
       const apiKeyToSend = apiKeys[api];
       if (!apiKeyToSend) {
-        setMessages(prev => [...prev, { role: 'system', content: `⚠️ Missing API Key for ${api === 'google' ? 'Google' : 'OpenAI'}. Add it in settings or in the .env file.` }]);
+        const apiName = { google: 'Google', openai: 'OpenAI', openrouter: 'OpenRouter' }[api];
+        setMessages(prev => [...prev, { role: 'system', content: `⚠️ Missing API Key for ${apiName}. Add it in settings or in the .env file.` }]);
         setIsLoading(false);
         return;
       }
-      // Si hay un PDF seleccionado, usa /process-pdf
       if (selectedPdf) {
-        const historyWithoutLast = apiHistory.slice(0, -1);
-        try {
-          const res = await fetch(`/api/${api}/process-pdf`, {
-            method: 'POST',
-            headers: {
-              'Content-Type': 'application/json',
-              'X-Session-Id': window.localStorage.getItem('session_id') || ''
-            },
-            body: JSON.stringify({
-              api_key: apiKeyToSend,
-              model,
-              pdf_filename: fileToSend, // Usar el archivo correcto
-              prompt: input,
-              history: historyWithoutLast
-            })
-          });
-          if (res.status === 413) {
-            const detail = await res.text();
-            alert(detail);
-            setIsLoading(false);
-            return;
-          }
-          const data = await res.json();
-          if (res.ok) {
-            setMessages(prev => [...prev, { role: 'model', content: data.response }]);
-          } else {
-            setMessages(prev => [...prev, { role: 'model', content: `Error: ${data.detail || 'Unknown error'}` }]);
-          }
-        } catch (err) {
-          setMessages(prev => [...prev, { role: 'model', content: `Error: ${err.message}` }]);
-        }
-        setIsLoading(false);
-        return;
-      }
-      // Si NO hay PDF, usa el endpoint de chat normal
-      try {
-        const res = await fetch(`/api/${api}/chat`, {
-          method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-            'X-Session-Id': window.localStorage.getItem('session_id') || ''
-          },
-          body: JSON.stringify({
-            api_key: apiKeyToSend,
-            model,
-            history: apiHistory
-          })
+        // Si hay un PDF seleccionado, usa /process-pdf
+        await streamReply(`/api/${api}/process-pdf`, {
+          api_key: apiKeyToSend,
+          model,
+          pdf_filename: fileToSend, // Usar el archivo correcto
+          prompt: input,
+          history: apiHistory.slice(0, -1)
         });
-        const data = await res.json();
-        if (res.ok) {
-          setMessages(prev => [...prev, { role: 'model', content: data.response }]);
-        } else {
-          setMessages(prev => [...prev, { role: 'model', content: `Error: ${data.detail || 'Unknown error'}` }]);
-        }
-      } catch (err) {
-        setMessages(prev => [...prev, { role: 'model', content: `Error: ${err.message}` }]);
-      }
-      setIsLoading(false);
-      return;
-    }
-
-    // Lógica para openrouter
-    if (api === 'openrouter') {
-      const apiKeyToSend = apiKeys[api];
-      if (!apiKeyToSend) {
-        setMessages(prev => [...prev, { role: 'system', content: '⚠️ Missing API Key for OpenRouter. Add it in settings or in the .env file.' }]);
-        setIsLoading(false);
-        return;
-      }
-      if (selectedPdf) {
-        const historyWithoutLast = apiHistory.slice(0, -1);
-        try {
-          const res = await fetch('/api/openrouter/process-pdf', {
-            method: 'POST',
-            headers: {
-              'Content-Type': 'application/json',
-              'X-Session-Id': window.localStorage.getItem('session_id') || ''
-            },
-            body: JSON.stringify({
-              api_key: apiKeyToSend,
-              model,
-              pdf_filename: fileToSend, // Usar el archivo correcto
-              prompt: input,
-              history: historyWithoutLast
-            })
-          });
-          const data = await res.json();
-          if (res.ok) {
-            setMessages(prev => [...prev, { role: 'model', content: data.response }]);
-          } else {
-            setMessages(prev => [...prev, { role: 'model', content: `Error: ${data.detail || 'Unknown error'}` }]);
-          }
-        } catch (err) {
-          setMessages(prev => [...prev, { role: 'model', content: `Error: ${err.message}` }]);
-        }
-        setIsLoading(false);
-        return;
-      }
-      // Si NO hay PDF, usa el endpoint de chat normal
-      try {
-        const res = await fetch('/api/openrouter/chat', {
-          method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-            'X-Session-Id': window.localStorage.getItem('session_id') || ''
-          },
-          body: JSON.stringify({
-            api_key: apiKeyToSend,
-            model,
-            history: apiHistory
-          })
+      } else {
+        // Si NO hay PDF, usa el endpoint de chat normal
+        await streamReply(`/api/${api}/chat`, {
+          api_key: apiKeyToSend,
+          model,
+          history: apiHistory
         });
-        const data = await res.json();
-        if (res.ok) {
-          setMessages(prev => [...prev, { role: 'model', content: data.response }]);
-        } else {
-          setMessages(prev => [...prev, { role: 'model', content: `Error: ${data.detail || 'Unknown error'}` }]);
-        }
-      } catch (err) {
-        setMessages(prev => [...prev, { role: 'model', content: `Error: ${err.message}` }]);
       }
-      setIsLoading(false);
       return;
     }
 
@@ -352,7 +310,8 @@ export default function ChatInterface() {
   };
   
   const handleStop = () => {
-    // Lógica para parar la generación
+    // Corta la respuesta en curso; el backend cierra la petición al proveedor
+    abortRef.current?.abort();
   };
   
   const handleClear = () => {
@@ -424,7 +383,8 @@ export default function ChatInterface() {
               >
                 <option value="">(None)</option>
                 {localPdfs.map(pdf => (
-                  <option key={pdf} value={pdf}>{pdf}</option>
+                  // El backend devuelve rutas {clave}_{md5}/fichero.pdf; se muestra solo el fichero
+                  <option key={pdf} value={pdf}>{pdf.split('/').pop()}</option>
                 ))}
               </select>
             </div>
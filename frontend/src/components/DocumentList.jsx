@@ -1,9 +1,58 @@
-import { useEffect, useState } from 'react';
+import { useEffect, useMemo, useState } from 'react';
 import { Resizable } from 'react-resizable'; // Import Resizable
 import 'react-resizable/css/styles.css'; // Import default styles
 import { DragDropContext, Droppable, Draggable } from 'react-beautiful-dnd';
 import LoadingDots from './LoadingDots';
 
+// Fields requested for list views (everything except the raw metadata blob)
+const LIST_FIELDS = 'id,key,title,hasAttachment,itemType,creators,date,tags,publisher,publicationTitle';
+
+// Adaptar: si los ítems vienen con 'id', convertir a 'key' para coherencia
+const normalizeItem = (it) => {
+  const d = { ...it, key: it.key || it.id };
+  // Normaliza publisher y publicationTitle
+  d.publisher = it.publisher || (it.data && it.data.publisher) || '';
+  d.publicationTitle = it.publicationTitle || (it.data && (it.data.publicationTitle || it.data.publication)) || '';
+  // Normaliza tags a array de strings
+  if (Array.isArray(it.tags)) {
+    d.tags = it.tags.map(t => (typeof t === 'string' ? t : t.tag)).filter(Boolean);
+  } else if (it.data && Array.isArray(it.data.tags)) {
+    d.tags = it.data.tags.map(t => (typeof t === 'string' ? t : t.tag)).filter(Boolean);
+  } else {
+    d.tags = [];
+  }
+  return d;
+};
+
+// Basic sorting by date (descending), if date exists
+const sortByDateDesc = (list) => list.sort((a, b) => {
+  const dateA = a.date || '0';
+  const dateB = b.date || '0';
+  return dateB.localeCompare(dateA);
+});
+
+// Reads an NDJSON response and calls onBatch with the items of each received chunk
+const readNdjson = async (response, onBatch) => {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  const parseLines = (lines) => lines
+    .filter(line => line.trim())
+    .map(line => JSON.parse(line))
+    .filter(obj => !('next_cursor' in obj)); // Pagination marker, not an item
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    const lines = buffer.split('\n');
+    buffer = lines.pop();
+    const batch = parseLines(lines);
+    if (batch.length) onBatch(batch);
+  }
+  const rest = parseLines([buffer]);
+  if (rest.length) onBatch(rest);
+};
+
 // Resizable Header Component
 const ResizableTitle = ({ onResize, width, children }) => {
   if (!width) {
@@ -78,10 +127,10 @@ export default function DocumentList({ lib, active, onSelect, activeCollectionKe
     setColumns(reordered);
   }
 
-  // Ordenar items según sortConfig
-  const getSortedItems = (data) => {
-    if (!sortConfig.key) return data;
-    const sorted = [...data].sort((a, b) => {
+  // Ordenar items según sortConfig (solo cuando cambian los ítems o el orden)
+  const sortedItems = useMemo(() => {
+    if (!sortConfig.key) return items;
+    return [...items].sort((a, b) => {
       let aValue = a[sortConfig.key];
       let bValue = b[sortConfig.key];
       // Normalizar para strings y arrays
@@ -97,8 +146,7 @@ export default function DocumentList({ lib, active, onSelect, activeCollectionKe
       }
       return 0;
     });
-    return sorted;
-  };
+  }, [items, sortConfig]);
 
   // Click en cabecera para ordenar
   const handleHeaderClick = (colKey) => {
@@ -168,55 +216,64 @@ export default function DocumentList({ lib, active, onSelect, activeCollectionKe
     let url;
     if (activeCollectionKey) {
       // Fetch items for the selected collection and all its subcollections
-      url = `/api/sqlite/libraries/${lib.type}/${lib.id}/collections/${activeCollectionKey}/items_recursive?recursive=true`;
+      url = `/api/sqlite/libraries/${lib.type}/${lib.id}/collections/${activeCollectionKey}/items_recursive?recursive=true&fields=${LIST_FIELDS}`;
     } else {
-      // Fetch top-level items for the selected library - Usar el mismo formato de endpoint
-      url = `/api/sqlite/libraries/${lib.type}/${lib.id}/items`;
+      // Fetch top-level items for the selected library as NDJSON so the first rows render while the rest arrives.
+      // The server already sends them newest first (indexed year sort), so chunks are only appended
+      url = `/api/sqlite/libraries/${lib.type}/${lib.id}/items?stream=true&sort=year&desc=true&fields=${LIST_FIELDS}`;
     }
 
     console.log(`Fetching items from URL: ${url}`); // Debugging
 
-    fetch(url)
-      .then(r => {
+    const controller = new AbortController();
+    const received = [];
+    let frame = null;
+    // Append each chunk; the table is refreshed at most once per animation frame
+    const showItems = (batch) => {
+      for (const it of batch) received.push(normalizeItem(it));
+      if (frame === null) {
+        frame = requestAnimationFrame(() => {
+          frame = null;
+          setItems(received.slice());
+        });
+      }
+    };
+    // Sort once when everything has arrived
+    const showAll = () => {
+      if (frame !== null) cancelAnimationFrame(frame);
+      frame = null;
+      setItems(sortByDateDesc(received.slice()));
+    };
+
+    fetch(url, { signal: controller.signal })
+      .then(async r => {
         if (!r.ok) {
           throw new Error(`HTTP error! status: ${r.status}`);
         }
-        return r.json();
-      })
-      .then(data => {
-        // Adaptar: si los ítems vienen con 'id', convertir a 'key' para coherencia
-        const itemsWithKey = data.map(it => {
-          const d = { ...it, key: it.key || it.id };
-          // Normaliza publisher y publicationTitle
-          d.publisher = it.publisher || (it.data && it.data.publisher) || '';
-          d.publicationTitle = it.publicationTitle || (it.data && (it.data.publicationTitle || it.data.publication)) || '';
-          // Normaliza tags a array de strings
-          if (Array.isArray(it.tags)) {
-            d.tags = it.tags.map(t => (typeof t === 'string' ? t : t.tag)).filter(Boolean);
-          } else if (it.data && Array.isArray(it.data.tags)) {
-            d.tags = it.data.tags.map(t => (typeof t === 'string' ? t : t.tag)).filter(Boolean);
-          } else {
-            d.tags = [];
-          }
-          return d;
-        });
-        console.log(`Received ${itemsWithKey.length} items`); // Debugging
-        // Add basic sorting by date (descending) as an example, if date exists
-        const sortedData = itemsWithKey.sort((a, b) => {
-          const dateA = a.date || '0';
-          const dateB = b.date || '0';
-          return dateB.localeCompare(dateA); // Sort descending by date string
-        });
-        setItems(sortedData);
+        if (activeCollectionKey) {
+          for (const it of await r.json()) received.push(normalizeItem(it));
+        } else {
+          await readNdjson(r, batch => {
+            showItems(batch);
+            setLoading(false); // First rows are on screen
+          });
+        }
+        showAll();
+        console.log(`Received ${received.length} items`); // Debugging
       })
       .catch(err => {
+        if (err.name === 'AbortError') return; // Library/collection changed mid-request
         console.error("Error fetching items:", err);
         setError(err.message);
         setItems([]); // Clear items on error
       })
       .finally(() => {
-        setLoading(false);
+        if (!controller.signal.aborted) setLoading(false);
       });
+    return () => {
+      controller.abort();
+      if (frame !== null) cancelAnimationFrame(frame);
+    };
   }, [lib, activeCollectionKey]);
 
   const handleRowDoubleClick = async (doc) => {
@@ -349,7 +406,7 @@ export default function DocumentList({ lib, active, onSelect, activeCollectionKe
               </Droppable>
             </DragDropContext>
             <tbody className="bg-white divide-y divide-gray-200">
-              {getSortedItems(items).map(it => (
+              {sortedItems.map(it => (
                 <tr
                   key={it.key}
                   onClick={() => onSelect(it)}
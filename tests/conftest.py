@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# backend.db crea las tablas al importarse: los tests usan una base de datos temporal
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "test.db"))
+os.environ.setdefault("DOWNLOADS_DIR", tempfile.mkdtemp())
@@ -0,0 +1,79 @@
+from backend import db
+from backend.sync import sync_library
+
+
+class FakeZotero:
+    """Biblioteca de Zotero en memoria con la interfaz de pyzotero que usa sync_library."""
+
+    def __init__(self):
+        self.version = 0
+        self.collections_by_key = {}
+        self.items_by_key = {}
+
+    def _bump(self):
+        self.version += 1
+        return self.version
+
+    def add_collection(self, key, name):
+        self.collections_by_key[key] = (self._bump(), {"key": key, "name": name, "parentCollection": False})
+
+    def add_item(self, key, title, item_type="book", parent=None, collections=(), **extra):
+        data = {"key": key, "title": title, "itemType": item_type, "collections": list(collections), **extra}
+        if parent:
+            data["parentItem"] = parent
+        self.items_by_key[key] = (self._bump(), data)
+
+    def remove(self, key):
+        """Borrado en Zotero (sin pasar por /deleted, que una pasada completa no consulta)."""
+        self.items_by_key.pop(key, None)
+        self.collections_by_key.pop(key, None)
+        self._bump()
+
+    def last_modified_version(self):
+        return self.version
+
+    def everything(self, results):
+        return results
+
+    def collections(self, since=0):
+        return [{"key": k, "version": v, "data": d} for k, (v, d) in self.collections_by_key.items() if v > since]
+
+    def items(self, since=0, itemType=None):
+        return [{"key": k, "version": v, "data": d} for k, (v, d) in self.items_by_key.items() if v > since]
+
+    def deleted(self, since=0):
+        return {"collections": [], "items": []}
+
+    def trash(self, since=0):
+        return []
+
+
+def _keys(table, column="id"):
+    with db.read_connection() as conn:
+        return {row[0] for row in conn.execute(
+            f"SELECT {column} FROM {table} WHERE library_type='user' AND library_id='full'")}
+
+
+def test_full_sync_removes_what_zotero_no_longer_has():
+    zot = FakeZotero()
+    zot.add_collection("COL1", "Kept")
+    zot.add_collection("COL2", "Gone")
+    zot.add_item("KEEP", "Kept paper", collections=["COL1"], tags=[{"tag": "a"}])
+    zot.add_item("GONE", "Deleted paper", collections=["COL2"], tags=[{"tag": "b"}])
+    zot.add_item("ATT1", "Kept pdf", item_type="attachment", parent="KEEP", filename="a.pdf")
+    zot.add_item("ATT2", "Deleted pdf", item_type="attachment", parent="GONE", filename="b.pdf")
+    sync_library(lambda: zot, "user", "full")
+    assert _keys("items") == {"KEEP", "GONE"}
+    assert _keys("attachments") == {"ATT1", "ATT2"}
+
+    zot.remove("GONE")
+    zot.remove("ATT2")
+    zot.remove("COL2")
+    sync_library(lambda: zot, "user", "full", full=True)
+
+    assert _keys("items") == {"KEEP"}
+    assert _keys("item_tags", "item_id") == {"KEEP"}
+    assert _keys("item_search", "item_id") == {"KEEP"}
+    assert _keys("item_collections", "item_id") == {"KEEP"}
+    assert _keys("attachments") == {"ATT1"}
+    assert _keys("collections") == {"COL1"}